@@ -1,5 +1,8 @@
 from flask import (
+    Blueprint,
     Flask,
+    Response,
+    current_app,
     request,
     redirect,
     url_for,
@@ -7,20 +10,20 @@ from flask import (
     flash,
     render_template,
     abort,
-    jsonify)
-from datetime import datetime
-from flask_swagger_ui import get_swaggerui_blueprint
-from flask_cors import (
-    CORS,
-    cross_origin)
+    jsonify,
+    stream_with_context)
+from datetime import (
+    date,
+    datetime)
+from jinja2 import FileSystemBytecodeCache
+from sqlalchemy import (
+    Date,
+    String)
 import dateutil.parser
-import babel
-import logging
+import csv
+import io
+import os
 import sys
-from logging import (
-    FileHandler,
-    Formatter)
-from authlib.integrations.flask_client import OAuth
 from urllib.parse import urlencode
 
 # Local imports...
@@ -34,18 +37,41 @@ from models import (
     Employee,
     Supplier,
     AisleContains,
+    Providesdelivery,
     EmployeeDto,
     ProductDto,
+    db,
     setup_db)
 from exceptions import (
     AuthError,
-    EmptyEntityError)
+    EmptyEntityError,
+    UnknownEntityError,
+    VersionConflictError)
 from auth import (
     auth_bp,
     requires_auth,
     requires_login)
-
-app = Flask(__name__)
+from replenishment import suggest_purchase_orders
+from batch import (
+    BATCH_PERMISSIONS,
+    apply_batch,
+    required_permission)
+from logging_config import setup_logging
+from metrics import setup_metrics
+from query_budget import setup_query_budget
+from group_commit import setup_group_commit
+from changefeed import (
+    CHANGE_ENTITIES,
+    CHANGE_PERMISSIONS,
+    setup_changefeed)
+from sessions import setup_sessions
+from compression import setup_compression
+from cors import setup_cors
+from assets import (
+    asset_path,
+    setup_assets)
+
+grocery_bp = Blueprint('grocery', __name__)
 
 ###########################################################
 #
@@ -53,64 +79,101 @@ app = Flask(__name__)
 #
 ###########################################################
 
-app.config.from_object(Config)
+conf_profile_key = Config.PROFILE_KEY
+conf_access_key = Config.ACCESS_KEY
+jwt_payload = Config.JWT_PAYLOAD
+id_key = Config.ID_KEY
+test_token = Config.TEST_TOKEN
+
+audience = Config.API_AUDIENCE
+client_id = Config.CLIENT_ID
+callback_uri = Config.CALLBACK_URL
+
+EXPIRING_REPORT_HEADER = [
+    'id', 'name', 'department_id', 'department_name', 'aisle_number',
+    'aisle_name', 'quantity_in_stock', 'price_per_cost_unit',
+    'markdown_percent', 'best_before_date']
 
-conf_profile_key = app.config['PROFILE_KEY']
-conf_access_key = app.config['ACCESS_KEY']
-jwt_payload = app.config['JWT_PAYLOAD']
-id_key = app.config['ID_KEY']
-profile_key = app.config['PROFILE_KEY']
-test_token = app.config['TEST_TOKEN']
+# Flush the streamed CSV report to the client in chunks of about this size
+REPORT_CHUNK_SIZE = 8192
 
-audience = app.config['API_AUDIENCE']
-auth0_domain = app.config['AUTH0_DOMAIN']
-algorithms = app.config['ALGORITHMS']
-client_id = app.config['CLIENT_ID']
-client_secret = app.config['CLIENT_SECRET']
-access_token_url = app.config['ACCESS_TOKEN_URL']
-authorize_url = app.config['AUTHORIZE_URL']
-callback_uri = app.config['CALLBACK_URL']
-secret_key = app.config['SECRET_KEY']
+# Adjustable product fields and the ways each one can be changed
+ADJUSTMENT_MODES = {
+    'price': ('percent', 'amount', 'value'),
+    'stock': ('amount', 'value')
+}
 
-conf = Config()
+# Ways the wage of many employees can be changed at once
+WAGE_MODES = ('percent', 'amount', 'value')
 
-if app.config["SQLALCHEMY_DATABASE_URI"] is None:
-    app.config["SQLALCHEMY_DATABASE_URI"] = \
-        conf.SQLALCHEMY_DATABASE_URI
+# Rows listed in the preview of a dry-run bulk change
+ADJUSTMENT_PREVIEW_ROWS = 20
 
-if app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] is None:
-    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = \
-        conf.SQLALCHEMY_TRACK_MODIFICATIONS
 
 ###########################################################
 #
-# LOGGING
+# APPLICATION FACTORY
+#
+# Building the app is kept cheap so that a dyno restart or
+# a recycled gunicorn worker answers quickly: modules only
+# a few routes need (babel, authlib) are imported on first
+# use, and compiled templates are cached on disk in
+# JINJA_CACHE_DIR so each new worker loads them instead of
+# compiling them again.
 #
 ###########################################################
 
-if not app.debug:
-    formatter = Formatter('%(asctime)s %(levelname)s: \
-            %(message)s [in %(pathname)s:%(lineno)d]')
-    file_handler = FileHandler('error.log')
-    file_handler.setFormatter(formatter)
-    app.logger.setLevel(logging.INFO)
-    file_handler.setLevel(logging.INFO)
-    app.logger.addHandler(file_handler)
-    app.logger.info('LOGGING LEVEL: INFO')
 
+def create_app(config=Config):
+    app = Flask(__name__)
+    app.config.from_object(config)
 
-###########################################################
-#
-# MAIN APP CODE
-#
-###########################################################
+    if not app.debug:
+        setup_logging(app)
+        app.logger.info(f'LOGGING LEVEL: {app.config["LOG_LEVEL"]}')
+
+    setup_db(app)
+    setup_group_commit(app)
+    setup_changefeed(app)
+    setup_metrics(app)
+    setup_query_budget(app)
+
+    setup_cors(app)
+
+    app.secret_key = app.config['SECRET_KEY']
+    setup_sessions(app)
+    setup_compression(app)
+    app.jinja_env.filters['datetime'] = format_datetime
 
+    if app.config['JINJA_CACHE_DIR']:
+        os.makedirs(app.config['JINJA_CACHE_DIR'], exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(
+            app.config['JINJA_CACHE_DIR'])
 
-setup_db(app)
+    setup_assets(app)
 
-CORS(app, resources={'/': {'origins': '*'}})
+    # Let Swagger UI load the fingerprinted swagger.json when built
+    api_url = app.config['API_URL']
+    static_prefix = f'{app.static_url_path}/'
+    if api_url and api_url.startswith(static_prefix):
+        api_url = asset_path(app, api_url[len(static_prefix):])
+
+    from flask_swagger_ui import get_swaggerui_blueprint
+
+    swagger_bp = get_swaggerui_blueprint(
+        app.config['SWAGGER_URL'],
+        api_url,
+        config={
+            'app_name': "UdaciMarket_Management_System"
+        }
+    )
+
+    app.register_blueprint(swagger_bp, url_prefix='/swagger')
+    app.register_blueprint(auth_bp)
+    app.register_blueprint(grocery_bp)
+
+    return app
 
-app.secret_key = secret_key
 
 # ---------------------------------------------------------------------------
 # TODO Pagination code for displaying database items
@@ -133,6 +196,8 @@ app.secret_key = secret_key
 
 
 def format_datetime(value, format='medium'):
+    import babel.dates
+
     date = dateutil.parser.parse(value)
     if format == 'full':
         format = "EEEE MMMM, d, y 'at' h:mma"
@@ -143,19 +208,128 @@ def format_datetime(value, format='medium'):
     return babel.dates.format_datetime(date, format)
 
 
-app.jinja_env.filters['datetime'] = format_datetime
+def parse_form_date(value):
+    # DATE columns take date objects, not the MM-DD-YYYY form strings,
+    # on every database; a blank field is stored as NULL
+    if value is None or isinstance(value, date) or not value.strip():
+        return value or None
 
-with app.app_context():
-    swagger_bp = get_swaggerui_blueprint(
-        app.config['SWAGGER_URL'],
-        app.config['API_URL'],
-        config={
-            'app_name': "UdaciMarket_Management_System"
-        }
-    )
+    try:
+        return dateutil.parser.parse(value).date()
+    except (ValueError, OverflowError):
+        current_app.logger.info(f'Invalid date "{value}"')
+        abort(422)
+
+
+def _form_update():
+    # The edit forms post their fields with _method=PUT; the Postman
+    # collection and the load test send the same form with a real PUT
+    return request.form.get('_method') == 'PUT' and not request.is_json
 
-    app.register_blueprint(swagger_bp, url_prefix='/swagger')
-    app.register_blueprint(auth_bp)
+
+def _update_fields():
+    # Fields of a partial update: the JSON object of a PUT or a PATCH, or
+    # a form sent with _method=PUT. Only these are written.
+    if request.method == 'PATCH' or \
+            (request.method == 'PUT' and not _form_update()):
+        fields = request.get_json(silent=True)
+
+        if not isinstance(fields, dict):
+            current_app.logger.info('Malformed update')
+            abort(400)
+
+        return dict(fields)
+
+    if not _form_update():
+        current_app.logger.info(
+            'Cannot perform this action. Please contact administrator')
+        abort(405)
+
+    fields = request.form.to_dict()
+    fields.pop('_method', None)
+    fields.pop('id', None)
+
+    return fields
+
+
+def _column_values(model, fields, read_only=()):
+    # Column -> new value of the supplied fields. Keys, versions,
+    # read-only and unknown columns are refused; a blank form field is
+    # NULL unless the column holds text
+    columns = model.__table__.columns
+    values = {}
+
+    for name, value in fields.items():
+        column = columns.get(name)
+
+        if column is None or column.primary_key or \
+                column.name == 'version' or name in read_only:
+            current_app.logger.info(f'Unknown field "{name}"')
+            abort(400)
+
+        if isinstance(column.type, Date):
+            if value is not None and not isinstance(value, str):
+                current_app.logger.info(f'Invalid date "{value}"')
+                abort(400)
+
+            value = parse_form_date(value)
+        elif value == '' and not isinstance(column.type, String):
+            value = None
+
+        values[name] = value
+
+    return values
+
+
+def _expected_version(fields):
+    # The version the edit was made against: the version field of the
+    # edit form or the JSON, else the If-Match header. Without one the
+    # update is not checked.
+    version = fields.pop('version', None)
+
+    if version in (None, '') and request.method in ('PUT', 'PATCH'):
+        tag = request.headers.get('If-Match', '*')
+        version = None if tag == '*' else tag.replace('W/', '').strip('"')
+
+    if version in (None, ''):
+        return None
+
+    try:
+        return int(version)
+    except (TypeError, ValueError):
+        current_app.logger.info(f'Invalid version "{version}"')
+        abort(400)
+
+
+def _form_id(value):
+    # "3 - Baked Goods", as picked in the edit forms, -> 3
+    try:
+        return int(str(value).split(' - ', 2)[0])
+    except ValueError:
+        current_app.logger.info(f'Invalid choice "{value}"')
+        abort(400)
+
+
+def _row_json(row):
+    return {
+        name: value.isoformat() if isinstance(value, date) else value
+        for name, value in row.items()}
+
+
+def _updated(name, data, message, endpoint):
+    # The API gets the updated row(s) back, the edit form the listing
+    if request.method in ('PUT', 'PATCH'):
+        response = jsonify({'success': True, name: data})
+
+        # The If-Match of the next edit
+        if isinstance(data, dict):
+            response.set_etag(str(data['version']))
+
+        return response
+
+    flash(message, 'success')
+
+    return redirect(url_for(endpoint))
 
 
 ###########################################################
@@ -164,19 +338,30 @@ with app.app_context():
 #
 ###########################################################
 
-oauth = OAuth(app)
 
-auth0 = oauth.register(
-    'auth0',
-    client_id=client_id,
-    client_secret=client_secret,
-    api_base_url=f'https://{auth0_domain}',
-    access_token_url=access_token_url,
-    authorize_url=authorize_url,
-    client_kwargs={
-        'scope': 'openid profile email'
-    },
-)
+def _auth0():
+    # The Auth0 client is registered by the first login, logout or
+    # callback; authlib is the slowest import of the app
+    oauth = current_app.extensions.get('authlib.integrations.flask_client')
+
+    if oauth is None:
+        from authlib.integrations.flask_client import OAuth
+
+        config = current_app.config
+        oauth = OAuth(current_app._get_current_object())
+        oauth.register(
+            'auth0',
+            client_id=config['CLIENT_ID'],
+            client_secret=config['CLIENT_SECRET'],
+            api_base_url=f'https://{config["AUTH0_DOMAIN"]}',
+            access_token_url=config['ACCESS_TOKEN_URL'],
+            authorize_url=config['AUTHORIZE_URL'],
+            client_kwargs={
+                'scope': 'openid profile email'
+            },
+        )
+
+    return oauth.auth0
 
 
 ###########################################################
@@ -190,28 +375,34 @@ Authorization and Authentication Routes
 '''
 
 
-@app.route('/login')
+@grocery_bp.route('/login')
 def login():
-    return auth0.authorize_redirect(
+    return _auth0().authorize_redirect(
         redirect_uri=callback_uri,
         audience=audience)
 
 
-@app.route('/logout')
+@grocery_bp.route('/logout')
 def logout():
     session.clear()
     params = {'returnTo': url_for(
-        'home', _external=True),
+        'grocery.home', _external=True),
         'client_id': client_id}
-    return redirect(f'{auth0.api_base_url}/v2/logout?{urlencode(params)}')
+    return redirect(
+        f'{_auth0().api_base_url}/v2/logout?{urlencode(params)}')
 
 
-@app.route('/callback')
+@grocery_bp.route('/callback')
 def callback_handling():
+    auth0 = _auth0()
     token = auth0.authorize_access_token()
     resp = auth0.get('userinfo')
     userinfo = resp.json()
 
+    # A new session id for the logged in user, where supported
+    if hasattr(session, 'regenerate'):
+        session.regenerate()
+
     session[jwt_payload] = userinfo
     session[conf_profile_key] = {
         'user_id': userinfo['sub'],
@@ -229,23 +420,8 @@ def callback_handling():
         'POSTMAN_TOKEN' not in request.headers else 'Guest')
 
 
-'''
-Use the after_request decorator to set Access-Control-Allow
-'''
-
-
-@app.after_request
-def after_request(response):
-    response.headers.add(
-        'Access-Control-Allow-Headers', 'Content-Type, Authorization')
-    response.headers.add(
-        'Access-Control-Allow-Methods',
-        'GET, POST, PATCH, PUT, DELETE, OPTIONS')
-    return response
-
-
-@app.route('/')
-@app.route('/home')
+@grocery_bp.route('/')
+@grocery_bp.route('/home')
 def home():
     # -------------------
     # Home page
@@ -257,11 +433,11 @@ def home():
             'POSTMAN_TOKEN' not in request.headers else 'Guest')
     except KeyError as e:
         tb = sys.exc_info()
-        app.logger.info(e.with_traceback(tb[2]))
+        current_app.logger.info(e.with_traceback(tb[2]))
         return render_template('grocery/home.html')
 
 
-@app.route('/constructions')
+@grocery_bp.route('/constructions')
 def constructions():
     # -------------------
     # Construction page
@@ -269,7 +445,7 @@ def constructions():
     return render_template('errors/construction.html')
 
 
-@app.route('/swaggerLink')
+@grocery_bp.route('/swaggerLink')
 @requires_login
 def swagger_link():
     # -------------------
@@ -283,8 +459,7 @@ def swagger_link():
 # -------------------------------------------------------
 
 
-@app.route('/aisles', methods=['GET'])
-@cross_origin(headers=["Content-Type", "Authorization"])
+@grocery_bp.route('/aisles', methods=['GET'])
 @requires_auth('get:aisle')
 def aisles(self):
     # -------------------------
@@ -294,7 +469,7 @@ def aisles(self):
         aisles = Aisle().list_all_aisles()
 
         if aisles is None:
-            app.logger.info('Aisles table is empty?')
+            current_app.logger.info('Aisles table is empty?')
             abort(422)
 
         return render_template(
@@ -303,12 +478,11 @@ def aisles(self):
             'POSTMAN_TOKEN' not in request.headers and
             'test_permission' not in request.headers else 'Guest')
     except BaseException:
-        app.logger.info('An error occurred. Aisles not available')
+        current_app.logger.info('An error occurred. Aisles not available')
         abort(422)
 
 
-@app.route('/aisles/create', methods=['POST'])
-@cross_origin(headers=["Content-Type", "Authorization"])
+@grocery_bp.route('/aisles/create', methods=['POST'])
 @requires_auth('post:aisle')
 def add_aisle(self):
     # -------------------------
@@ -328,22 +502,21 @@ def add_aisle(self):
             f'Aisle {aisle.aisle_number} was successfully added!',
             'success')
     except EmptyEntityError as e:
-        app.logger.info(f'{e.description} - Aisle')
+        current_app.logger.info(f'{e.description} - Aisle')
         abort(422)
     except BaseException as e:
         tb = sys.exc_info()
-        app.logger.info(e.with_traceback(tb[2]))
-        app.logger.info(
+        current_app.logger.info(e.with_traceback(tb[2]))
+        current_app.logger.info(
             f'An error occurred. Aisle {aisle.aisle_number} \
             could not be added!')
         abort(422)
 
-    return redirect(url_for('aisles'))
+    return redirect(url_for('grocery.aisles'))
 
 
-@app.route(
+@grocery_bp.route(
     '/aisles/<string:aisle_number>', methods=['PUT', 'DELETE', 'POST'])
-@cross_origin(headers=["Content-Type", "Authorization"])
 @requires_auth(['delete:aisle', 'put:aisle'])
 def handle_aisle(self, aisle_number):
     aisle = Aisle(aisle_number=aisle_number)
@@ -352,11 +525,11 @@ def handle_aisle(self, aisle_number):
         aisle = aisle.list_one_or_none_aisle()
 
         if aisle is None:
-            app.logger.info(
+            current_app.logger.info(
                 f'No data with Aisle number = {aisle_number} could be found!')
             abort(422)
     except BaseException:
-        app.logger.info(
+        current_app.logger.info(
             f'No data with Aisle number = {aisle_number} could be found!')
         abort(422)
 
@@ -386,49 +559,53 @@ def handle_aisle(self, aisle_number):
 
             flash(f'Aisle {aisle_number} was successfully deleted!', 'success')
         except BaseException:
-            app.logger.info(
+            current_app.logger.info(
                 f'An error occurred. Aisle {aisle_number} was failed \
                     to be deleted!')
             abort(422)
 
-    elif request.form.get('_method') == 'PUT':
+    else:
         # -------------------------
         # Update data of aisle
         # -------------------------
-
-        aisle.aisle_number = aisle_number
+        fields = _update_fields()
 
         # TODO Actually I think the correct thing to do is to check whether
         # the new value is different than the old value first, then
         # replace if they are different and remain if they are the same.
         # What I did here is okay except for the fact that when user is
         # trying to delete an entry... s/he can't
-        aisle.name = request.form.get('name', aisle.name)
+        aisle.name = fields.get('name', aisle.name)
+
+        version = _expected_version(fields)
 
         try:
-            aisle = aisle.update_aisle_in_database()
-            flash(
-                f'Aisle {aisle_number} was successfully updated!',
-                'success')
+            aisle = aisle.update_aisle_in_database(version)
+        except VersionConflictError:
+            raise
         except BaseException:
-            app.logger.info(
+            current_app.logger.info(
                 f'An error occurred. Aisle {aisle_number} \
                 could not be updated!')
             abort(422)
-    else:
-        app.logger.info(
-            'Cannot perform this action. Please contact administrator')
-        abort(405)
 
-    return redirect(url_for('aisles'))
+        return _updated(
+            'aisle', {
+                'aisle_number': aisle.aisle_number,
+                'name': aisle.name,
+                'version': aisle.version
+            },
+            f'Aisle {aisle_number} was successfully updated!',
+            'grocery.aisles')
+
+    return redirect(url_for('grocery.aisles'))
 
 # ----------------------------------------------------------------
 # Customers
 # ----------------------------------------------------------------
 
 
-@app.route('/customers', methods=['GET'])
-@cross_origin(headers=["Content-Type", "Authorization"])
+@grocery_bp.route('/customers', methods=['GET'])
 @requires_auth('get:customer')
 def customers(self):
     # -------------------------
@@ -438,7 +615,7 @@ def customers(self):
         customers = Customer().list_all_customers()
 
         if customers is None:
-            app.logger.info('Customers table is empty?')
+            current_app.logger.info('Customers table is empty?')
             abort(422)
 
         return render_template(
@@ -447,12 +624,11 @@ def customers(self):
             'POSTMAN_TOKEN' not in request.headers and
             'test_permission' not in request.headers else 'Guest')
     except BaseException:
-        app.logger.info('An error occurred. Customers not available')
+        current_app.logger.info('An error occurred. Customers not available')
         abort(422)
 
 
-@app.route('/customers/create', methods=['POST'])
-@cross_origin(headers=["Content-Type", "Authorization"])
+@grocery_bp.route('/customers/create', methods=['POST'])
 @requires_auth('post:customer')
 def add_customer(self):
     # -------------------------
@@ -467,7 +643,7 @@ def add_customer(self):
     try:
         id = Customer().get_next_customer_id()
     except BaseException:
-        app.logger.info('Error finding next customer ID')
+        current_app.logger.info('Error finding next customer ID')
         abort(422)
 
     customer = Customer(
@@ -481,64 +657,153 @@ def add_customer(self):
         customer = customer.add_customer_to_database()
         flash(f'Customer {name} was successfully added!', 'success')
     except BaseException:
-        app.logger.info(
+        current_app.logger.info(
             f'An error occurred. Customer {name} could not be added!')
         abort(422)
 
-    return redirect(url_for('customers'))
+    return redirect(url_for('grocery.customers'))
 
 
-@app.route('/customers/<string:customer_id>', methods=['PUT', 'POST'])
-@cross_origin(headers=["Content-Type", "Authorization"])
+@grocery_bp.route(
+    '/customers/<int:customer_id>', methods=['PUT', 'PATCH', 'POST'])
 @requires_auth('put:customer')
 def update_customer(self, customer_id):
     # -------------------------
     # Update data of customer
     # -------------------------
-    if request.form.get('_method') != 'PUT':
-        app.logger.Info(
-            'Cannot perform this action. Please contact administrator')
-        abort(405)
-
-    customer = Customer(id=customer_id)
+    fields = _update_fields()
+    version = _expected_version(fields)
+    values = _column_values(Customer, fields)
 
     try:
-        customer = customer.list_one_or_none_customer()
-
-        if customer is None:
-            app.logger.info(
-                f'No data with Customer ID = {customer_id} could be found!')
-            abort(422)
+        row = Customer(id=customer_id).patch_customer_in_database(
+            values, version)
+    except VersionConflictError:
+        raise
     except BaseException:
-        app.logger.info(
-            f'An error occurred. No data with Customer ID\
-                 = {customer_id} could be found!')
+        current_app.logger.info(
+            f'An error occurred. Customer {customer_id} could not be updated!')
         abort(422)
 
-    customer.id = customer_id
-    customer.name = request.form.get('name', customer.name)
-    customer.phone = request.form.get('phone', customer.phone)
-    customer.email = request.form.get('email', customer.email)
+    if row is None:
+        current_app.logger.info(
+            f'No data with Customer ID = {customer_id} could be found!')
+        abort(404)
+
+    return _updated(
+        'customer', _row_json(row),
+        f'Customer {customer_id} was successfully updated!',
+        'grocery.customers')
+
+
+def _purchase_history(customer_id):
+    # The customer, their lifetime stats and one page of their purchases,
+    # newest first. The page after this one starts past next_cursor.
+    cursor = request.args.get('cursor', None)
+    limit = request.args.get(
+        'limit', current_app.config['PURCHASE_HISTORY_PAGE_SIZE'], type=int)
+    after = None
+
+    if not 0 < limit <= current_app.config['PURCHASE_HISTORY_MAX_PAGE_SIZE']:
+        current_app.logger.info(f'Invalid purchase history page of {limit}')
+        abort(400)
 
     try:
-        customer.update_customer_in_database()
-        flash(
-            f'Customer {customer_id} was successfully updated!',
-            'success')
+        if cursor is not None:
+            id, product_id = cursor.split(':', 1)
+            after = (int(id), int(product_id))
+    except ValueError:
+        current_app.logger.info(f'Invalid purchase history cursor {cursor}')
+        abort(400)
+
+    customer = Customer(id=customer_id)
+
+    try:
+        result = customer.list_one_or_none_customer_with_stats()
+
+        # One row more than the page tells whether there is a next page
+        if result is not None:
+            rows = customer.list_purchase_history(after, limit + 1)
     except BaseException:
-        app.log.info(f'An error occurred. Customer {customer_id} \
-            could not be updated!')
+        current_app.logger.info(
+            f'An error occurred. Purchases of Customer {customer_id} \
+            not available')
         abort(422)
 
-    return redirect(url_for('customers'))
+    if result is None:
+        current_app.logger.info(
+            f'No data with Customer ID = {customer_id} could be found!')
+        abort(404)
+
+    customer, stats = result
+    next_cursor = None
+
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = f'{rows[-1].id}:{rows[-1].product_id}'
+
+    return {
+        'customer': {
+            'id': customer.id,
+            'name': customer.name,
+            'phone': customer.phone,
+            'email': customer.email
+        },
+        'stats': {
+            'order_count': stats.order_count if stats else 0,
+            'lifetime_spend': round(stats.lifetime_spend, 2) if stats else 0,
+            'last_purchase_date':
+                stats.last_purchase_date.isoformat()
+                if stats and stats.last_purchase_date else None
+        },
+        'purchases': [{
+            'id': row.id,
+            'product_id': row.product_id,
+            'product_name': row.product_name,
+            'quantity': row.quantity,
+            'total': row.total,
+            'purchase_date':
+                row.purchase_date.isoformat() if row.purchase_date else None,
+            'is_cancelled': row.is_cancelled
+        } for row in rows],
+        'next_cursor': next_cursor
+    }
+
+
+@grocery_bp.route('/customers/<int:customer_id>/history', methods=['GET'])
+@requires_auth('get:customer')
+def customer_detail(self, customer_id):
+    # -------------------------
+    # Customer page with their
+    # purchase history
+    # -------------------------
+    history = _purchase_history(customer_id)
+
+    return render_template(
+        'grocery/customer.html', data=history,
+        nickname=session[conf_profile_key]['nickname'] if
+        'POSTMAN_TOKEN' not in request.headers and
+        'test_permission' not in request.headers else 'Guest')
+
+
+@grocery_bp.route('/customers/<int:customer_id>/purchases', methods=['GET'])
+@requires_auth('get:customer')
+def customer_purchases(self, customer_id):
+    # -------------------------
+    # Purchase history of a
+    # customer as JSON
+    # -------------------------
+    history = _purchase_history(customer_id)
+    history['success'] = True
+
+    return jsonify(history)
 
 
 # -------------------------------------------------------
 # Departments
 # -------------------------------------------------------
 
-@app.route('/departments', methods=['GET'])
-@cross_origin(headers=["Content-Type", "Authorization"])
+@grocery_bp.route('/departments', methods=['GET'])
 @requires_auth('get:department')
 def departments(self):
     # -------------------------
@@ -548,7 +813,7 @@ def departments(self):
         departments = Department().list_all_departments()
 
         if departments is None:
-            app.logger.info('Departments table is empty?')
+            current_app.logger.info('Departments table is empty?')
             abort(422)
 
         return render_template(
@@ -557,12 +822,11 @@ def departments(self):
             'POSTMAN_TOKEN' not in request.headers and
             'test_permission' not in request.headers else 'Guest')
     except BaseException:
-        app.logger.info('An error occurred. Departments not available')
+        current_app.logger.info('An error occurred. Departments not available')
         abort(422)
 
 
-@app.route('/departments/create', methods=['POST'])
-@cross_origin(headers=["Content-Type", "Authorization"])
+@grocery_bp.route('/departments/create', methods=['POST'])
 @requires_auth('post:department')
 def add_department(self):
     # -------------------------
@@ -575,7 +839,7 @@ def add_department(self):
     try:
         id = Department().get_next_department_id()
     except BaseException:
-        app.logger.info('Error finding next department ID')
+        current_app.logger.info('Error finding next department ID')
         abort(422)
 
     department = Department(
@@ -587,73 +851,66 @@ def add_department(self):
         department = department.add_department_to_database()
         flash(f'Department {name} was successfully added!', 'success')
     except BaseException:
-        app.logger.info(
+        current_app.logger.info(
             f'An error occurred. Department {name} could not be added!')
         abort(422)
 
-    return redirect(url_for('departments'))
+    return redirect(url_for('grocery.departments'))
 
 
-@app.route('/departments/<string:department_id>', methods=['PUT', 'POST'])
-@cross_origin(headers=["Content-Type", "Authorization"])
+@grocery_bp.route(
+    '/departments/<int:department_id>', methods=['PUT', 'PATCH', 'POST'])
 @requires_auth('put:department')
 def update_department(self, department_id):
     # -------------------------
     # Update data of department
     # -------------------------
-    if request.form.get('_method') != 'PUT':
-        app.logger.Info(
-            'Cannot perform this action. Please contact administrator')
-        abort(405)
-
-    department = Department(id=department_id)
-
-    try:
-        department = department.list_one_or_none_department()
-
-        if department is None:
-            app.logger.info(
-                f'No data with Department ID =\
-                    {department_id} could be found!')
-            abort(422)
-    except BaseException:
-        app.logger.info(
-            f'An error occurred. No data with Department ID\
-                 = {department_id} could be found!')
-        abort(422)
-
-    department.id = department_id
-    department.name = request.form.get('name', department.name)
+    fields = _update_fields()
+    version = _expected_version(fields)
+    values = _column_values(Department, fields)
 
     try:
-        department.update_department_in_database()
-        flash(
-            f'Department {department_id} was successfully updated!',
-            'success')
+        row = Department(id=department_id).patch_department_in_database(
+            values, version)
+    except VersionConflictError:
+        raise
     except BaseException:
-        app.log.info(f'An error occurred. Department {department_id} \
+        current_app.logger.info(
+            f'An error occurred. Department {department_id} \
             could not be updated!')
         abort(422)
 
-    return redirect(url_for('departments'))
+    if row is None:
+        current_app.logger.info(
+            f'No data with Department ID = {department_id} could be found!')
+        abort(404)
+
+    return _updated(
+        'department', _row_json(row),
+        f'Department {department_id} was successfully updated!',
+        'grocery.departments')
 
 
 # ----------------------------------------------------------------
 # Employees
 # ----------------------------------------------------------------
 
-@app.route('/employees', methods=['GET'])
-@cross_origin(headers=["Content-Type", "Authorization"])
+@grocery_bp.route('/employees', methods=['GET'])
 @requires_auth('get:employee')
 def employees(self):
     # -------------------------
     # List all employees
     # -------------------------
+    # Inactive staff are left out by the query unless asked for
+    include_inactive = \
+        request.args.get('include_inactive', 'false').lower() == 'true'
+
     try:
-        results = Employee().list_all_employees_filtered(Department())
+        results = Employee().list_all_employees_filtered(
+            Department(), include_inactive)
 
         if results is None:
-            app.logger.info('No matches between Employees\
+            current_app.logger.info('No matches between Employees\
                 and Department tables')
             abort(422)
 
@@ -670,7 +927,8 @@ def employees(self):
                 address=emp.address,
                 phone=emp.phone,
                 wage=emp.wage,
-                is_active=emp.is_active
+                is_active=emp.is_active,
+                version=emp.version
             )
 
             dtos.append(dto)
@@ -678,22 +936,21 @@ def employees(self):
         departments = Department().list_all_departments()
 
         if departments is None or len(departments) == 0:
-            app.logger.info('Departments table is empty?')
+            current_app.logger.info('Departments table is empty?')
             abort(422)
 
         return render_template(
             'grocery/employees.html', data=dtos,
-            departments=departments,
+            departments=departments, include_inactive=include_inactive,
             nickname=session[conf_profile_key]['nickname'] if
             'POSTMAN_TOKEN' not in request.headers and
             'test_permission' not in request.headers else 'Guest')
     except BaseException:
-        app.logger.info('An error occurred. Employees not available')
+        current_app.logger.info('An error occurred. Employees not available')
         abort(422)
 
 
-@app.route('/employees/create', methods=['POST'])
-@cross_origin(headers=["Content-Type", "Authorization"])
+@grocery_bp.route('/employees/create', methods=['POST'])
 @requires_auth('post:employee')
 def add_employee(self):
     # -------------------------
@@ -713,7 +970,7 @@ def add_employee(self):
     try:
         id = Employee().get_next_employee_id()
     except BaseException:
-        app.logger.info('Error finding next employee ID')
+        current_app.logger.info('Error finding next employee ID')
         abort(422)
 
     employee = Employee(
@@ -732,72 +989,145 @@ def add_employee(self):
         employee = employee.add_employee_to_database()
         flash(f'Employee {name} was successfully added!', 'success')
     except BaseException:
-        app.logger.info(
+        current_app.logger.info(
             f'An error occurred. Employee {name} could not be added!')
         abort(422)
 
-    return redirect(url_for('employees'))
+    return redirect(url_for('grocery.employees'))
 
 
-@app.route('/employees/<string:employee_id>', methods=['PUT', 'POST'])
-@cross_origin(headers=["Content-Type", "Authorization"])
+@grocery_bp.route(
+    '/employees/<int:employee_id>', methods=['PUT', 'PATCH', 'POST'])
 @requires_auth('put:employee')
 def update_employee(self, employee_id):
     # -------------------------
     # Update data of employee
     # -------------------------
-    if request.form.get('_method') != 'PUT':
-        app.logger.Info(
-            'Cannot perform this action. Please contact administrator')
-        abort(405)
+    fields = _update_fields()
 
-    employee = Employee(id=employee_id)
+    if 'department_name' in fields:
+        fields['department_id'] = _form_id(fields.pop('department_name'))
 
-    try:
-        employee = employee.list_one_or_none_employee()
+    # An unticked checkbox is not posted; the edit form always has one
+    if _form_update():
+        fields['is_active'] = 'is_active' in fields
 
-        if employee is None:
-            app.logger.info(
-                f'No data with Employee ID = {employee_id} could be found!')
-            abort(422)
+    version = _expected_version(fields)
+    values = _column_values(Employee, fields)
+
+    try:
+        row = Employee(id=employee_id).patch_employee_in_database(
+            values, version)
+    except VersionConflictError:
+        raise
     except BaseException:
-        app.logger.info(
-            f'An error occurred. No data with Employee ID\
-                 = {employee_id} could be found!')
+        current_app.logger.info(
+            f'An error occurred. Employee {employee_id} could not be updated!')
         abort(422)
 
-    employee.id = employee_id
-    employee.name = request.form.get('name', employee.name)
+    if row is None:
+        current_app.logger.info(
+            f'No data with Employee ID = {employee_id} could be found!')
+        abort(404)
+
+    return _updated(
+        'employee', _row_json(row),
+        f'Employee {employee_id} was successfully updated!',
+        'grocery.employees')
+
 
-    temp = request.form.get('department_name')
-    employee.department_id = temp.split(' - ', 2)[0]
+@grocery_bp.route('/employees/bulk', methods=['POST'])
+@requires_auth('put:employee')
+def bulk_update_employees(self):
+    # -------------------------
+    # Transfer, deactivate, reactivate or change the wage of many
+    # employees at once
+    # -------------------------
+    body = request.get_json(silent=True) or {}
+    action = body.get('action')
+    dry_run = body.get('dry_run', False)
+    targets = {}
+    mode = value = None
+
+    try:
+        if action == 'transfer':
+            value = int(body['to_department_id'])
+        elif action == 'wage':
+            modes = [mode for mode in WAGE_MODES if mode in body]
+
+            if len(modes) != 1:
+                raise ValueError(f'Expected one of {WAGE_MODES}')
+
+            mode = modes[0]
+            value = body[mode]
+
+            if isinstance(value, bool) or \
+                    not isinstance(value, (int, float)):
+                raise ValueError(f'Invalid {mode} {value}')
+        elif action not in ('deactivate', 'reactivate'):
+            raise ValueError(f'Unknown action {action}')
+
+        if body.get('department_id') is not None:
+            targets['department_id'] = int(body['department_id'])
+
+        if body.get('employee_ids') is not None:
+            targets['employee_ids'] = [
+                int(employee_id) for employee_id in body['employee_ids']]
 
-    employee.title = request.form.get('title', employee.title)
-    employee.emp_number = request.form.get('emp_number', employee.emp_number)
-    employee.address = request.form.get('address', employee.address)
-    employee.phone = request.form.get('phone', employee.phone)
-    employee.wage = request.form.get('wage', employee.wage)
-    employee.is_active = 'is_active' in request.form
+        # Changing the whole staff has to be asked for explicitly
+        if not targets and body.get('all') is not True:
+            raise ValueError('No employees targeted')
+
+        if not isinstance(dry_run, bool):
+            raise ValueError(f'Invalid dry_run {dry_run}')
+    except (KeyError, TypeError, ValueError) as e:
+        current_app.logger.info(f'Malformed bulk employee change: {e}')
+        abort(400)
 
     try:
-        employee.update_employee_in_database()
-        flash(
-            f'Employee {employee_id} was successfully updated!',
-            'success')
+        if action == 'transfer' and \
+                Department(id=value).list_one_or_none_department() is None:
+            current_app.logger.info(f'No department with ID = {value}')
+            abort(422)
+
+        if dry_run:
+            preview = Employee().preview_bulk_change(
+                action, targets, mode, value, ADJUSTMENT_PREVIEW_ROWS)
+        else:
+            count = Employee().apply_bulk_change(action, targets, mode, value)
     except BaseException:
-        app.log.info(f'An error occurred. Employee {employee_id} \
-            could not be updated!')
+        current_app.logger.info(
+            'An error occurred. Employees could not be updated!')
         abort(422)
 
-    return redirect(url_for('employees'))
+    if dry_run:
+        result = {
+            'success': True,
+            'dry_run': True,
+            'action': action,
+            'employees': preview['matched'],
+            'preview': preview['rows']
+        }
+
+        if action == 'wage':
+            result['total_before'] = preview['total_before']
+            result['total_after'] = preview['total_after']
+
+        return jsonify(result)
+
+    return jsonify({
+        'success': True,
+        'dry_run': False,
+        'action': action,
+        'employees': count
+    })
 
 
 # ----------------------------------------------------------------
 # Products
 # ----------------------------------------------------------------
 
-@app.route('/products', methods=['GET'])
-@cross_origin(headers=["Content-Type", "Authorization"])
+@grocery_bp.route('/products', methods=['GET'])
 @requires_auth('get:product')
 def products(self):
     # -------------------------
@@ -808,7 +1138,7 @@ def products(self):
             Department(), AisleContains(), Aisle())
 
         if results is None:
-            app.logger.info('No matches between Products,\
+            current_app.logger.info('No matches between Products,\
                 Departments, AisleContains, and Aisles tables')
             abort(422)
 
@@ -832,7 +1162,8 @@ def products(self):
                 animal=prod.animal,
                 department_name=dept.name,
                 aisle_number=aico.aisle_number,
-                aisle_name=aisl.name
+                aisle_name=aisl.name,
+                version=prod.version
             )
 
             dtos.append(dto)
@@ -840,13 +1171,13 @@ def products(self):
         departments = Department().list_all_departments()
 
         if departments is None or len(departments) == 0:
-            app.logger.info('Departments table is empty?')
+            current_app.logger.info('Departments table is empty?')
             abort(422)
 
         aisles = Aisle().list_all_aisles()
 
         if aisles is None or len(aisles) == 0:
-            app.logger.info('Aisles table is empty?')
+            current_app.logger.info('Aisles table is empty?')
             abort(422)
 
         return render_template(
@@ -857,13 +1188,12 @@ def products(self):
             'test_permission' not in request.headers else 'Guest')
     except BaseException as e:
         tb = sys.exc_info()
-        app.logger.info(e.with_traceback(tb[2]))
-        app.logger.info('An error occurred. Products not available')
+        current_app.logger.info(e.with_traceback(tb[2]))
+        current_app.logger.info('An error occurred. Products not available')
         abort(422)
 
 
-@app.route('/products/create', methods=['POST'])
-@cross_origin(headers=["Content-Type", "Authorization"])
+@grocery_bp.route('/products/create', methods=['POST'])
 @requires_auth('post:product')
 def add_product(self):
     # -------------------------
@@ -877,11 +1207,11 @@ def add_product(self):
     quantity_in_stock = request.form.get('quantity_in_stock', 0)
     brand = request.form.get('brand', None)
 
-    production_date = request.form.get(
-        'production_date', datetime.today().strftime('%m/%d/%Y'))
+    production_date = parse_form_date(request.form.get(
+        'production_date', datetime.today().strftime('%m/%d/%Y')))
 
-    best_before_date = request.form.get(
-        'best_before_date', datetime.today().strftime('%m/%d/%Y'))
+    best_before_date = parse_form_date(request.form.get(
+        'best_before_date', datetime.today().strftime('%m/%d/%Y')))
 
     plu = request.form.get('plu', None)
     upc = request.form.get('upc', None)
@@ -896,7 +1226,7 @@ def add_product(self):
     try:
         id = Product().get_next_product_id()
     except BaseException:
-        app.logger.info('Error finding next product ID')
+        current_app.logger.info('Error finding next product ID')
         abort(422)
 
     organic = 0
@@ -936,124 +1266,189 @@ def add_product(self):
 
         flash(f'Product {name} was successfully added!', 'success')
     except BaseException:
-        app.logger.info(
+        current_app.logger.info(
             f'An error occurred. Product {name} could not be added!')
         abort(422)
 
     return redirect('/products')
 
 
-@app.route('/products/<int:product_id>', methods=['PUT', 'POST'])
-@cross_origin(headers=["Content-Type", "Authorization"])
+@grocery_bp.route(
+    '/products/<int:product_id>', methods=['PUT', 'PATCH', 'POST'])
 @requires_auth('put:product')
 def update_product(self, product_id):
     # -------------------------
     # Update data of product
     # -------------------------
-    if request.form.get('_method') != 'PUT':
-        app.logger.Info(
-            'Cannot perform this action. Please contact administrator')
-        abort(405)
+    fields = _update_fields()
+    aisle_number = None
+
+    if 'department_name' in fields:
+        fields['department_id'] = _form_id(fields.pop('department_name'))
+
+    # The aisle is kept in the AisleContains table
+    if 'aisle_name' in fields:
+        aisle_number = _form_id(fields.pop('aisle_name'))
+    elif 'aisle_number' in fields:
+        aisle_number = _form_id(fields.pop('aisle_number'))
+
+    # An unticked checkbox is not posted; the edit form always has one
+    if _form_update():
+        fields['organic'] = 1 if fields.get('organic') == 'on' else 0
 
-    product = Product(id=product_id)
+    version = _expected_version(fields)
+    values = _column_values(Product, fields, ('markdown_percent',))
 
     try:
-        product = product.list_one_or_none_product()
+        row = Product(id=product_id).patch_product_in_database(
+            values, aisle_number, version)
+    except VersionConflictError:
+        raise
+    except BaseException:
+        current_app.logger.info(
+            f'An error occurred. Product {product_id} could not be updated!')
+        abort(422)
 
-        if product is None:
-            app.logger.info(
-                f'No data with Employee ID = {product_id} could be found!')
-            abort(422)
+    if row is None:
+        current_app.logger.info(
+            f'No data with Product ID = {product_id} could be found!')
+        abort(404)
 
-        product.id = product_id
-        product.name = request.form.get('name', product.name)
-        product.price_per_cost_unit = request.form.get(
-            'price_per_cost_unit', product.price_per_cost_unit)
-        product.cost_unit = request.form.get('cost_unit', product.cost_unit)
-        product.quantity_in_stock = request.form.get(
-            'quantity_in_stock', product.quantity_in_stock)
-        product.brand = request.form.get('brand', product.brand)
+    return _updated(
+        'product', _row_json(row),
+        f'Product {product_id} was successfully updated!',
+        'grocery.products')
 
-        product.production_date = request.form.get(
-            'production_date', product.production_date)
 
-        product.best_before_date = request.form.get(
-            'best_before_date', product.best_before_date)
+@grocery_bp.route('/products/expiring', methods=['GET'])
+@requires_auth('get:product')
+def expiring_products(self):
+    # -------------------------
+    # Stream the expiring-stock report as CSV
+    # -------------------------
+    days = request.args.get(
+        'days', current_app.config['EXPIRING_DAYS'], type=int)
+    department_id = request.args.get('department_id', None, type=int)
+    aisle_number = request.args.get('aisle_number', None, type=int)
 
-        product.plu = request.form.get('plu', product.plu)
-        product.upc = request.form.get('upc', product.upc)
-        form_organic = request.form.get('organic', 'off')
+    if days < 0:
+        current_app.logger.info(f'Invalid expiring window of {days} days')
+        abort(400)
 
-        product.organic = 0
+    try:
+        rows = Product().list_expiring_products(
+            days, department_id, aisle_number)
+    except BaseException:
+        current_app.logger.info(
+            'An error occurred. Expiring products not available')
+        abort(422)
 
-        if form_organic == 'on':
-            product.organic = 1
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPIRING_REPORT_HEADER)
 
-        product.cut = request.form.get('cut', product.cut)
-        product.animal = request.form.get('animal', product.animal)
+        for row in rows:
+            writer.writerow(row)
 
-        department = request.form.get('department_name')
-        product.department_id = department.split(' - ', 2)[0]
+            if buffer.tell() >= REPORT_CHUNK_SIZE:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate(0)
 
-        # Need to update aisle_number in AisleContains table as well
-        aisle = request.form.get('aisle_name')
+        yield buffer.getvalue()
 
-        if aisle is not None:
-            aisle_number = int(aisle.split(' - ', 2)[0])
-            aisle_contains = AisleContains(
-                aisle_number=aisle_number,
-                product_id=product_id
-            )
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/csv',
+        headers={
+            'Content-Disposition':
+                f'attachment; filename=expiring_products_{days}_days.csv'
+        })
 
-            aisle_contains = \
-                aisle_contains.list_one_or_none_aisle_contains(product)
-
-            if aisle_contains is not None:
-                aisle_contains.aisle_number = aisle_number
-            else:
-                aisle_contains = AisleContains(
-                    aisle_number=aisle_number,
-                    product_id=product_id
-                )
-
-                # If the product is associated with any aisle, this code
-                # should never have been reached. The other option here
-                # would be to add the association to the AisleContains
-                # table.
-                try:
-                    aisle_contains = \
-                        aisle_contains.add_aisle_contains_to_database()
-                except BaseException:
-                    app.logger.info(
-                        f'An error occurred. Product {product_id} failed to be \
-                        associated with Aisle {aisle_number}.')
-                    abort(422)
 
-        try:
-            product.update_product_in_database()
-            flash(
-                f'Product {product_id} was successfully updated!',
-                'success')
-        except BaseException:
-            app.logger.info(
-                f'An error occurred. Product {product_id} \
-                    could not be updated!')
-            abort(422)
+@grocery_bp.route('/products/adjust', methods=['POST'])
+@requires_auth('put:product')
+def adjust_products(self):
+    # -------------------------
+    # Change the price or the stock of many products at once
+    # -------------------------
+    body = request.get_json(silent=True) or {}
+    field = body.get('field')
+    dry_run = body.get('dry_run', False)
+    targets = {}
+
+    try:
+        modes = [
+            mode for mode in ADJUSTMENT_MODES[field] if mode in body]
+
+        if len(modes) != 1:
+            raise ValueError(f'Expected one of {ADJUSTMENT_MODES[field]}')
+
+        mode = modes[0]
+        value = body[mode]
+
+        if isinstance(value, bool) or \
+                not isinstance(value, int if field == 'stock' else
+                               (int, float)):
+            raise ValueError(f'Invalid {mode} {value}')
+
+        for key in ('department_id', 'aisle_number'):
+            if body.get(key) is not None:
+                targets[key] = int(body[key])
+
+        if body.get('brand') is not None:
+            targets['brand'] = str(body['brand'])
+
+        if body.get('product_ids') is not None:
+            targets['product_ids'] = [
+                int(product_id) for product_id in body['product_ids']]
+
+        # A catalog-wide change has to be asked for explicitly
+        if not targets and body.get('all') is not True:
+            raise ValueError('No products targeted')
+
+        if not isinstance(dry_run, bool):
+            raise ValueError(f'Invalid dry_run {dry_run}')
+    except (KeyError, TypeError, ValueError) as e:
+        current_app.logger.info(f'Malformed product adjustment: {e}')
+        abort(400)
+
+    try:
+        if dry_run:
+            preview = Product().preview_adjustment(
+                field, mode, value, targets, ADJUSTMENT_PREVIEW_ROWS)
+        else:
+            count = Product().apply_adjustment(field, mode, value, targets)
     except BaseException:
-        app.logger.info(
-            f'An error occurred. No data with Product ID\
-                 = {product_id} could be found!')
+        current_app.logger.info(
+            'An error occurred. Products could not be adjusted!')
         abort(422)
 
-    return redirect('/products')
+    if dry_run:
+        return jsonify({
+            'success': True,
+            'dry_run': True,
+            'field': field,
+            'products': preview['matched'],
+            'total_before': preview['total_before'],
+            'total_after': preview['total_after'],
+            'preview': preview['rows']
+        })
+
+    return jsonify({
+        'success': True,
+        'dry_run': False,
+        'field': field,
+        'products': count
+    })
 
 
 # ----------------------------------------------------------------
 # Suppliers
 # ----------------------------------------------------------------
 
-@app.route('/suppliers', methods=['GET'])
-@cross_origin(headers=["Content-Type", "Authorization"])
+@grocery_bp.route('/suppliers', methods=['GET'])
 @requires_auth('get:supplier')
 def suppliers(self):
     # -------------------------
@@ -1063,7 +1458,7 @@ def suppliers(self):
         suppliers = Supplier().list_all_suppliers()
 
         if suppliers is None:
-            app.logger.info('Suppliers table is empty?')
+            current_app.logger.info('Suppliers table is empty?')
             abort(422)
 
         return render_template(
@@ -1072,12 +1467,11 @@ def suppliers(self):
             'POSTMAN_TOKEN' not in request.headers and
             'test_permission' not in request.headers else 'Guest')
     except BaseException:
-        app.logger.info('An error occurred. Suppliers not available')
+        current_app.logger.info('An error occurred. Suppliers not available')
         abort(422)
 
 
-@app.route('/suppliers/create', methods=['POST'])
-@cross_origin(headers=["Content-Type", "Authorization"])
+@grocery_bp.route('/suppliers/create', methods=['POST'])
 @requires_auth('post:supplier')
 def add_supplier(self):
     # -------------------------
@@ -1092,7 +1486,7 @@ def add_supplier(self):
     try:
         id = Supplier().get_next_supplier_id()
     except BaseException:
-        app.logger.info('Error finding next supplier ID')
+        current_app.logger.info('Error finding next supplier ID')
         abort(422)
 
     supplier = Supplier(
@@ -1106,57 +1500,154 @@ def add_supplier(self):
         supplier = supplier.add_supplier_to_database()
         flash(f'Supplier {name} was successfully added!', 'success')
     except BaseException:
-        app.logger.info(
+        current_app.logger.info(
             f'An error occurred. Supplier {name} could not be added!')
         abort(422)
 
-    return redirect(url_for('suppliers'))
+    return redirect(url_for('grocery.suppliers'))
 
 
-@app.route('/suppliers/<int:supplier_id>', methods=['PUT', 'POST'])
-@cross_origin(headers=["Content-Type", "Authorization"])
+@grocery_bp.route(
+    '/suppliers/<int:supplier_id>', methods=['PUT', 'PATCH', 'POST'])
 @requires_auth('put:supplier')
 def update_supplier(self, supplier_id):
     # -------------------------
     # Update data of supplier
     # -------------------------
-    if request.form.get('_method') != 'PUT':
-        app.logger.Info(
-            'Cannot perform this action. Please contact administrator')
-        abort(405)
+    fields = _update_fields()
+    version = _expected_version(fields)
+    values = _column_values(Supplier, fields)
+
+    try:
+        row = Supplier(id=supplier_id).patch_supplier_in_database(
+            values, version)
+    except VersionConflictError:
+        raise
+    except BaseException:
+        current_app.logger.info(
+            f'An error occurred. Supplier {supplier_id} could not be updated!')
+        abort(422)
+
+    if row is None:
+        current_app.logger.info(
+            f'No data with Supplier ID = {supplier_id} could be found!')
+        abort(404)
+
+    return _updated(
+        'supplier', _row_json(row),
+        f'Supplier {supplier_id} was successfully updated!',
+        'grocery.suppliers')
+
+
+# ----------------------------------------------------------------
+# Replenishment
+# ----------------------------------------------------------------
+
+@grocery_bp.route('/replenishment', methods=['GET'])
+@requires_auth('get:supplier')
+def replenishment(self):
+    # -------------------------
+    # Suggested purchase orders
+    # grouped by supplier
+    # -------------------------
+    window_days = request.args.get(
+        'window_days', current_app.config['REPLENISH_WINDOW_DAYS'],
+        type=int)
+    cover_days = request.args.get(
+        'cover_days', current_app.config['REPLENISH_COVER_DAYS'],
+        type=int)
+    as_of = request.args.get('as_of', None)
+
+    if window_days <= 0 or cover_days < 0:
+        current_app.logger.info(
+            f'Invalid replenishment window {window_days} / {cover_days}')
+        abort(400)
 
-    supplier = Supplier(id=supplier_id)
+    try:
+        if as_of is not None:
+            as_of = dateutil.parser.parse(as_of).date()
+    except (ValueError, OverflowError):
+        current_app.logger.info(f'Invalid replenishment date {as_of}')
+        abort(400)
 
     try:
-        supplier = supplier.list_one_or_none_supplier()
+        orders = suggest_purchase_orders(
+            db, window_days, cover_days, as_of)
+    except BaseException:
+        current_app.logger.info(
+            'An error occurred. Suggested purchase orders not available')
+        abort(422)
 
-        if supplier_id is None:
-            app.logger.info(
-                f'No data with Supplier ID =\
-                    {supplier_id} could be found!')
-            abort(422)
+    return jsonify({
+        'success': True,
+        'window_days': window_days,
+        'cover_days': cover_days,
+        'purchase_orders': orders
+    })
+
+
+# ----------------------------------------------------------------
+# Deliveries
+# ----------------------------------------------------------------
+
+@grocery_bp.route('/deliveries/create', methods=['POST'])
+@requires_auth('put:product')
+def receive_delivery(self):
+    # -------------------------
+    # Receive a delivery manifest
+    # -------------------------
+    manifest = request.get_json(silent=True) or {}
+    lines = {}
+
+    try:
+        supplier_id = int(manifest['supplier_id'])
+
+        # Repeated products in the manifest are received as one line
+        for line in manifest['lines']:
+            product_id = int(line['product_id'])
+            quantity = int(line['quantity'])
+
+            if quantity <= 0:
+                raise ValueError(f'Invalid quantity {quantity}')
+
+            lines[product_id] = lines.get(product_id, 0) + quantity
+    except (KeyError, TypeError, ValueError) as e:
+        current_app.logger.info(f'Malformed delivery manifest: {e}')
+        abort(400)
+
+    if len(lines) == 0:
+        current_app.logger.info('Delivery manifest has no lines')
+        abort(400)
+
+    try:
+        delivery_id = Providesdelivery().get_next_delivery_id()
     except BaseException:
-        app.logger.info(
-            f'An error occurred. No data with Supplier ID\
-                 = {supplier_id} could be found!')
+        current_app.logger.info('Error finding next delivery ID')
         abort(422)
 
-    supplier.id = supplier_id
-    supplier.name = request.form.get("name", supplier.name)
-    supplier.address = request.form.get("address", supplier.address)
-    supplier.phone = request.form.get("phone", supplier.phone)
+    delivery = Providesdelivery(
+        delivery_id=delivery_id,
+        supplier_id=supplier_id
+    )
 
     try:
-        supplier.update_supplier_in_database()
-        flash(
-            f'Supplier {supplier_id} was successfully updated!',
-            'success')
+        delivery.receive_delivery_into_database(lines)
+    except UnknownEntityError as e:
+        current_app.logger.info(f'{e.description} - Delivery')
+        abort(422)
     except BaseException:
-        app.log.info(f'An error occurred. Supplier {supplier_id} \
-            could not be updated!')
+        current_app.logger.info(
+            f'An error occurred. Delivery from Supplier {supplier_id} \
+            could not be received!')
         abort(422)
 
-    return redirect(url_for('suppliers'))
+    return jsonify({
+        'success': True,
+        'delivery_id': delivery_id,
+        'supplier_id': supplier_id,
+        'products': len(lines),
+        'quantity': sum(lines.values())
+    })
 
 
 # ----------------------------------------------------------------
@@ -1168,8 +1659,7 @@ def update_supplier(self, supplier_id):
 # ----------------------------------------------------------------
 
 
-@app.route('/purchases', methods=['GET'])
-@cross_origin(headers=["Content-Type", "Authorization"])
+@grocery_bp.route('/purchases', methods=['GET'])
 @requires_auth('get:purchase')
 def purchases(self):
     # -------------------------
@@ -1179,7 +1669,7 @@ def purchases(self):
         purchases = Purchase().list_all_purchases()
 
         if purchases is None:
-            app.logger.info('Purchases table is empty?')
+            current_app.logger.info('Purchases table is empty?')
             abort(422)
 
         return render_template(
@@ -1188,12 +1678,11 @@ def purchases(self):
             'POSTMAN_TOKEN' not in request.headers and
             'test_permission' not in request.headers else 'Guest')
     except BaseException:
-        app.logger.info('An error occurred. Suppliers not available')
+        current_app.logger.info('An error occurred. Suppliers not available')
         abort(422)
 
 
-@app.route('/purchases/create', methods=['POST'])
-@cross_origin(headers=["Content-Type", "Authorization"])
+@grocery_bp.route('/purchases/create', methods=['POST'])
 @requires_auth('post:purchase')
 def add_order(self):
     # -------------------------
@@ -1203,17 +1692,25 @@ def add_order(self):
     quantity = request.form.get('quantity', 0)
     customer_name = request.form.get('customer', '')
 
-    purchase_date = request.form.get(
-        'purchase_date', datetime.today().strftime('%m/%d/%Y'))
+    purchase_date = parse_form_date(request.form.get(
+        'purchase_date', datetime.today().strftime('%m/%d/%Y')))
 
     total = request.form.get('total', 0)
 
-    product = Product.query.filter(
+    product = db.session.query(Product).filter(
         Product.name == product_name).one_or_none()
-    customer = Customer.query.filter(
+    customer = db.session.query(Customer).filter(
         Customer.name == customer_name).one_or_none()
 
+    if product is None or customer is None:
+        current_app.logger.info(
+            f'Unknown product {product_name} or customer {customer_name}')
+        abort(422)
+
+    # A new order: its id is taken when the purchase is written, so
+    # concurrent purchases committed in one group get ids of their own
     purchase = Purchase(
+        id=None,
         product_id=product.id,
         quantity=quantity,
         customer_id=customer.id,
@@ -1227,70 +1724,242 @@ def add_order(self):
             f'Product ID {product.id} was successfully added \
             to purchases table!')
     except BaseException:
-        app.logger.info(
+        current_app.logger.info(
             f'An error occurred. Product ID {product.id} could not be added!')
         abort(422)
 
-    return redirect(url_for('purchases'))
+    return redirect(url_for('grocery.purchases'))
 
 
-@app.route('/purchases/<int:purchase_id>', methods=['PUT', 'POST'])
-@cross_origin(headers=["Content-Type", "Authorization"])
+@grocery_bp.route(
+    '/purchases/<int:purchase_id>', methods=['PUT', 'PATCH', 'POST'])
 @requires_auth('put:purchase')
-def update_order(purchase_id):
+def update_order(self, purchase_id):
     # -------------------------
-    # Update data of order
+    # Update data of order, or of
+    # one of its products
     # -------------------------
-    if request.form.get('_method') != 'PUT':
-        app.logger.Info(
-            'Cannot perform this action. Please contact administrator')
-        abort(405)
+    fields = _update_fields()
+    product_id = None
+
+    if fields.get('product_id') not in (None, ''):
+        product_id = _form_id(fields.pop('product_id'))
+
+    # Each line has its own version
+    version = _expected_version(fields)
+
+    if version is not None and product_id is None:
+        current_app.logger.info('A version needs the product_id of a line')
+        abort(400)
 
-    purchase = Purchase(id=purchase_id)
+    # Cancelling goes through /purchases/cancel, which restocks
+    values = _column_values(Purchase, fields, ('is_cancelled',))
 
     try:
-        purchase = purchase.list_one_or_none_purchase()
+        rows = Purchase(id=purchase_id).patch_purchase_in_database(
+            values, product_id, version)
+    except VersionConflictError:
+        raise
+    except BaseException:
+        current_app.logger.info(
+            f'An error occurred. Purchase {purchase_id} could not be updated!')
+        abort(422)
 
-        if purchase_id is None:
-            app.logger.info(
-                f'No data with Purchase ID =\
-                    {purchase_id} could be found!')
-            abort(422)
+    if len(rows) == 0:
+        current_app.logger.info(
+            f'No data with Purchase ID = {purchase_id} could be found!')
+        abort(404)
+
+    return _updated(
+        'purchases', [_row_json(row) for row in rows],
+        f'Purchase {purchase_id} was successfully updated!',
+        'grocery.purchases')
+
+
+@grocery_bp.route('/purchases/cancel', methods=['POST'])
+@requires_auth('put:purchase')
+def cancel_purchases(self):
+    # -------------------------
+    # Cancel many purchases at once
+    # and put their stock back
+    # -------------------------
+    body = request.get_json(silent=True) or {}
+    purchase_ids = purchase_date = None
+
+    try:
+        if body.get('purchase_ids') is not None:
+            purchase_ids = [
+                int(purchase_id) for purchase_id in body['purchase_ids']]
+
+        if body.get('purchase_date') is not None:
+            purchase_date = dateutil.parser.parse(
+                body['purchase_date']).date()
+
+        # Cancelling every purchase is never what is meant
+        if purchase_ids is None and purchase_date is None:
+            raise ValueError('No purchases targeted')
+    except (TypeError, ValueError, OverflowError) as e:
+        current_app.logger.info(f'Malformed purchase cancellation: {e}')
+        abort(400)
+
+    try:
+        result = Purchase().cancel_purchases(purchase_ids, purchase_date)
     except BaseException:
-        app.logger.info(
-            f'An error occurred. No data with Purchase ID\
-                 = {purchase_id} could be found!')
+        current_app.logger.info(
+            'An error occurred. Purchases could not be cancelled!')
         abort(422)
 
-    purchase.id = purchase_id
-    product_name = request.form.get('product')
-    purchase.quantity = request.form.get('quantity', purchase.quantity)
-    customer_name = request.form.get('customer_id')
+    result['success'] = True
 
-    purchase.purchase_date = request.form.get(
-        'purchase_date', purchase.purchase_date)
+    return jsonify(result)
 
-    purchase.total = request.form.get('total', purchase.total)
 
-    product = Product.query.filter(
-        Product.name == product_name).one_or_none()
-    customer = Customer.query.filter(
-        Customer.name == customer_name).one_or_none()
+@grocery_bp.route('/purchases/<int:purchase_id>/refund', methods=['POST'])
+@requires_auth('put:purchase')
+def refund_purchase(self, purchase_id):
+    # -------------------------
+    # Refund an order, or some of
+    # its products
+    # -------------------------
+    body = request.get_json(silent=True) or {}
+    product_ids = None
 
-    purchase.product_id = product.product_id
-    purchase.customer_id = customer.customer_id
+    try:
+        if body.get('product_ids') is not None:
+            product_ids = [
+                int(product_id) for product_id in body['product_ids']]
+    except (TypeError, ValueError) as e:
+        current_app.logger.info(f'Malformed refund: {e}')
+        abort(400)
 
     try:
-        purchase.update_purchase_in_database()
-        flash(
-            f'Purchase {purchase_id} was successfully updated!',
-            'success')
+        result = Purchase().cancel_purchases(
+            [purchase_id], product_ids=product_ids)
     except BaseException:
-        app.log.info(f'An error occurred. Purchase {purchase_id} \
-            could not be updated!')
+        current_app.logger.info(
+            f'An error occurred. Purchase {purchase_id} \
+            could not be refunded!')
+        abort(422)
+
+    if result['purchases'] == 0:
+        current_app.logger.info(
+            f'Nothing to refund in Purchase ID = {purchase_id}')
+        abort(422)
+
+    result['success'] = True
+    result['purchase_id'] = purchase_id
+
+    return jsonify(result)
+
+
+# ----------------------------------------------------------------
+# Batch
+# ----------------------------------------------------------------
+
+
+@grocery_bp.route('/batch', methods=['POST'])
+@requires_auth(BATCH_PERMISSIONS)
+def batch(self):
+    # -------------------------
+    # Create, update and delete rows of several entities at once
+    # -------------------------
+    body = request.get_json(silent=True) or {}
+    operations = body.get('operations')
+    atomic = body.get('atomic', True)
+
+    if not isinstance(operations, list) or len(operations) == 0 or \
+            not isinstance(atomic, bool):
+        current_app.logger.info('Malformed batch')
+        abort(400)
+
+    if len(operations) > current_app.config['BATCH_MAX_OPERATIONS']:
+        current_app.logger.info(
+            f'Batch of {len(operations)} operations is too large')
+        abort(400)
+
+    for operation in operations:
+        if required_permission(operation) is None:
+            current_app.logger.info(f'Malformed batch operation {operation}')
+            abort(400)
+
+    try:
+        results = apply_batch(
+            db, operations, set(self['permissions']), atomic)
+    except BaseException:
+        current_app.logger.info('An error occurred. Batch failed!')
         abort(422)
 
-    return redirect(url_for('purchases'))
+    success = all(result['status'] == 'ok' for result in results)
+
+    # A partial batch reports its failures operation by operation
+    return jsonify({
+        'success': success,
+        'atomic': atomic,
+        'results': results
+    }), 200 if success or not atomic else 422
+
+
+# ----------------------------------------------------------------
+# Changes
+# ----------------------------------------------------------------
+
+
+@grocery_bp.route('/changes', methods=['GET'])
+@requires_auth(CHANGE_PERMISSIONS)
+def changes(self):
+    # -------------------------
+    # Stream the changes of the entities the user may read
+    # -------------------------
+    feed = current_app.extensions.get('changefeed')
+
+    if feed is None:
+        abort(404)
+
+    entities = set(CHANGE_ENTITIES.values())
+
+    if request.args.get('entity'):
+        requested = set(request.args['entity'].split(','))
+
+        if not requested <= entities:
+            current_app.logger.info(
+                f'Unknown entities {sorted(requested - entities)}')
+            abort(400)
+
+        entities = requested
+
+    entities = {
+        entity for entity in entities
+        if f'get:{entity}' in self['permissions']}
+
+    if not entities:
+        raise AuthError({
+            'code': 'unauthorized',
+            'description': 'Permission not found'
+        }, 401)
+
+    # A stream holds its thread while it is open: past max_streams the
+    # worker keeps its threads for the other requests
+    subscriber = feed.subscribe()
+
+    if subscriber is None:
+        current_app.logger.info('No thread left for another change stream')
+        abort(503)
+
+    # Not wrapped in stream_with_context: the stream holds no request
+    # context, so its database session is released while it runs
+    response = Response(
+        feed.stream(
+            subscriber,
+            entities,
+            current_app.config['CHANGEFEED_STREAM_SECONDS'],
+            current_app.config['CHANGEFEED_KEEPALIVE_SECONDS']),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    # Also when the client goes away before the stream has started
+    response.call_on_close(lambda: feed.unsubscribe(subscriber))
+
+    return response
 
 
 ###########################################################
@@ -1300,9 +1969,9 @@ def update_order(purchase_id):
 ###########################################################
 
 
-@app.errorhandler(422)
+@grocery_bp.app_errorhandler(422)
 def unprocessable(error):
-    app.logger.info('ErrorHandler 422 called')
+    current_app.logger.info('ErrorHandler 422 called')
     return render_template(
         'errors/422.html',
         data=jsonify({
@@ -1311,9 +1980,9 @@ def unprocessable(error):
         })), 422
 
 
-@app.errorhandler(400)
+@grocery_bp.app_errorhandler(400)
 def bad_request(error):
-    app.logger.info('ErrorHandler 400 called')
+    current_app.logger.info('ErrorHandler 400 called')
     return render_template(
         'errors/400.html',
         data=jsonify({
@@ -1322,9 +1991,9 @@ def bad_request(error):
         })), 400
 
 
-@app.errorhandler(401)
+@grocery_bp.app_errorhandler(401)
 def unauthorized(error):
-    app.logger.info('ErrorHandler 401 called')
+    current_app.logger.info('ErrorHandler 401 called')
     return render_template(
         'errors/401.html',
         data=jsonify({
@@ -1333,9 +2002,9 @@ def unauthorized(error):
         })), 401
 
 
-@app.errorhandler(403)
+@grocery_bp.app_errorhandler(403)
 def forbidden(error):
-    app.logger.info('ErrorHandler 403 called')
+    current_app.logger.info('ErrorHandler 403 called')
     return render_template(
         'errors/403.html',
         data=jsonify({
@@ -1344,9 +2013,9 @@ def forbidden(error):
         })), 403
 
 
-@app.errorhandler(405)
+@grocery_bp.app_errorhandler(405)
 def method_not_allowed(error):
-    app.logger.info('ErrorHandler 405 called')
+    current_app.logger.info('ErrorHandler 405 called')
     return render_template(
         'errors/405.html',
         data=jsonify({
@@ -1355,9 +2024,9 @@ def method_not_allowed(error):
         })), 405
 
 
-@app.errorhandler(500)
+@grocery_bp.app_errorhandler(500)
 def server_error(error):
-    app.logger.info('ErrorHandler 500 called')
+    current_app.logger.info('ErrorHandler 500 called')
     return render_template(
         'errors/500.html',
         data=jsonify({
@@ -1366,9 +2035,9 @@ def server_error(error):
         })), 500
 
 
-@app.errorhandler(404)
+@grocery_bp.app_errorhandler(404)
 def resource_not_found(error):
-    app.logger.info('ErrorHandler 404 called')
+    current_app.logger.info('ErrorHandler 404 called')
     return render_template(
         'errors/404.html',
         data=jsonify({
@@ -1377,9 +2046,29 @@ def resource_not_found(error):
         })), 404
 
 
-@app.errorhandler(AuthError)
+@grocery_bp.app_errorhandler(VersionConflictError)
+def version_conflict(error):
+    current_app.logger.info('ErrorHandler VersionConflictError called')
+
+    # The API gets the current version back to retry against
+    if request.method in ('PUT', 'PATCH'):
+        return jsonify({
+            'success': False,
+            'message': error.description,
+            'status_code': error.code
+        }), 409
+
+    return render_template(
+        'errors/409.html',
+        data=jsonify({
+            'message': error.description,
+            'status_code': error.code
+        })), 409
+
+
+@grocery_bp.app_errorhandler(AuthError)
 def auth_error(error):
-    app.logger.info('ErrorHandler AuthError called')
+    current_app.logger.info('ErrorHandler AuthError called')
     return render_template(
         'errors/errors.html',
         data=jsonify({
@@ -1389,4 +2078,4 @@ def auth_error(error):
 
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8181, debug=True)
+    create_app().run(host='0.0.0.0', port=8181, debug=True)
@@ -0,0 +1,159 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+from flask import (
+    abort,
+    request,
+    send_from_directory,
+    url_for)
+
+
+ASSETS_RULE = '/assets/<path:filename>'
+BUILD_DIR = 'dist'
+MANIFEST = 'manifest.json'
+
+# Images are already compressed; these formats shrink by 60-90%
+COMPRESSIBLE = ('.css', '.js', '.json', '.svg', '.html', '.txt')
+
+# The content of a fingerprinted URL never changes, so browsers and CDNs
+# can keep it for a year without asking again
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+
+###########################################################
+#
+# STATIC ASSETS
+#
+# `python manage.py assets` copies every file of static/
+# to static/dist/ under a name holding a hash of its
+# content (css/style.css -> css/style.1a2b3c4d5e6f.css),
+# writes .gz and .br variants of the text files next to
+# them and lists the names in static/dist/manifest.json.
+# Templates link assets through asset_url(), so a changed
+# file gets a new URL, and the old one can be cached
+# forever. Without a build, asset_url() falls back to the
+# plain /static/ URL.
+#
+###########################################################
+
+
+def _fingerprint(path):
+    digest = hashlib.sha256()
+
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(65536), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()[:12]
+
+
+def _compress(path):
+    # Built once, so the slowest, smallest settings are worth it
+    import brotli
+
+    with open(path, 'rb') as file:
+        data = file.read()
+
+    with open(f'{path}.gz', 'wb') as file:
+        file.write(gzip.compress(data, compresslevel=9, mtime=0))
+
+    with open(f'{path}.br', 'wb') as file:
+        file.write(brotli.compress(data, quality=11))
+
+
+def build_assets(static_dir):
+    build_dir = os.path.join(static_dir, BUILD_DIR)
+    shutil.rmtree(build_dir, ignore_errors=True)
+    manifest = {}
+
+    for root, dirs, files in os.walk(static_dir):
+        if root == static_dir and BUILD_DIR in dirs:
+            dirs.remove(BUILD_DIR)
+
+        for name in sorted(files):
+            source = os.path.join(root, name)
+            logical = os.path.relpath(source, static_dir).replace(os.sep, '/')
+            stem, extension = os.path.splitext(logical)
+            hashed = f'{stem}.{_fingerprint(source)}{extension}'
+
+            target = os.path.join(build_dir, hashed)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copyfile(source, target)
+
+            if extension.lower() in COMPRESSIBLE:
+                _compress(target)
+
+            manifest[logical] = hashed
+
+    with open(os.path.join(build_dir, MANIFEST), 'w') as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+
+    return manifest
+
+
+def _load_manifest(static_dir):
+    try:
+        with open(os.path.join(static_dir, BUILD_DIR, MANIFEST)) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def asset_path(app, filename):
+    '''
+    URL path of a file of static/, e.g. asset_path(app, 'css/style.css'),
+    usable outside of a request
+    '''
+    hashed = app.extensions['assets'].get(filename)
+
+    if hashed is None:
+        return f'{app.static_url_path}/{filename}'
+
+    return ASSETS_RULE.replace('<path:filename>', hashed)
+
+
+def setup_assets(app):
+    manifest = _load_manifest(app.static_folder)
+    served = set(manifest.values())
+    build_dir = os.path.join(app.static_folder, BUILD_DIR)
+    app.extensions['assets'] = manifest
+
+    def asset_url(filename):
+        hashed = manifest.get(filename)
+
+        if hashed is None:
+            return url_for('static', filename=filename)
+
+        return url_for('serve_asset', filename=hashed)
+
+    app.jinja_env.globals['asset_url'] = asset_url
+
+    @app.route(ASSETS_RULE, methods=['GET'])
+    def serve_asset(filename):
+        if filename not in served:
+            abort(404)
+
+        encodings = request.accept_encodings
+        mimetype = mimetypes.guess_type(filename)[0] \
+            or 'application/octet-stream'
+
+        for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+            if encodings[encoding] and \
+                    os.path.exists(os.path.join(build_dir, filename + suffix)):
+                response = send_from_directory(
+                    build_dir, filename + suffix, mimetype=mimetype)
+                response.headers['Content-Encoding'] = encoding
+                break
+        else:
+            response = send_from_directory(
+                build_dir, filename, mimetype=mimetype)
+
+        response.headers['Cache-Control'] = IMMUTABLE
+        response.vary.add('Accept-Encoding')
+
+        return response
+
+    return manifest
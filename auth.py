@@ -26,6 +26,7 @@ conf = Config()
 api_audience = conf.API_AUDIENCE
 auth0_domain = conf.AUTH0_DOMAIN
 algorithms = conf.ALGORITHMS
+jwks_url = conf.JWKS_URL
 client_id = conf.CLIENT_ID
 client_secret = conf.CLIENT_SECRET
 access_token_url = conf.ACCESS_TOKEN_URL
@@ -169,9 +170,8 @@ def _check_permissions(permission, payload):
 
 
 def _verify_decode_jwt(token):
-    # Get the public key from Auth0
-    jsonurl = urlopen(
-        f'https://{auth0_domain}/.well-known/jwks.json')
+    # Get the public key from Auth0 (or JWKS_URL when it is overridden)
+    jsonurl = urlopen(jwks_url)
     jwks = json.loads(jsonurl.read())
 
     # Get the data in the header
@@ -259,7 +259,7 @@ def requires_login(f):
     def decorated(*args, **kwargs):
         if profile_key not in session:
             session.clear()
-            return redirect(url_for('login'))
+            return redirect(url_for('grocery.login'))
         return f(*args, **kwargs)
 
     return decorated
@@ -0,0 +1,299 @@
+import sys
+import dateutil.parser
+from sqlalchemy import Date
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.sql.expression import func
+
+# Local imports...
+from exceptions import BatchOperationError
+from models import (
+    Aisle,
+    Customer,
+    Department,
+    Employee,
+    Product,
+    Supplier,
+    flush_session,
+    t_aislecontains)
+
+
+###########################################################
+#
+# BATCH MUTATIONS
+#
+# A batch is a list of operations, each one creating,
+# updating or deleting one row:
+#
+#   {"op": "update", "entity": "product", "id": 5,
+#    "data": {"price_per_cost_unit": 2.49}}
+#
+# An update or a delete may carry the version of the row
+# it was made against ("version": 3); it fails if the row
+# has been changed since.
+#
+# Every operation needs the permission of the route doing
+# the same thing (post:, put: or delete:<entity>). The
+# token is verified once for the whole batch, and all the
+# operations run in one transaction. An atomic batch is
+# committed only when every operation succeeds; otherwise
+# each operation runs in its own savepoint, so a failed one
+# is rolled back alone and the rest are committed.
+#
+###########################################################
+
+
+# entity -> (model, key column, columns the batch may not write)
+ENTITIES = {
+    'aisle': (Aisle, 'aisle_number', ()),
+    'customer': (Customer, 'id', ()),
+    'department': (Department, 'id', ()),
+    'employee': (Employee, 'id', ()),
+    'product': (Product, 'id', ('markdown_percent',)),
+    'supplier': (Supplier, 'id', ())
+}
+
+# Entities a batch may delete: only aisles, whose products are unlinked
+# first, as on the delete route. The rows of the others are referenced
+# by purchases, deliveries and links that no route removes
+DELETABLE = ('aisle',)
+
+# Column values a created row starts with, as on the create routes
+CREATE_DEFAULTS = {
+    'employee': {'is_active': True}
+}
+
+# op -> permission prefix, as on the single-row routes
+OPERATIONS = {
+    'create': 'post',
+    'update': 'put',
+    'delete': 'delete'
+}
+
+BATCH_PERMISSIONS = [
+    f'{prefix}:{entity}'
+    for entity in ENTITIES for op, prefix in OPERATIONS.items()
+    if op != 'delete' or entity in DELETABLE]
+
+
+def required_permission(operation):
+    '''
+    Permission needed by a batch operation, e.g. 'put:product', or None
+    when the operation or the entity is unknown, or the entity cannot be
+    deleted
+    '''
+    if not isinstance(operation, dict) or \
+            operation.get('op') not in OPERATIONS or \
+            operation.get('entity') not in ENTITIES:
+        return None
+
+    if operation['op'] == 'delete' and \
+            operation['entity'] not in DELETABLE:
+        return None
+
+    return f'{OPERATIONS[operation["op"]]}:{operation["entity"]}'
+
+
+def _coerce(column, value):
+    # JSON has no date type: dates come as strings
+    if value is not None and isinstance(column.type, Date):
+        try:
+            return dateutil.parser.parse(value).date()
+        except (TypeError, ValueError, OverflowError):
+            raise BatchOperationError(
+                f'Invalid date "{value}" for {column.name}', 400)
+
+    return value
+
+
+def _assign(model, row, data, key, read_only):
+    if not isinstance(data, dict):
+        raise BatchOperationError('data must be an object', 400)
+
+    columns = model.__table__.columns
+
+    for name, value in data.items():
+        if name not in columns or name in (key, 'version') or \
+                name in read_only:
+            raise BatchOperationError(f'Unknown field "{name}"', 400)
+
+        setattr(row, name, _coerce(columns[name], value))
+
+
+def _load(session, model, key, operation):
+    if 'id' not in operation:
+        raise BatchOperationError('id is required', 400)
+
+    row = session.query(model).filter(
+        getattr(model, key) == operation['id']).one_or_none()
+
+    if row is None:
+        raise BatchOperationError(
+            f'No {operation["entity"]} with id {operation["id"]}', 422)
+
+    # The version the operation was made against, if it has one
+    if operation.get('version') not in (None, row.version):
+        raise BatchOperationError(
+            f'{operation["entity"].capitalize()} {operation["id"]} is at '
+            f'version {row.version}, not {operation["version"]}', 409)
+
+    return row
+
+
+def _aisle_number(session, operation, data):
+    # The aisle a product is put in, taken out of its data. A product
+    # needs one: the listings only show products linked to an aisle
+    aisle_number = data.pop('aisle_number', None)
+
+    if aisle_number is None:
+        if operation['op'] == 'create':
+            raise BatchOperationError('aisle_number is required', 400)
+
+        return None
+
+    if session.query(Aisle).filter(
+            Aisle.aisle_number == aisle_number).one_or_none() is None:
+        raise BatchOperationError(f'No aisle with id {aisle_number}', 422)
+
+    return aisle_number
+
+
+def _apply(session, operation):
+    model, key, read_only = ENTITIES[operation['entity']]
+    data = operation.get('data', {})
+    aisle_number = None
+
+    if model is Product and operation['op'] != 'delete' and \
+            isinstance(data, dict):
+        data = dict(data)
+        aisle_number = _aisle_number(session, operation, data)
+
+    if operation['op'] == 'create':
+        row = model()
+
+        if key == 'id':
+            # Same numbering as the create routes; the query sees the
+            # rows created earlier in the batch
+            row.id = (session.query(func.max(model.id)).scalar() or 0) + 1
+        elif 'id' in operation:
+            setattr(row, key, operation['id'])
+        else:
+            raise BatchOperationError('id is required', 400)
+
+        for name, value in CREATE_DEFAULTS.get(
+                operation['entity'], {}).items():
+            setattr(row, name, value)
+
+        _assign(model, row, data, key, read_only)
+        session.add(row)
+    elif operation['op'] == 'update':
+        row = _load(session, model, key, operation)
+        _assign(model, row, data, key, read_only)
+
+        # As the update route does, a new price or best before date
+        # starts the markdown over
+        if model is Product and (
+                'price_per_cost_unit' in data or 'best_before_date' in data):
+            row.restart_markdown('price_per_cost_unit' in data)
+    else:
+        row = _load(session, model, key, operation)
+
+        # As the delete route does, the aisle's products are unlinked
+        # first to uphold referential integrity
+        if model is Aisle:
+            session.execute(t_aislecontains.delete().where(
+                t_aislecontains.c.aisle_number == row.aisle_number))
+
+        session.delete(row)
+
+    try:
+        flush_session(session)
+    except StaleDataError:
+        # Written by someone else since _load read it
+        raise BatchOperationError(
+            f'{operation["entity"].capitalize()} {operation["id"]} was '
+            f'changed by someone else', 409)
+
+    # As the product routes do, the aisle is kept in aislecontains
+    if aisle_number is not None:
+        moved = session.execute(t_aislecontains.update().where(
+            t_aislecontains.c.product_id == row.id).values(
+            aisle_number=aisle_number)).rowcount
+
+        if moved == 0:
+            session.execute(t_aislecontains.insert().values(
+                aisle_number=aisle_number, product_id=row.id))
+
+    return getattr(row, key)
+
+
+def apply_batch(db, operations, permissions, atomic=True) -> list:
+    '''
+    Runs the operations allowed by permissions in one transaction and
+    returns one result per operation: {'index', 'status', 'id'} or
+    {'index', 'status', 'error'}. The status is 'ok', 'error', or, in
+    a failed atomic batch, 'rolled back' or 'skipped'
+    '''
+    results = []
+    denied = [
+        required_permission(operation) not in permissions
+        for operation in operations]
+
+    # An atomic batch is refused as a whole before touching the database
+    failed = atomic and any(denied)
+
+    session = db.session
+    session.expire_on_commit = False
+
+    try:
+        for index, operation in enumerate(operations):
+            if denied[index]:
+                failed = True
+                results.append({
+                    'index': index,
+                    'status': 'error',
+                    'error': 'Permission not found'})
+                continue
+
+            if failed and atomic:
+                results.append({'index': index, 'status': 'skipped'})
+                continue
+
+            savepoint = None if atomic else session.begin_nested()
+
+            try:
+                id = _apply(session, operation)
+
+                if savepoint is not None:
+                    savepoint.commit()
+
+                results.append({'index': index, 'status': 'ok', 'id': id})
+                continue
+            except BatchOperationError as e:
+                error = e.description
+            except Exception as e:
+                tb = sys.exc_info()
+                db.app.logger.info(e.with_traceback(tb[2]))
+                error = f'{operation["op"]} failed: {type(e).__name__}'
+
+            if savepoint is not None:
+                savepoint.rollback()
+
+            failed = True
+            results.append(
+                {'index': index, 'status': 'error', 'error': error})
+
+        if failed and atomic:
+            session.rollback()
+
+            for result in results:
+                if result['status'] == 'ok':
+                    result['status'] = 'rolled back'
+        else:
+            session.commit()
+    except BaseException as e:
+        tb = sys.exc_info()
+        db.app.logger.info(e.with_traceback(tb[2]))
+        session.rollback()
+        raise
+
+    return results
@@ -0,0 +1,87 @@
+"""Benchmark a store-wide price change on 50,000 products.
+
+Compares changing prices one product at a time, with a lookup and a
+commit per product as done through update_product, with the set-based
+path of /products/adjust: the dry-run preview (one query) and the
+adjustment itself (one UPDATE). The per-product path is timed on SAMPLE
+products and extrapolated to the whole catalog. Runs against the test
+database (POSTGRES.DB_TEST) and adds synthetic products to it when it
+holds fewer than PRODUCTS products:
+
+    python benchmarks/bench_adjust.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import text  # noqa: E402
+
+from app import create_app  # noqa: E402
+from models import Product, db  # noqa: E402
+
+PRODUCTS = 50000
+SAMPLE = 2000
+PERCENT = 1
+
+
+def _seed_products(session):
+    count = session.query(Product.id).count()
+
+    if count < PRODUCTS:
+        session.execute(text(
+            "INSERT INTO products (id, name, price_per_cost_unit, "
+            "cost_unit, department_id, quantity_in_stock) "
+            "SELECT m + n, 'Bench product ' || n, 1.0, 'ea', 1, 0 "
+            "FROM generate_series(1, :missing) AS n, "
+            "(SELECT MAX(id) AS m FROM products) AS last"),
+            {'missing': PRODUCTS - count})
+        session.commit()
+
+    return session.query(Product.id).count()
+
+
+def _adjust_per_product(session, product_ids):
+    for product_id in product_ids:
+        product = session.query(Product).filter_by(id=product_id).one()
+        product.price_per_cost_unit = round(
+            product.price_per_cost_unit * (100 + PERCENT) / 100, 2)
+        session.commit()
+
+
+def main():
+    app = create_app()
+    app.config['SQLALCHEMY_DATABASE_URI'] = \
+        app.config['SQLALCHEMY_TEST_DATABASE_URI']
+
+    with app.app_context():
+        session = db.session
+        products = _seed_products(session)
+        sample = [row[0] for row in session.query(Product.id).order_by(
+            Product.id).limit(SAMPLE)]
+
+        start = time.perf_counter()
+        _adjust_per_product(session, sample)
+        per_product = (time.perf_counter() - start) / len(sample) * products
+
+        start = time.perf_counter()
+        preview = Product().preview_adjustment(
+            'price', 'percent', PERCENT, {})
+        dry_run = time.perf_counter() - start
+
+        start = time.perf_counter()
+        updated = Product().apply_adjustment('price', 'percent', PERCENT, {})
+        set_based = time.perf_counter() - start
+
+    print(f'{products} products, {preview["matched"]} previewed, '
+          f'{updated} updated')
+    print(f'per-product updates: {per_product:8.3f}s '
+          f'(extrapolated from {len(sample)})')
+    print(f'dry-run preview:     {dry_run:8.3f}s')
+    print(f'single UPDATE:       {set_based:8.3f}s '
+          f'({per_product / set_based:.0f}x faster)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""Benchmark purchase inserts from concurrent checkouts.
+
+Compares purchases per second of THREADS threads each inserting their
+share of PURCHASES purchases, first with one commit per purchase as
+done by add_purchase_to_database(), then with the group commit writer
+(PURCHASE_GROUP_COMMIT) sharing the commits between the threads. Runs
+against the test database (POSTGRES.DB_TEST) and removes the purchases
+it added:
+
+    python benchmarks/bench_group_commit.py
+"""
+import os
+import sys
+import threading
+import time
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy.sql.expression import func  # noqa: E402
+
+from app import create_app  # noqa: E402
+from group_commit import setup_group_commit  # noqa: E402
+from models import CustomerStats, Purchase, db  # noqa: E402
+
+PURCHASES = 2000
+THREADS = 8
+PRODUCT_ID = 1
+CUSTOMERS = 30
+
+
+def _purchases(first_id):
+    return [
+        Purchase(
+            id=first_id + n, product_id=PRODUCT_ID, quantity=1,
+            customer_id=1 + n % CUSTOMERS, purchase_date=date.today(),
+            total=1.0)
+        for n in range(PURCHASES)]
+
+
+def _checkout(app, purchases):
+    def insert(share):
+        with app.app_context():
+            for purchase in share:
+                purchase.add_purchase_to_database()
+            db.session.remove()
+
+    threads = [
+        threading.Thread(target=insert, args=(purchases[n::THREADS],))
+        for n in range(THREADS)]
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return time.perf_counter() - start
+
+
+def main():
+    app = create_app()
+    app.config['SQLALCHEMY_DATABASE_URI'] = \
+        app.config['SQLALCHEMY_TEST_DATABASE_URI']
+
+    with app.app_context():
+        first_id = (db.session.query(func.max(Purchase.id)).scalar() or 0) + 1
+        db.session.remove()
+
+    per_purchase = _checkout(app, _purchases(first_id))
+
+    app.config['PURCHASE_GROUP_COMMIT'] = True
+    writer = setup_group_commit(app)
+    grouped = _checkout(app, _purchases(first_id + PURCHASES))
+    writer.close()
+    del app.extensions['purchase_writer']
+
+    with app.app_context():
+        db.session.query(Purchase).filter(
+            Purchase.id >= first_id).delete(synchronize_session=False)
+        db.session.commit()
+        CustomerStats().rebuild_customer_stats()
+
+    print(f'{PURCHASES} purchases from {THREADS} threads')
+    print(f'commit per purchase: {PURCHASES / per_purchase:8.0f}/s')
+    print(f'group commit:        {PURCHASES / grouped:8.0f}/s '
+          f'({per_purchase / grouped:.1f}x faster)')
+
+
+if __name__ == '__main__':
+    main()
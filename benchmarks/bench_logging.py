@@ -0,0 +1,93 @@
+"""Benchmark request latency under an error storm.
+
+Every request to a small Flask app logs LINES error lines, the way a
+failing models.py helper and the 422 error handler do. Requests are sent
+from THREADS threads, first with a plain FileHandler and then with the
+queued handler from logging_config. Needs no database:
+
+    python benchmarks/bench_logging.py
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+from logging import FileHandler, Formatter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask  # noqa: E402
+from flask.logging import default_handler  # noqa: E402
+
+from config import Config  # noqa: E402
+from logging_config import (  # noqa: E402
+    TEXT_FORMAT,
+    setup_logging,
+    stop_logging)
+
+REQUESTS = 2000
+THREADS = 8
+LINES = 5
+
+
+def _make_app(name):
+    app = Flask(name)
+    app.config.from_object(Config)
+    app.logger.removeHandler(default_handler)
+
+    @app.route('/storm')
+    def storm():
+        for line in range(LINES):
+            app.logger.info('An error occurred. Products not available')
+            app.logger.info('ErrorHandler 422 called')
+        return 'storm', 422
+
+    return app
+
+
+def _run(app):
+    client = app.test_client()
+    latencies = []
+    lock = threading.Lock()
+
+    def worker():
+        timings = []
+        for _ in range(REQUESTS // THREADS):
+            start = time.perf_counter()
+            client.get('/storm')
+            timings.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(timings)
+
+    threads = [threading.Thread(target=worker) for _ in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    latencies.sort()
+    return (
+        latencies[len(latencies) // 2] * 1000,
+        latencies[int(len(latencies) * 0.99)] * 1000)
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        plain = _make_app('plain')
+        handler = FileHandler(os.path.join(directory, 'plain.log'))
+        handler.setFormatter(Formatter(TEXT_FORMAT))
+        plain.logger.setLevel('INFO')
+        plain.logger.addHandler(handler)
+        p50, p99 = _run(plain)
+        print(f'FileHandler:  p50 {p50:6.3f}ms  p99 {p99:6.3f}ms')
+
+        queued = _make_app('queued')
+        queued.config['LOG_FILE'] = os.path.join(directory, 'queued.log')
+        setup_logging(queued)
+        p50, p99 = _run(queued)
+        stop_logging()
+        print(f'QueueHandler: p50 {p50:6.3f}ms  p99 {p99:6.3f}ms')
+
+
+if __name__ == '__main__':
+    main()
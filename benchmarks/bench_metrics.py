@@ -0,0 +1,64 @@
+"""Benchmark the per-request overhead of the request metrics.
+
+Times REQUESTS calls to a trivial route of a small Flask app, with and
+without setup_metrics(), so the difference is the cost of the
+before/after request hooks. Needs no database:
+
+    python benchmarks/bench_metrics.py
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask  # noqa: E402
+
+from config import Config  # noqa: E402
+from metrics import setup_metrics  # noqa: E402
+
+REQUESTS = 20000
+
+
+def _make_app(name, directory=None):
+    app = Flask(name)
+    app.config.from_object(Config)
+
+    @app.route('/ping')
+    def ping():
+        return 'pong'
+
+    if directory is not None:
+        app.config['METRICS_DIR'] = directory
+        setup_metrics(app)
+
+    return app
+
+
+def _run(app):
+    client = app.test_client()
+
+    # Warm up
+    for _ in range(100):
+        client.get('/ping')
+
+    start = time.perf_counter()
+    for _ in range(REQUESTS):
+        client.get('/ping')
+
+    return (time.perf_counter() - start) / REQUESTS * 1e6
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        plain = _run(_make_app('plain'))
+        measured = _run(_make_app('measured', directory))
+
+    print(f'without metrics: {plain:7.1f}us per request')
+    print(f'with metrics:    {measured:7.1f}us per request '
+          f'(+{measured - plain:.1f}us)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""Benchmark receiving a 5,000-line delivery manifest.
+
+Compares the old way of receiving stock, one product update and commit
+per line as done through update_product, with the set-based
+receive_delivery_into_database() path. Runs against the test database
+(POSTGRES.DB_TEST) and adds synthetic products to it when it holds fewer
+than LINES products:
+
+    python benchmarks/bench_receiving.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import text  # noqa: E402
+
+from app import create_app  # noqa: E402
+from models import Product, Providesdelivery, db  # noqa: E402
+
+LINES = 5000
+SUPPLIER_ID = 1
+
+
+def _seed_products(session):
+    count = session.query(Product.id).count()
+
+    if count < LINES:
+        session.execute(text(
+            "INSERT INTO products (id, name, price_per_cost_unit, "
+            "cost_unit, department_id, quantity_in_stock) "
+            "SELECT m + n, 'Bench product ' || n, 1.0, 'ea', 1, 0 "
+            "FROM generate_series(1, :missing) AS n, "
+            "(SELECT MAX(id) AS m FROM products) AS last"),
+            {'missing': LINES - count})
+        session.commit()
+
+    return [row[0] for row in session.query(Product.id).order_by(
+        Product.id).limit(LINES)]
+
+
+def _receive_per_line(session, product_ids):
+    for product_id in product_ids:
+        product = session.query(Product).filter_by(id=product_id).one()
+        product.quantity_in_stock = (product.quantity_in_stock or 0) + 1
+        session.commit()
+
+
+def _receive_manifest(product_ids):
+    delivery = Providesdelivery(
+        delivery_id=Providesdelivery().get_next_delivery_id(),
+        supplier_id=SUPPLIER_ID)
+    delivery.receive_delivery_into_database(
+        {product_id: 1 for product_id in product_ids})
+
+
+def main():
+    app = create_app()
+    app.config['SQLALCHEMY_DATABASE_URI'] = \
+        app.config['SQLALCHEMY_TEST_DATABASE_URI']
+
+    with app.app_context():
+        session = db.session
+        product_ids = _seed_products(session)
+
+        start = time.perf_counter()
+        _receive_per_line(session, product_ids)
+        per_line = time.perf_counter() - start
+
+        start = time.perf_counter()
+        _receive_manifest(product_ids)
+        manifest = time.perf_counter() - start
+
+    print(f'{len(product_ids)} manifest lines')
+    print(f'per-line updates: {per_line:8.3f}s')
+    print(f'manifest receive: {manifest:8.3f}s '
+          f'({per_line / manifest:.0f}x faster)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""Benchmark the per-request cost of the session, by session store.
+
+Logs a client in with a session the size of the one /callback stores
+(the Auth0 profile, an id token and an access token), then times
+REQUESTS calls to a route reading the nickname from it, with Flask's
+cookie session and with each server-side store. Prints the time per
+request and the size of the cookie the browser uploads every time.
+The redis store is only timed when the redis package is installed and
+SESSION_REDIS_URL answers. Needs no database:
+
+    python benchmarks/bench_sessions.py
+"""
+import os
+import secrets
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import (  # noqa: E402
+    Flask,
+    session)
+
+from config import Config  # noqa: E402
+from sessions import setup_sessions  # noqa: E402
+
+REQUESTS = 5000
+
+# About the size of what /callback keeps in the session
+USERINFO = {
+    'sub': 'auth0|5fd1e9d8a1b2c3d4e5f60718',
+    'name': 'apptest2099@gmail.com',
+    'nickname': 'apptest2099',
+    'picture': 'https://s.gravatar.com/avatar/' + 'a' * 32 + '?s=480&r=pg',
+    'updated_at': '2021-01-10T18:30:00.000Z',
+    'email': 'apptest2099@gmail.com',
+    'email_verified': True
+}
+# Random, like signed tokens, so the cookie session can not compress them
+ID_TOKEN = secrets.token_urlsafe(825)
+ACCESS_TOKEN = secrets.token_urlsafe(1050)
+
+
+def _make_app(store, directory):
+    app = Flask(store)
+    app.config.from_object(Config)
+    app.secret_key = 'bench'
+    app.config['SESSION_STORE'] = store
+    app.config['SESSION_FILE'] = os.path.join(directory, 'sessions.db')
+    setup_sessions(app)
+
+    @app.route('/whoami')
+    def whoami():
+        return session['profile']['nickname']
+
+    return app
+
+
+def _run(app):
+    client = app.test_client()
+
+    with client.session_transaction() as stored:
+        stored['jwt_payload'] = USERINFO
+        stored['profile'] = {'nickname': USERINFO['nickname']}
+        stored['id_key'] = {'id': ID_TOKEN}
+        stored['access_key'] = {'access': ACCESS_TOKEN}
+
+    cookie = next(
+        c for c in client.cookie_jar if c.name == app.session_cookie_name)
+
+    # Warm up
+    for _ in range(100):
+        client.get('/whoami')
+
+    start = time.perf_counter()
+    for _ in range(REQUESTS):
+        client.get('/whoami')
+
+    return (time.perf_counter() - start) / REQUESTS * 1e6, len(cookie.value)
+
+
+def _redis_available():
+    try:
+        import redis
+        redis.Redis.from_url(Config.SESSION_REDIS_URL).ping()
+    except Exception:
+        return False
+
+    return True
+
+
+def main():
+    stores = ['cookie', 'memory', 'sqlite']
+    if _redis_available():
+        stores.append('redis')
+
+    with tempfile.TemporaryDirectory() as directory:
+        for store in stores:
+            per_request, size = _run(_make_app(store, directory))
+            print(f'{store:7} {per_request:7.1f}us per request, '
+                  f'{size:5} byte cookie')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""Benchmark the cold start of a worker.
+
+Starts RUNS fresh interpreters and times, in each, importing app.py,
+building the app with create_app() and answering the first request of
+a few template pages, the time-to-first-response of a restarted dyno or
+a recycled gunicorn worker. The first response is timed with an empty
+Jinja bytecode cache and with one filled by an earlier worker. Also
+prints what the imports deferred to first use would add. Needs no
+database:
+
+    python benchmarks/bench_startup.py
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+RUNS = 5
+PAGES = ('/', '/constructions')
+
+PROBE = '''
+import json
+import sys
+import time
+
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+application = app.create_app()
+created = time.perf_counter()
+client = application.test_client()
+for path in sys.argv[1:]:
+    client.get(path)
+answered = time.perf_counter()
+
+import authlib.integrations.flask_client
+import babel.dates
+import flask_migrate
+deferred = time.perf_counter()
+
+print(json.dumps({
+    'import': imported - start,
+    'create_app': created - imported,
+    'first_response': answered - created,
+    'deferred': deferred - answered}))
+'''
+
+
+def _probe(directory, cache_dir):
+    env = dict(
+        os.environ,
+        JINJA_CACHE_DIR=cache_dir,
+        LOG_FILE=os.path.join(directory, 'startup.log'),
+        METRICS_DIR=os.path.join(directory, 'metrics'))
+    output = subprocess.run(
+        [sys.executable, '-c', PROBE] + list(PAGES),
+        cwd=ROOT, env=env, check=True, capture_output=True, text=True)
+
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def _median(runs, key):
+    return statistics.median(run[key] for run in runs) * 1000
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        cold = [
+            _probe(directory, tempfile.mkdtemp(dir=directory))
+            for _ in range(RUNS)]
+
+        warm_dir = tempfile.mkdtemp(dir=directory)
+        _probe(directory, warm_dir)
+        warm = [_probe(directory, warm_dir) for _ in range(RUNS)]
+
+    runs = cold + warm
+
+    print(f'median of {RUNS} fresh interpreters')
+    print(f'import app:                    {_median(runs, "import"):7.1f}ms')
+    print(f'create_app():                  '
+          f'{_median(runs, "create_app"):7.1f}ms')
+    print(f'first response, cold template cache: '
+          f'{_median(cold, "first_response"):7.1f}ms')
+    print(f'first response, warm template cache: '
+          f'{_median(warm, "first_response"):7.1f}ms')
+    print(f'deferred imports (first login): '
+          f'{_median(runs, "deferred"):7.1f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+"""Measure the memory of every gunicorn worker, with and without preload.
+
+Starts the app under gunicorn.conf.py with WORKERS workers, once with
+GUNICORN_PRELOAD=false (every worker imports the app itself) and once
+with the app preloaded in the master, sends the same requests to both,
+and reads the memory of every worker from /proc/<pid>/smaps_rollup:
+
+- RSS counts every page the worker maps, shared or not,
+- PSS splits the shared pages between the processes sharing them,
+- USS only counts the pages private to the worker, what it really adds.
+
+Linux only. Needs no database:
+
+    python benchmarks/bench_workers.py
+"""
+import http.client
+import os
+import shutil
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WORKERS = 4
+REQUESTS = 200
+PAGES = ('/', '/constructions', '/swaggerLink')
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _gunicorn():
+    # Prefer the gunicorn of the interpreter running this script
+    local = os.path.join(os.path.dirname(sys.executable), 'gunicorn')
+    return local if os.path.exists(local) else shutil.which('gunicorn')
+
+
+def _request(port, path):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+    try:
+        connection.request('GET', path)
+        connection.getresponse().read()
+    finally:
+        connection.close()
+
+
+def _children(pid):
+    children = []
+
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as file:
+                # The command may hold spaces, the fields after it do not
+                fields = file.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == pid:
+            children.append(int(entry))
+
+    return children
+
+
+def _memory(pid):
+    values = {}
+
+    with open(f'/proc/{pid}/smaps_rollup') as file:
+        for line in file:
+            name, _, rest = line.partition(':')
+            if rest.strip().endswith('kB'):
+                values[name] = int(rest.split()[0]) / 1024
+
+    return {
+        'rss': values['Rss'],
+        'pss': values['Pss'],
+        'uss': values['Private_Clean'] + values['Private_Dirty']}
+
+
+def _measure(preload):
+    port = _free_port()
+    env = dict(
+        os.environ,
+        GUNICORN_PRELOAD=str(preload),
+        WEB_CONCURRENCY=str(WORKERS),
+        GUNICORN_MAX_RSS_GROWTH_MB='0')
+    process = subprocess.Popen([
+        _gunicorn() or 'gunicorn',
+        '--bind', f'127.0.0.1:{port}',
+        '--log-level', 'warning',
+        'app:create_app()'],
+        cwd=ROOT, env=env, stderr=subprocess.DEVNULL)
+
+    try:
+        deadline = time.monotonic() + 30
+        while len(_children(process.pid)) < WORKERS:
+            if time.monotonic() > deadline or process.poll() is not None:
+                raise RuntimeError('gunicorn did not start its workers')
+            time.sleep(0.2)
+
+        while True:
+            try:
+                _request(port, PAGES[0])
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.2)
+
+        for number in range(REQUESTS):
+            _request(port, PAGES[number % len(PAGES)])
+
+        return [_memory(pid) for pid in _children(process.pid)]
+    finally:
+        process.send_signal(signal.SIGTERM)
+        process.wait()
+
+
+def main():
+    if not os.path.exists('/proc/self/smaps_rollup'):
+        sys.exit('This benchmark reads /proc/<pid>/smaps_rollup (Linux)')
+
+    print(f'{WORKERS} workers, {REQUESTS} requests, '
+          f'median per worker in MB')
+    print(f'{"":12} {"RSS":>8} {"PSS":>8} {"USS":>8}')
+
+    for preload in (False, True):
+        workers = _measure(preload)
+        label = 'preload' if preload else 'no preload'
+        print(f'{label:12} ' + ' '.join(
+            f'{statistics.median(w[key] for w in workers):8.1f}'
+            for key in ('rss', 'pss', 'uss')))
+
+
+if __name__ == '__main__':
+    main()
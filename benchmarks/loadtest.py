@@ -0,0 +1,484 @@
+"""Replay the Postman collection as concurrent traffic and measure it.
+
+Every request of udacity-fsnd-udacimarket.postman_collection.json becomes
+a weighted scenario (GET requests are picked more often than writes).
+CONCURRENCY threads replay them for DURATION seconds against a local app
+and the throughput, latency percentiles and error rate of every route
+are printed and stored in benchmarks/results/ so runs can be compared:
+
+    python benchmarks/loadtest.py --duration 30 --concurrency 8
+    python benchmarks/loadtest.py --compare latest
+
+Instead of Auth0 the script serves its own JWKS on --jwks-port and signs
+a fresh token for every role of the collection (keeping the role's
+permissions), then starts gunicorn with JWKS_URL pointing at it. To load
+an instance started by hand, run it with
+JWKS_URL=http://127.0.0.1:8765/.well-known/jwks.json and pass --url.
+
+Write requests (create, update, delete) change the database, so they are
+only replayed with --writes; point the app at a scratch database first.
+"""
+import argparse
+import base64
+import glob
+import http.client
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime
+from http.server import (
+    BaseHTTPRequestHandler,
+    ThreadingHTTPServer)
+from urllib.parse import (
+    urlencode,
+    urlsplit)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from cryptography.hazmat.backends import default_backend  # noqa: E402
+from cryptography.hazmat.primitives import serialization  # noqa: E402
+from cryptography.hazmat.primitives.asymmetric import rsa  # noqa: E402
+from jose import jwt  # noqa: E402
+
+from config import Config  # noqa: E402
+
+COLLECTION = os.path.join(
+    ROOT, 'udacity-fsnd-udacimarket.postman_collection.json')
+RESULTS_DIR = os.path.join(ROOT, 'benchmarks', 'results')
+KEY_ID = 'loadtest'
+METHOD_WEIGHTS = {'GET': 10, 'POST': 2, 'PUT': 2, 'DELETE': 1}
+
+STATUS_CHECK = re.compile(r'to\.have\.status\((\d+)\)')
+TEXT_CHECK = re.compile(r'to\.include\((?:\'([^\']*)\'|"([^"]*)")\)')
+
+
+###########################################################
+#
+# SCENARIOS
+#
+###########################################################
+
+
+def _parse_checks(events):
+    # The collection's test scripts only assert a status and some text
+    status = None
+    texts = []
+
+    for event in events or []:
+        if event.get('listen') != 'test':
+            continue
+
+        script = '\n'.join(event['script'].get('exec', []))
+        match = STATUS_CHECK.search(script)
+        if match:
+            status = int(match.group(1))
+        texts += [a or b for a, b in TEXT_CHECK.findall(script)]
+
+    return status, texts
+
+
+def load_scenarios(path, writes=False, weights=METHOD_WEIGHTS):
+    with open(path) as file:
+        collection = json.load(file)
+
+    scenarios = []
+
+    for folder in collection['item']:
+        token = None
+        for entry in (folder.get('auth') or {}).get('bearer', []):
+            if entry['key'] == 'token':
+                token = entry['value']
+
+        for item in folder['item']:
+            request = item['request']
+            method = request['method']
+
+            if method != 'GET' and not writes:
+                continue
+
+            body = request.get('body') or {}
+            form = {
+                field['key']: field.get('value', '')
+                for field in body.get('formdata', [])
+                if not field.get('disabled')}
+            status, texts = _parse_checks(item.get('event'))
+
+            scenarios.append({
+                'name': f'{folder["name"]} {method} {item["name"]}',
+                'role': folder['name'],
+                'method': method,
+                'path': '/' + '/'.join(request['url']['path']),
+                'form': form,
+                'token': token,
+                'status': status,
+                'texts': texts,
+                'weight': weights.get(method, 1)
+            })
+
+    return scenarios
+
+
+###########################################################
+#
+# LOCAL AUTH0 STAND-IN
+#
+###########################################################
+
+
+def _b64(number):
+    raw = number.to_bytes((number.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+
+class TokenStandIn(object):
+    '''
+    Signs tokens with a throwaway RSA key and serves the matching JWKS,
+    so the app verifies them exactly as it verifies Auth0 tokens.
+    '''
+
+    def __init__(self, issuer, audience):
+        self.issuer = issuer
+        self.audience = audience
+
+        key = rsa.generate_private_key(65537, 2048, default_backend())
+        self.pem = key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.TraditionalOpenSSL,
+            serialization.NoEncryption())
+        numbers = key.public_key().public_numbers()
+        self.jwks = {'keys': [{
+            'kty': 'RSA',
+            'kid': KEY_ID,
+            'use': 'sig',
+            'alg': 'RS256',
+            'n': _b64(numbers.n),
+            'e': _b64(numbers.e)
+        }]}
+
+    def sign(self, original):
+        # Keep the subject and permissions of the recorded token
+        claims = jwt.get_unverified_claims(original)
+        now = int(time.time())
+        claims.update({
+            'iss': self.issuer,
+            'aud': self.audience,
+            'iat': now,
+            'exp': now + 24 * 3600
+        })
+
+        return jwt.encode(
+            claims, self.pem, algorithm='RS256', headers={'kid': KEY_ID})
+
+    def serve(self, port):
+        body = json.dumps(self.jwks).encode('utf8')
+
+        class JwksHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', port), JwksHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        return f'http://127.0.0.1:{port}/.well-known/jwks.json'
+
+
+###########################################################
+#
+# LOAD
+#
+###########################################################
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _gunicorn():
+    # Prefer the gunicorn of the interpreter running this script
+    local = os.path.join(os.path.dirname(sys.executable), 'gunicorn')
+    return local if os.path.exists(local) else shutil.which('gunicorn')
+
+
+def start_app(jwks_url, workers, threads):
+    port = _free_port()
+    env = dict(os.environ, JWKS_URL=jwks_url)
+    process = subprocess.Popen([
+        _gunicorn() or 'gunicorn',
+        '--bind', f'127.0.0.1:{port}',
+        '--workers', str(workers),
+        '--threads', str(threads),
+        '--log-level', 'warning',
+        'app:create_app()'], cwd=ROOT, env=env)
+
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('The app exited during startup')
+        # Any HTTP answer means a worker has booted and imported the app
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=2)
+        try:
+            connection.request('GET', '/swaggerLink')
+            connection.getresponse().read()
+            return process, f'http://127.0.0.1:{port}'
+        except (OSError, http.client.HTTPException):
+            time.sleep(0.2)
+        finally:
+            connection.close()
+
+    process.terminate()
+    raise RuntimeError('The app did not start within 30 seconds')
+
+
+def _send(connection, scenario, token):
+    headers = {'Postman-Token': str(uuid.uuid4())}
+    body = None
+
+    if token is not None:
+        headers['Authorization'] = f'Bearer {token}'
+    if scenario['form']:
+        body = urlencode(scenario['form'])
+        headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+    connection.request(
+        scenario['method'], scenario['path'], body=body, headers=headers)
+    response = connection.getresponse()
+
+    return response.status, response.read().decode('utf8', 'replace')
+
+
+def _passed(scenario, status, text):
+    if scenario['status'] is not None:
+        if status != scenario['status']:
+            return False
+    elif status >= 400:
+        return False
+
+    return all(expected in text for expected in scenario['texts'])
+
+
+def _worker(url, scenarios, tokens, warmup_until, stop_at, samples, seed):
+    rand = random.Random(seed)
+    weights = [scenario['weight'] for scenario in scenarios]
+    address = urlsplit(url)
+    connection = http.client.HTTPConnection(address.netloc, timeout=30)
+
+    while True:
+        start = time.perf_counter()
+        if time.monotonic() >= stop_at:
+            break
+
+        scenario = rand.choices(scenarios, weights)[0]
+        try:
+            status, text = _send(
+                connection, scenario, tokens.get(scenario['role']))
+            ok = _passed(scenario, status, text)
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            connection = http.client.HTTPConnection(
+                address.netloc, timeout=30)
+            ok = False
+        seconds = time.perf_counter() - start
+
+        if time.monotonic() >= warmup_until:
+            samples.append((scenario['name'], seconds, ok))
+
+    connection.close()
+
+
+def run(url, scenarios, tokens, concurrency, duration, warmup):
+    now = time.monotonic()
+    warmup_until = now + warmup
+    stop_at = warmup_until + duration
+    per_thread = [[] for _ in range(concurrency)]
+
+    threads = [
+        threading.Thread(target=_worker, args=(
+            url, scenarios, tokens, warmup_until, stop_at,
+            per_thread[number], number))
+        for number in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return [sample for samples in per_thread for sample in samples]
+
+
+###########################################################
+#
+# REPORT
+#
+###########################################################
+
+
+def _percentile(ordered, percent):
+    # Nearest-rank percentile of an already sorted list
+    if not ordered:
+        return 0.0
+    rank = max(int(round(percent / 100.0 * len(ordered))) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def _summarize(seconds, errors, duration):
+    ordered = sorted(seconds)
+    return {
+        'requests': len(ordered),
+        'throughput': round(len(ordered) / duration, 2),
+        'error_rate': round(errors / len(ordered), 4) if ordered else 0.0,
+        'p50_ms': round(_percentile(ordered, 50) * 1000, 2),
+        'p90_ms': round(_percentile(ordered, 90) * 1000, 2),
+        'p99_ms': round(_percentile(ordered, 99) * 1000, 2),
+        'max_ms': round(ordered[-1] * 1000, 2) if ordered else 0.0
+    }
+
+
+def summarize(samples, duration):
+    routes = {}
+    for name, seconds, ok in samples:
+        route = routes.setdefault(name, ([], [0]))
+        route[0].append(seconds)
+        route[1][0] += 0 if ok else 1
+
+    return {
+        'total': _summarize(
+            [seconds for _, seconds, _ in samples],
+            sum(1 for _, _, ok in samples if not ok),
+            duration),
+        'routes': {
+            name: _summarize(seconds, errors[0], duration)
+            for name, (seconds, errors) in sorted(routes.items())}
+    }
+
+
+def print_report(summary, previous=None):
+    columns = ('requests', 'throughput', 'p50_ms', 'p90_ms', 'p99_ms',
+               'max_ms', 'error_rate')
+    print(f'{"route":<40}' + ''.join(f'{c:>12}' for c in columns))
+
+    rows = list(summary['routes'].items()) + [('TOTAL', summary['total'])]
+    for name, stats in rows:
+        print(f'{name[:40]:<40}' + ''.join(
+            f'{stats[c]:>12}' for c in columns))
+
+        if previous is None:
+            continue
+        before = previous['total'] if name == 'TOTAL' \
+            else previous['routes'].get(name)
+        if before is None:
+            continue
+        print(f'{"  vs previous":<40}' + ''.join(
+            f'{_delta(before[c], stats[c]):>12}' for c in columns))
+
+
+def _delta(before, after):
+    if not before:
+        return '-'
+    return f'{(after - before) / before * 100:+.1f}%'
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(summary, options):
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    started = datetime.now().strftime('%Y%m%d-%H%M%S')
+    path = os.path.join(RESULTS_DIR, f'loadtest-{started}.json')
+
+    with open(path, 'w') as file:
+        json.dump(dict(
+            summary, started=started, commit=_git_commit(),
+            options=options), file, indent=2)
+
+    return path
+
+
+def load_results(path):
+    if path == 'latest':
+        runs = sorted(glob.glob(os.path.join(RESULTS_DIR, 'loadtest-*.json')))
+        if not runs:
+            return None
+        path = runs[-1]
+
+    with open(path) as file:
+        return json.load(file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--warmup', type=float, default=3)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=2,
+                        help='gunicorn workers of the started app')
+    parser.add_argument('--threads', type=int, default=4,
+                        help='gunicorn threads per worker')
+    parser.add_argument('--url', default=None,
+                        help='load a running app instead of starting one')
+    parser.add_argument('--jwks-port', type=int, default=8765)
+    parser.add_argument('--writes', action='store_true',
+                        help='also replay create, update and delete')
+    parser.add_argument('--collection', default=COLLECTION)
+    parser.add_argument('--compare', default=None,
+                        help='results file to compare with, or "latest"')
+    parser.add_argument('--no-save', action='store_true')
+    options = parser.parse_args()
+
+    previous = load_results(options.compare) if options.compare else None
+    scenarios = load_scenarios(options.collection, options.writes)
+
+    stand_in = TokenStandIn(f'https://{Config.AUTH0_DOMAIN}/',
+                            Config.API_AUDIENCE)
+    jwks_url = stand_in.serve(options.jwks_port)
+    tokens = {
+        scenario['role']: stand_in.sign(scenario['token'])
+        for scenario in scenarios if scenario['token']}
+
+    process = None
+    url = options.url
+    if url is None:
+        process, url = start_app(jwks_url, options.workers, options.threads)
+
+    try:
+        print(f'{len(scenarios)} scenarios, {options.concurrency} clients, '
+              f'{options.duration}s against {url}')
+        samples = run(url, scenarios, tokens, options.concurrency,
+                      options.duration, options.warmup)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    summary = summarize(samples, options.duration)
+    print_report(summary, previous)
+
+    if not options.no_save:
+        print(f'Results saved to {save_results(summary, vars(options))}')
+
+
+if __name__ == '__main__':
+    main()
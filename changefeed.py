@@ -0,0 +1,306 @@
+import json
+import os
+import queue
+import select
+import threading
+import time
+from datetime import date
+from decimal import Decimal
+from sqlalchemy import (
+    event,
+    text)
+from sqlalchemy.orm import Session
+
+# Local imports...
+from models import db
+
+
+# table -> entity of the change events, as in the permissions
+CHANGE_ENTITIES = {
+    'aisles': 'aisle',
+    'customers': 'customer',
+    'departments': 'department',
+    'employees': 'employee',
+    'products': 'product',
+    'purchases': 'purchase',
+    'suppliers': 'supplier'
+}
+
+# Reading any one entity is enough to follow its changes
+CHANGE_PERMISSIONS = [f'get:{entity}' for entity in CHANGE_ENTITIES.values()]
+
+CHANNEL = 'changes'
+
+# NOTIFY payloads are limited to 8000 bytes
+MAX_PAYLOAD = 7900
+
+# More changes than this in one transaction, e.g. a bulk adjustment,
+# are sent as one reload event per entity
+MAX_CHANGES = 500
+
+# Milliseconds the browser waits before reconnecting to a stream
+RETRY_MS = 3000
+
+PENDING_KEY = 'changefeed'
+
+# Savepoint -> number of events pending when it began
+SAVEPOINTS_KEY = 'changefeed_savepoints'
+
+
+###########################################################
+#
+# CHANGE FEED
+#
+# The write helpers of models.py describe every row they
+# insert, update or delete with a compact event:
+#
+#   {"entity": "product", "op": "update", "id": 5,
+#    "changes": {"quantity_in_stock": 12}, "version": 4}
+#
+# and publish them through the feed before committing. On
+# PostgreSQL the events are sent with NOTIFY, which the
+# database only delivers once the transaction commits, to
+# a LISTEN connection in every worker; elsewhere they are
+# kept on the session until it commits. Either way each
+# worker hands them to its subscribers, the /changes
+# streams, and drops those of a rolled back transaction.
+# A savepoint rolled back only drops the events published
+# since it began, so the operations of a non-atomic batch
+# that succeeded keep theirs.
+#
+###########################################################
+
+
+def _json_value(value):
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+
+    return str(value)
+
+
+def _payload(change):
+    payload = json.dumps(change, default=_json_value)
+
+    # Too long to be sent: the subscribers reload the row instead
+    if len(payload) > MAX_PAYLOAD:
+        payload = json.dumps(dict(change, changes=None), default=_json_value)
+
+    return payload
+
+
+class _Subscriber(object):
+    def __init__(self, size):
+        self.queue = queue.Queue(size)
+        # Set when events had to be dropped: the stream asks the page
+        # to reload rather than show a partial picture
+        self.lost = False
+
+
+class ChangeFeed(object):
+    def __init__(self, app, queue_size=1000, max_streams=2):
+        self.app = app
+        self.queue_size = queue_size
+        # Every stream holds a worker thread while it is open
+        self.max_streams = max_streams
+        self.lock = threading.Lock()
+        self.subscribers = set()
+        self.listener = None
+        self.pid = None
+
+    def publish(self, session, changes):
+        # Called with the changes of a transaction before it commits
+        changes = [
+            dict(change, entity=CHANGE_ENTITIES[change['entity']])
+            for change in changes if change['entity'] in CHANGE_ENTITIES]
+
+        if not changes:
+            return
+
+        if len(changes) > MAX_CHANGES:
+            changes = [{
+                'entity': entity,
+                'op': 'reload',
+                'id': None,
+                'changes': None,
+                'version': None
+            } for entity in sorted({change['entity'] for change in changes})]
+
+        if session.get_bind().dialect.name == 'postgresql':
+            session.execute(
+                text('SELECT pg_notify(:channel, :payload)'), [{
+                    'channel': CHANNEL,
+                    'payload': _payload(change)
+                } for change in changes])
+        else:
+            session.info.setdefault(PENDING_KEY, []).extend(
+                json.loads(_payload(change)) for change in changes)
+
+    def deliver(self, change):
+        with self.lock:
+            subscribers = list(self.subscribers)
+
+        for subscriber in subscribers:
+            try:
+                subscriber.queue.put_nowait(change)
+            except queue.Full:
+                subscriber.lost = True
+
+    def subscribe(self):
+        # None when the worker already serves max_streams streams
+        subscriber = _Subscriber(self.queue_size)
+
+        with self.lock:
+            if len(self.subscribers) >= self.max_streams:
+                return None
+
+            self.subscribers.add(subscriber)
+
+        self._listen()
+
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def stream(self, subscriber, entities, seconds, keepalive):
+        # Server-Sent Events of the entities for up to seconds, after
+        # which the browser reconnects on its own
+        deadline = time.monotonic() + seconds
+
+        try:
+            yield f'retry: {RETRY_MS}\n\n'
+
+            while not subscriber.lost:
+                remaining = deadline - time.monotonic()
+
+                if remaining <= 0:
+                    return
+
+                try:
+                    change = subscriber.queue.get(
+                        timeout=min(remaining, keepalive))
+                except queue.Empty:
+                    # Keeps proxies from closing an idle connection
+                    yield ': keepalive\n\n'
+                    continue
+
+                if change['entity'] in entities:
+                    yield f'event: change\ndata: {json.dumps(change)}\n\n'
+
+            yield 'event: reload\ndata: {}\n\n'
+        finally:
+            self.unsubscribe(subscriber)
+
+    def _listen(self):
+        # One LISTEN connection per worker, started with its first
+        # stream; threads do not survive a fork
+        if db.get_engine(self.app).dialect.name != 'postgresql':
+            return
+
+        with self.lock:
+            if self.listener is not None and self.pid == os.getpid():
+                return
+
+            self.pid = os.getpid()
+            self.listener = threading.Thread(
+                target=self._run, name='changefeed', daemon=True)
+            self.listener.start()
+
+    def _run(self):
+        while True:
+            try:
+                connection = db.get_engine(self.app).raw_connection()
+
+                try:
+                    self._receive(connection.connection)
+                finally:
+                    # Not handed back to the pool with its LISTEN on
+                    connection.invalidate()
+            except Exception as e:
+                self.app.logger.info(f'Change feed listener failed: {e}')
+                time.sleep(1)
+
+    def _receive(self, connection):
+        connection.autocommit = True
+        connection.cursor().execute(f'LISTEN {CHANNEL}')
+
+        while True:
+            if select.select([connection], [], [], 5) == ([], [], []):
+                continue
+
+            connection.poll()
+
+            while connection.notifies:
+                self.deliver(json.loads(connection.notifies.pop(0).payload))
+
+    def __repr__(self):
+        return f'ChangeFeed("{len(self.subscribers)}")'
+
+
+def _after_transaction_create(session, transaction):
+    if transaction.nested:
+        session.info.setdefault(SAVEPOINTS_KEY, {})[transaction] = \
+            len(session.info.get(PENDING_KEY, []))
+
+
+def _after_transaction_end(session, transaction):
+    session.info.get(SAVEPOINTS_KEY, {}).pop(transaction, None)
+
+
+def _after_commit(session):
+    feed = db.app.extensions.get('changefeed') if db.app else None
+
+    for change in session.info.pop(PENDING_KEY, []):
+        if feed is not None:
+            feed.deliver(change)
+
+    # The savepoints still open began before what is pending from now on
+    savepoints = session.info.get(SAVEPOINTS_KEY, {})
+
+    for transaction in savepoints:
+        savepoints[transaction] = 0
+
+
+def _after_rollback(session):
+    # The transaction rolled back is the savepoint or the outermost
+    # transaction that session.transaction belongs to
+    transaction = session.transaction
+
+    while not transaction.nested and transaction.parent is not None:
+        transaction = transaction.parent
+
+    pending = session.info.get(PENDING_KEY)
+
+    if pending is None:
+        return
+
+    if transaction.nested:
+        del pending[session.info.get(SAVEPOINTS_KEY, {}).get(
+            transaction, 0):]
+    else:
+        session.info.pop(PENDING_KEY, None)
+
+
+def setup_changefeed(app):
+    if not app.config['CHANGEFEED']:
+        return None
+
+    feed = ChangeFeed(
+        app,
+        app.config['CHANGEFEED_QUEUE_SIZE'],
+        app.config['CHANGEFEED_MAX_STREAMS'])
+
+    if not event.contains(Session, 'after_commit', _after_commit):
+        event.listen(
+            Session, 'after_transaction_create', _after_transaction_create)
+        event.listen(
+            Session, 'after_transaction_end', _after_transaction_end)
+        event.listen(Session, 'after_commit', _after_commit)
+        event.listen(Session, 'after_rollback', _after_rollback)
+
+    app.extensions['changefeed'] = feed
+
+    return feed
@@ -0,0 +1,134 @@
+import zlib
+from flask import request
+
+
+###########################################################
+#
+# RESPONSE COMPRESSION
+#
+# Compresses the responses of COMPRESS_MIMETYPES with
+# Brotli (at COMPRESS_BROTLI_QUALITY) or gzip (at
+# COMPRESS_LEVEL), whichever the client prefers. Bodies
+# smaller than COMPRESS_MIN_SIZE are sent as they are,
+# since they would barely shrink. A streamed response (the CSV
+# report) stays streamed: every chunk is compressed and
+# flushed as it is produced. Responses that are already
+# encoded, like the precompressed assets, are left alone.
+#
+###########################################################
+
+
+class _GzipEncoder(object):
+    name = 'gzip'
+
+    def __init__(self, level):
+        # wbits 16 + MAX_WBITS writes the gzip header and trailer
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def flush(self):
+        return self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.compressor.flush(zlib.Z_FINISH)
+
+
+class _BrotliEncoder(object):
+    name = 'br'
+
+    def __init__(self, quality):
+        import brotli
+
+        self.compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def flush(self):
+        return self.compressor.flush()
+
+    def finish(self):
+        return self.compressor.finish()
+
+
+def _choose_encoder(encoders):
+    # The encoding the client gives the highest q-value, Brotli on a tie
+    best, best_quality = None, 0
+
+    for encoder, level in encoders:
+        quality = request.accept_encodings[encoder.name]
+
+        if quality > best_quality:
+            best, best_quality = encoder(level), quality
+
+    return best
+
+
+def _stream(encoder, chunks):
+    for chunk in chunks:
+        data = encoder.compress(chunk) + encoder.flush()
+        if data:
+            yield data
+
+    yield encoder.finish()
+
+
+def compress_response(response, encoders, min_size, mimetypes):
+    if request.method == 'HEAD' \
+            or response.status_code < 200 \
+            or response.status_code in (204, 206, 304) \
+            or 'Content-Encoding' in response.headers \
+            or response.mimetype not in mimetypes \
+            or response.cache_control.no_transform:
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoder = _choose_encoder(encoders)
+
+    if encoder is None:
+        return response
+
+    if response.is_streamed:
+        response.response = _stream(encoder, response.iter_encoded())
+        response.direct_passthrough = False
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+
+        if len(data) < min_size:
+            return response
+
+        response.set_data(encoder.compress(data) + encoder.finish())
+
+    response.headers['Content-Encoding'] = encoder.name
+
+    # The compressed body is a different representation of the page
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak=True)
+
+    return response
+
+
+def setup_compression(app):
+    encoders = []
+
+    if app.config['COMPRESS_BROTLI_QUALITY']:
+        encoders.append(
+            (_BrotliEncoder, app.config['COMPRESS_BROTLI_QUALITY']))
+    if app.config['COMPRESS_LEVEL']:
+        encoders.append((_GzipEncoder, app.config['COMPRESS_LEVEL']))
+
+    if not encoders:
+        return
+
+    min_size = app.config['COMPRESS_MIN_SIZE']
+    mimetypes = frozenset(
+        mimetype.strip()
+        for mimetype in app.config['COMPRESS_MIMETYPES'].split(','))
+
+    @app.after_request
+    def compress(response):
+        return compress_response(response, encoders, min_size, mimetypes)
@@ -1,4 +1,5 @@
 import os
+import tempfile
 from dotenv import load_dotenv
 from os.path import abspath, dirname, join
 
@@ -21,6 +22,8 @@ class Config(object):
 
     AUTH0_DOMAIN = os.environ.get('AUTH0_DOMAIN')
     ALGORITHMS = os.environ.get('ALGORITHMS')
+    JWKS_URL = os.environ.get(
+        'JWKS_URL', f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
     CLIENT_ID = os.environ.get('CLIENT_ID')
     CLIENT_SECRET = os.environ.get('CLIENT_SECRET')
     API_AUDIENCE = os.environ.get('API_AUDIENCE')
@@ -38,3 +41,149 @@ class Config(object):
     SQLALCHEMY_TRACK_MODIFICATIONS = \
         os.environ.get('SQLALCHEMY_TRACK_MODIFICATIONS')
     TEST_TOKEN = os.environ.get("TEST_TOKEN")
+
+    # Expiring-stock report window (days) and markdown job rules, given
+    # as comma separated "days:percent" pairs, e.g. "1:50,3:25"
+    EXPIRING_DAYS = int(os.environ.get('EXPIRING_DAYS', 7))
+    MARKDOWN_RULES = os.environ.get('MARKDOWN_RULES', '1:50,3:25')
+
+    # Replenishment engine: days of sales history used for the velocity
+    # and days of stock to hold on top of the supplier lead time
+    REPLENISH_WINDOW_DAYS = int(os.environ.get('REPLENISH_WINDOW_DAYS', 28))
+    REPLENISH_COVER_DAYS = int(os.environ.get('REPLENISH_COVER_DAYS', 7))
+
+    # Logging: to stderr, or to LOG_FILE (one file per gunicorn worker)
+    # when set. LOG_ROTATION is 'size' (LOG_MAX_BYTES) or 'time'
+    # (LOG_ROTATE_WHEN), LOG_FORMAT is 'text' or 'json'. Identical messages
+    # beyond LOG_RATE_LIMIT_BURST per LOG_RATE_LIMIT_INTERVAL seconds are
+    # dropped; a burst of 0 disables the rate limiting
+    LOG_FILE = os.environ.get('LOG_FILE', '')
+    LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+    LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
+    LOG_ROTATION = os.environ.get('LOG_ROTATION', 'size')
+    LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES', 10485760))
+    LOG_ROTATE_WHEN = os.environ.get('LOG_ROTATE_WHEN', 'midnight')
+    LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT', 5))
+    LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+    LOG_RATE_LIMIT_BURST = int(os.environ.get('LOG_RATE_LIMIT_BURST', 5))
+    LOG_RATE_LIMIT_INTERVAL = \
+        float(os.environ.get('LOG_RATE_LIMIT_INTERVAL', 60))
+
+    # Request metrics: every worker dumps its counters to METRICS_DIR so
+    # /metrics can add up all gunicorn workers; /metrics only answers to
+    # the comma separated METRICS_ALLOWED_IPS, or to a request with
+    # METRICS_TOKEN as its bearer token (needed behind Heroku's router)
+    METRICS_DIR = os.environ.get(
+        'METRICS_DIR', join(tempfile.gettempdir(), 'udacimarket_metrics'))
+    METRICS_FLUSH_INTERVAL = \
+        float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))
+    METRICS_ALLOWED_IPS = \
+        os.environ.get('METRICS_ALLOWED_IPS', '127.0.0.1,::1')
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+    # Query inspector (development): adds an X-Query-Count header, warns
+    # when a request repeats the same query NPLUSONE_THRESHOLD times
+    # (N+1) or runs more than QUERY_BUDGET queries (0 for no budget)
+    QUERY_INSPECTOR = \
+        os.environ.get('QUERY_INSPECTOR', 'False').lower() == 'true'
+    NPLUSONE_THRESHOLD = int(os.environ.get('NPLUSONE_THRESHOLD', 5))
+    QUERY_BUDGET = int(os.environ.get('QUERY_BUDGET', 0))
+
+    # Compiled templates are cached in JINJA_CACHE_DIR so new workers
+    # skip compiling them; an empty value disables the cache
+    JINJA_CACHE_DIR = os.environ.get(
+        'JINJA_CACHE_DIR', join(tempfile.gettempdir(), 'udacimarket_jinja'))
+
+    # gunicorn (gunicorn.conf.py): WEB_CONCURRENCY workers, by default
+    # two per CPU plus one and at most GUNICORN_MAX_WORKERS, each with
+    # GUNICORN_THREADS threads. A worker whose memory grows by more than
+    # GUNICORN_MAX_RSS_GROWTH_MB (0 for no limit) or that has served
+    # GUNICORN_MAX_REQUESTS requests (0 for no limit) is replaced; both
+    # limits are raised by up to GUNICORN_RECYCLE_JITTER per worker so
+    # the workers are not all replaced at once
+    WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY', 0))
+    GUNICORN_MAX_WORKERS = int(os.environ.get('GUNICORN_MAX_WORKERS', 4))
+    GUNICORN_THREADS = int(os.environ.get('GUNICORN_THREADS', 2))
+    GUNICORN_PRELOAD = \
+        os.environ.get('GUNICORN_PRELOAD', 'True').lower() == 'true'
+    GUNICORN_MAX_RSS_GROWTH_MB = \
+        int(os.environ.get('GUNICORN_MAX_RSS_GROWTH_MB', 150))
+    GUNICORN_MAX_REQUESTS = int(os.environ.get('GUNICORN_MAX_REQUESTS', 0))
+    GUNICORN_RECYCLE_JITTER = \
+        float(os.environ.get('GUNICORN_RECYCLE_JITTER', 0.1))
+
+    # Sessions: SESSION_STORE is 'redis' at SESSION_REDIS_URL, shared by
+    # every dyno, when that is set, else 'cookie' for Flask's cookie
+    # session. 'sqlite' (in SESSION_FILE) only serves one machine and
+    # 'memory' one process: both are opt-in. A server-side session
+    # expires after SESSION_IDLE_TIMEOUT seconds without a request
+    SESSION_REDIS_URL = os.environ.get('SESSION_REDIS_URL', '')
+    SESSION_STORE = os.environ.get(
+        'SESSION_STORE', 'redis' if SESSION_REDIS_URL else 'cookie')
+    SESSION_FILE = os.environ.get(
+        'SESSION_FILE',
+        join(tempfile.gettempdir(), 'udacimarket_sessions.db'))
+    SESSION_IDLE_TIMEOUT = int(os.environ.get('SESSION_IDLE_TIMEOUT', 3600))
+
+    # Response compression: gzip at COMPRESS_LEVEL (1-9) or Brotli at
+    # COMPRESS_BROTLI_QUALITY (1-11) for COMPRESS_MIMETYPES bodies of at
+    # least COMPRESS_MIN_SIZE bytes; a level of 0 turns that encoding off
+    COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL', 6))
+    COMPRESS_BROTLI_QUALITY = \
+        int(os.environ.get('COMPRESS_BROTLI_QUALITY', 4))
+    COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+    COMPRESS_MIMETYPES = os.environ.get(
+        'COMPRESS_MIMETYPES',
+        'text/html,text/csv,text/plain,application/json')
+
+    # CORS: comma-separated origins ('*' for any). Browsers keep a
+    # preflight answer CORS_MAX_AGE seconds (Chrome at most 7200)
+    CORS_ORIGINS = os.environ.get('CORS_ORIGINS', '*')
+    CORS_ALLOW_METHODS = os.environ.get(
+        'CORS_ALLOW_METHODS', 'GET, POST, PATCH, PUT, DELETE, OPTIONS')
+    CORS_ALLOW_HEADERS = os.environ.get(
+        'CORS_ALLOW_HEADERS', 'Content-Type, Authorization')
+    CORS_MAX_AGE = int(os.environ.get('CORS_MAX_AGE', 7200))
+
+    # Purchases per page of a customer's purchase history, by default
+    # and at most
+    PURCHASE_HISTORY_PAGE_SIZE = \
+        int(os.environ.get('PURCHASE_HISTORY_PAGE_SIZE', 25))
+    PURCHASE_HISTORY_MAX_PAGE_SIZE = \
+        int(os.environ.get('PURCHASE_HISTORY_MAX_PAGE_SIZE', 100))
+
+    # Group commit of purchases: with PURCHASE_GROUP_COMMIT, the purchases
+    # of concurrent requests of a worker are committed together. A group
+    # waits at most PURCHASE_GROUP_COMMIT_WINDOW_MS for more purchases and
+    # holds at most PURCHASE_GROUP_COMMIT_MAX_SIZE
+    PURCHASE_GROUP_COMMIT = \
+        os.environ.get('PURCHASE_GROUP_COMMIT', 'False').lower() == 'true'
+    PURCHASE_GROUP_COMMIT_WINDOW_MS = \
+        float(os.environ.get('PURCHASE_GROUP_COMMIT_WINDOW_MS', 2))
+    PURCHASE_GROUP_COMMIT_MAX_SIZE = \
+        int(os.environ.get('PURCHASE_GROUP_COMMIT_MAX_SIZE', 100))
+
+    # Most operations a single /batch request may carry
+    BATCH_MAX_OPERATIONS = int(os.environ.get('BATCH_MAX_OPERATIONS', 100))
+
+    # Change feed: with CHANGEFEED, rows written through the models are
+    # streamed to the pages by /changes as Server-Sent Events. A stream
+    # lasts at most CHANGEFEED_STREAM_SECONDS (the browser then
+    # reconnects), sends a comment after CHANGEFEED_KEEPALIVE_SECONDS of
+    # silence, and asks the page to reload once CHANGEFEED_QUEUE_SIZE
+    # changes wait for it. A worker serves at most CHANGEFEED_MAX_STREAMS
+    # streams, each on a thread of its own added to GUNICORN_THREADS
+    CHANGEFEED = os.environ.get('CHANGEFEED', 'False').lower() == 'true'
+    CHANGEFEED_STREAM_SECONDS = \
+        float(os.environ.get('CHANGEFEED_STREAM_SECONDS', 300))
+    CHANGEFEED_KEEPALIVE_SECONDS = \
+        float(os.environ.get('CHANGEFEED_KEEPALIVE_SECONDS', 15))
+    CHANGEFEED_QUEUE_SIZE = int(os.environ.get('CHANGEFEED_QUEUE_SIZE', 1000))
+    CHANGEFEED_MAX_STREAMS = int(os.environ.get('CHANGEFEED_MAX_STREAMS', 2))
+
+
+class SQLiteConfig(Config):
+    # In-memory SQLite database: runs the test suite and the benchmarks
+    # of the pure-Python layers without a PostgreSQL server
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    SQLALCHEMY_TEST_DATABASE_URI = 'sqlite://'
@@ -0,0 +1,93 @@
+from flask import request
+from werkzeug.exceptions import HTTPException
+from werkzeug.routing import RequestRedirect
+
+
+###########################################################
+#
+# CORS
+#
+# Cross-origin requests are allowed from CORS_ORIGINS ('*'
+# for any origin). A preflight (an OPTIONS request with an
+# Access-Control-Request-Method header) is answered by a
+# WSGI middleware in front of the app, so it never opens
+# the session, runs the Auth0 check or touches the
+# database; its Access-Control-Max-Age of CORS_MAX_AGE
+# seconds lets the browser skip the preflights that follow.
+# Every header value is built once, when the app starts.
+#
+###########################################################
+
+
+class PreflightMiddleware(object):
+    def __init__(self, app, wsgi_app, origins, headers):
+        self.app = app
+        self.wsgi_app = wsgi_app
+        self.origins = origins
+        self.headers = headers
+
+    def _routed(self, environ, method):
+        # Only answer for a URL and a method the app would serve
+        try:
+            self.app.url_map.bind_to_environ(environ).match(method=method)
+        except RequestRedirect:
+            return True
+        except HTTPException:
+            return False
+
+        return True
+
+    def __call__(self, environ, start_response):
+        method = environ.get('HTTP_ACCESS_CONTROL_REQUEST_METHOD')
+        origin = environ.get('HTTP_ORIGIN')
+
+        if environ['REQUEST_METHOD'] != 'OPTIONS' or not method \
+                or not origin or not self._routed(environ, method):
+            return self.wsgi_app(environ, start_response)
+
+        if self.origins is None:
+            headers = [('Access-Control-Allow-Origin', '*')]
+        elif origin in self.origins:
+            headers = [('Access-Control-Allow-Origin', origin),
+                       ('Vary', 'Origin')]
+        else:
+            return self.wsgi_app(environ, start_response)
+
+        start_response('204 NO CONTENT', headers + self.headers)
+        return []
+
+
+def _parse_list(value):
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def setup_cors(app):
+    origins = _parse_list(app.config['CORS_ORIGINS'])
+    origins = None if '*' in origins else frozenset(origins)
+
+    preflight_headers = [
+        ('Access-Control-Allow-Methods',
+         ', '.join(_parse_list(app.config['CORS_ALLOW_METHODS']))),
+        ('Access-Control-Allow-Headers',
+         ', '.join(_parse_list(app.config['CORS_ALLOW_HEADERS']))),
+        ('Access-Control-Max-Age', str(app.config['CORS_MAX_AGE']))
+    ]
+
+    app.wsgi_app = PreflightMiddleware(
+        app, app.wsgi_app, origins, preflight_headers)
+
+    @app.after_request
+    def add_cors_headers(response):
+        origin = request.headers.get('Origin')
+
+        if origins is None:
+            if origin is not None:
+                response.headers['Access-Control-Allow-Origin'] = '*'
+            return response
+
+        # The header depends on the origin, so must caches
+        response.vary.add('Origin')
+        if origin in origins:
+            response.headers['Access-Control-Allow-Origin'] = origin
+
+        return response
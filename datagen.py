@@ -0,0 +1,438 @@
+import csv
+import io
+import math
+import random
+import sys
+from bisect import bisect
+from datetime import (
+    date,
+    timedelta)
+from itertools import (
+    accumulate,
+    islice)
+
+
+###########################################################
+#
+# SYNTHETIC DATA GENERATOR
+#
+# Replaces the content of every table with generated,
+# referentially consistent data sized by a scale factor
+# (scale 1 is 10,000 products, 100,000 customers and
+# 1,000,000 purchases over a year). Rows are produced
+# lazily and streamed to PostgreSQL with COPY, so millions
+# of purchases load without being held in memory or sent
+# as INSERT statements.
+#
+###########################################################
+
+
+ROWS_PER_SCALE = {
+    'suppliers': 200,
+    'products': 10000,
+    'employees': 500,
+    'customers': 100000,
+    'deliveries': 50000,
+    'purchases': 1000000
+}
+
+TABLES = (
+    'purchases', 'receivedfrom', 'providesdelivery', 'providedby',
+    'aislecontains', 'aisles', 'employees', 'products', 'customers',
+    'suppliers', 'departments')
+
+# Tables computed from the generated ones once they are loaded
+DERIVED = {
+    'customer_stats':
+        'INSERT INTO customer_stats '
+        '(customer_id, order_count, lifetime_spend, last_purchase_date) '
+        'SELECT customer_id, count(DISTINCT id), sum(total), '
+        'max(purchase_date) FROM purchases '
+        'WHERE customer_id IS NOT NULL AND NOT is_cancelled '
+        'GROUP BY customer_id'
+}
+
+SEQUENCES = {
+    'customers_id_seq': ('customers', 'id'),
+    'suppliers_id_seq': ('suppliers', 'id'),
+    'employees_id_seq': ('employees', 'id'),
+    'products_id_seq': ('products', 'id'),
+    'providesdelivery_delivery_id_seq': ('providesdelivery', 'delivery_id'),
+    'purchases_id_seq': ('purchases', 'id')
+}
+
+# (name, aisle names, catalog, seasonal peak day of year, amplitude)
+# catalog rows: (item, cost unit, lowest price, highest price, shelf days)
+DEPARTMENTS = [
+    ('Produce', ['Fruits', 'Vegetables'], [
+        ('Apples', 'lb', 0.99, 3.49, 21),
+        ('Bananas', 'lb', 0.49, 0.99, 7),
+        ('Strawberries', 'lb', 2.99, 6.99, 5),
+        ('Potatoes', 'lb', 0.59, 1.49, 45),
+        ('Onions', 'lb', 0.79, 1.79, 60),
+        ('Lettuce', 'ct', 1.49, 3.49, 7),
+        ('Tomatoes', 'lb', 1.49, 3.99, 10)], 200, 0.30),
+    ('Meat and Seafood', ['Meats', 'Seafood'], [
+        ('Steak', 'lb', 7.99, 24.99, 4),
+        ('Chicken Breast', 'lb', 3.99, 8.99, 4),
+        ('Ground Beef', 'lb', 3.49, 6.99, 3),
+        ('Salmon Fillet', 'lb', 8.99, 19.99, 3),
+        ('Shrimp', 'lb', 7.99, 15.99, 5)], 185, 0.20),
+    ('Baked Goods', ['Baked Goods'], [
+        ('Bagels', 'pack', 2.99, 5.99, 5),
+        ('Bread', 'ct', 1.99, 5.49, 6),
+        ('Croissants', 'pack', 3.49, 6.99, 3),
+        ('Muffins', 'pack', 3.99, 7.99, 4)], 355, 0.25),
+    ('Pantry Items', ['Pantry Items'], [
+        ('Spaghetti', 'lb', 0.69, 2.99, 720),
+        ('Rice', 'lb', 0.99, 3.99, 720),
+        ('Table Salt', 'lb', 0.49, 1.99, 1800),
+        ('Canned Tomatoes', 'ct', 0.89, 2.49, 720),
+        ('Olive Oil', 'L', 5.99, 14.99, 540)], 320, 0.10),
+    ('Eggs and Dairy', ['Dairy', 'Eggs'], [
+        ('Milk', 'L', 1.49, 4.49, 14),
+        ('Half and Half', 'L', 1.99, 3.99, 14),
+        ('Yogurt', 'ct', 0.99, 5.99, 21),
+        ('Cheddar Cheese', 'lb', 4.99, 9.99, 60),
+        ('Eggs', 'pack', 2.99, 5.99, 30)], 100, 0.10)
+]
+
+VARIANTS = ['Classic', 'Organic', 'Family Size', 'Value', 'Premium',
+            'Local', 'Fresh', 'Light', 'Extra', 'Select']
+BRANDS = ['Western Family', 'Dairyland', 'Golden Valley', 'Silk',
+          'Pepperidge Farms', 'Barilla', 'Italpasta', 'Windsor',
+          'Natrel', 'Compliments', 'No Name', 'Kirkland']
+CUTS = {'Steak': 'Tenderloin', 'Ground Beef': 'Lean',
+        'Chicken Breast': 'Boneless'}
+ANIMALS = {'Steak': 'Beef', 'Ground Beef': 'Beef',
+           'Chicken Breast': 'Chicken', 'Salmon Fillet': 'Salmon',
+           'Shrimp': 'Shrimp'}
+
+FIRST_NAMES = ['Olivia', 'Liam', 'Emma', 'Noah', 'Ava', 'William',
+               'Sophia', 'James', 'Mia', 'Benjamin', 'Chloe', 'Lucas',
+               'Amelia', 'Ethan', 'Harper', 'Mason', 'Ella', 'Logan',
+               'Aria', 'Jacob', 'Wei', 'Priya', 'Hiroshi', 'Fatima']
+LAST_NAMES = ['Smith', 'Brown', 'Tremblay', 'Martin', 'Roy', 'Wilson',
+              'MacDonald', 'Gagnon', 'Johnson', 'Taylor', 'Lee', 'Chen',
+              'Wong', 'Singh', 'Patel', 'Nguyen', 'Kim', 'Campbell']
+STREETS = ['Main Mall', 'Kingsway', 'Granville St', 'Broadway',
+           'Hastings St', 'Lougheed Hwy', 'Marine Dr', 'Cambie St']
+CITIES = ['Vancouver', 'Burnaby', 'Richmond', 'Surrey', 'Coquitlam']
+TITLES = [('Stocker', 15), ('Cashier', 15), ('Clerk', 17),
+          ('Supervisor', 22), ('Manager', 30)]
+
+QUANTITIES = (1, 2, 3, 4, 6)
+QUANTITY_ODDS = (50, 75, 87, 95, 100)
+
+# Monday..Sunday
+WEEKDAY_FACTORS = (0.85, 0.80, 0.85, 0.95, 1.10, 1.30, 1.15)
+
+
+def _phone(rand):
+    return f'{rand.randint(200, 999)} {rand.randint(200, 999)} ' \
+        f'{rand.randint(1000, 9999)}'
+
+
+def _address(rand):
+    return f'{rand.randint(100, 9999)} {rand.choice(STREETS)}, ' \
+        f'{rand.choice(CITIES)}, BC'
+
+
+def _seasonal(day, peak, amplitude):
+    return 1 + amplitude * math.cos(2 * math.pi * (day - peak) / 365.0)
+
+
+class _CopyStream(object):
+    '''
+    File-like object rendering rows as CSV as COPY reads them, so a
+    table of any size is streamed without being built in memory.
+    '''
+
+    def __init__(self, rows, batch=2000):
+        self.rows = iter(rows)
+        self.batch = batch
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer, lineterminator='\n')
+        self.pending = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.pending) < size:
+            rows = list(islice(self.rows, self.batch))
+            if not rows:
+                break
+            self.writer.writerows(rows)
+            self.pending += self.buffer.getvalue()
+            self.buffer.seek(0)
+            self.buffer.truncate()
+
+        if size < 0:
+            size = len(self.pending)
+        data, self.pending = self.pending[:size], self.pending[size:]
+
+        return data
+
+
+class DatasetGenerator(object):
+    def __init__(self, scale=1.0, seed=0, days=365, today=None):
+        self.scale = scale
+        self.days = days
+        self.today = today or date.today()
+        self.rand = random.Random(seed)
+        self.sizes = {
+            table: max(int(rows * scale), 1)
+            for table, rows in ROWS_PER_SCALE.items()}
+        self.catalog = self._build_catalog()
+
+    def _build_catalog(self):
+        # Products are dealt round-robin over the departments; every
+        # product gets a popularity following a Zipf-like curve
+        rand = self.rand
+        products = []
+        aisles = []
+        aisle_number = 0
+        # More aisles as the catalog grows, at least the repo's eight
+        per_aisle = max(int(self.scale), 1)
+
+        for department_id, (name, aisle_names, items, peak, amplitude) \
+                in enumerate(DEPARTMENTS, 1):
+            numbers = []
+            for aisle_name in aisle_names:
+                for copy in range(per_aisle):
+                    aisle_number += 1
+                    suffix = f' {copy + 1}' if per_aisle > 1 else ''
+                    aisles.append((aisle_number, aisle_name + suffix))
+                    numbers.append(aisle_number)
+
+            count = self.sizes['products'] // len(DEPARTMENTS)
+            for position in range(count):
+                item, unit, low, high, shelf = items[position % len(items)]
+                variant = VARIANTS[(position // len(items)) % len(VARIANTS)]
+                batch = position // (len(items) * len(VARIANTS))
+                products.append({
+                    'department_id': department_id,
+                    'aisle_number': rand.choice(numbers),
+                    'name': f'{item} ({variant}'
+                            f'{", #" + str(batch + 1) if batch else ""})',
+                    'item': item,
+                    'unit': unit,
+                    'price': round(rand.uniform(low, high), 2),
+                    'shelf': shelf,
+                    'popularity': 1.0 / (position + 1) ** 0.8
+                })
+
+        rand.shuffle(products)
+        for product_id, product in enumerate(products, 1):
+            product['id'] = product_id
+
+        return {'products': products, 'aisles': aisles}
+
+    ###########################################################
+    # Row generators, in load order
+    ###########################################################
+
+    def departments(self):
+        for department_id, department in enumerate(DEPARTMENTS, 1):
+            yield (department_id, department[0])
+
+    def aisles(self):
+        yield from self.catalog['aisles']
+
+    def suppliers(self):
+        rand = self.rand
+        for supplier_id in range(1, self.sizes['suppliers'] + 1):
+            yield (supplier_id,
+                   f'{rand.choice(LAST_NAMES)} Foods #{supplier_id}',
+                   _address(rand), _phone(rand), rand.randint(1, 7))
+
+    def products(self):
+        rand = self.rand
+        for product in self.catalog['products']:
+            produced = self.today - timedelta(
+                days=rand.randint(0, max(product['shelf'] - 1, 0)))
+            best_before = produced + timedelta(days=product['shelf'])
+            animal = ANIMALS.get(product['item'])
+            yield (product['id'], product['name'], product['price'],
+                   product['unit'], product['department_id'],
+                   rand.randint(0, 300),
+                   rand.choice(BRANDS) if product['department_id'] > 2
+                   else None,
+                   produced.isoformat(), best_before.isoformat(),
+                   rand.randint(3000, 4999)
+                   if product['department_id'] == 1 else None,
+                   f'{rand.randrange(10 ** 11, 10 ** 12)}'
+                   if product['department_id'] > 1 else None,
+                   int('Organic' in product['name']),
+                   CUTS.get(product['item']), animal, 0)
+
+    def aislecontains(self):
+        for product in self.catalog['products']:
+            yield (product['aisle_number'], product['id'])
+
+    def providedby(self):
+        # One or two suppliers per product, remembered for deliveries
+        rand = self.rand
+        suppliers = self.sizes['suppliers']
+        self.supplied = [[] for _ in range(suppliers + 1)]
+
+        for product in self.catalog['products']:
+            for supplier_id in rand.sample(
+                    range(1, suppliers + 1), min(rand.randint(1, 2),
+                                                 suppliers)):
+                self.supplied[supplier_id].append(product['id'])
+                yield (product['id'], supplier_id)
+
+    def employees(self):
+        rand = self.rand
+        titles = [title for title, _ in TITLES]
+        wages = dict(TITLES)
+        for employee_id in range(1, self.sizes['employees'] + 1):
+            title = rand.choices(titles, (40, 30, 20, 7, 3))[0]
+            yield (employee_id,
+                   f'{rand.choice(FIRST_NAMES)} {rand.choice(LAST_NAMES)}',
+                   rand.randint(1, len(DEPARTMENTS)), title,
+                   100000000 + employee_id, _address(rand), _phone(rand),
+                   wages[title] + rand.randint(0, 5),
+                   rand.random() > 0.05)
+
+    def customers(self):
+        rand = self.rand
+        for customer_id in range(1, self.sizes['customers'] + 1):
+            first, last = rand.choice(FIRST_NAMES), rand.choice(LAST_NAMES)
+            yield (customer_id, f'{first} {last}', _phone(rand),
+                   f'{first}.{last}{customer_id}@example.com'.lower())
+
+    def providesdelivery(self):
+        rand = self.rand
+        stocked = [s for s in range(1, len(self.supplied))
+                   if self.supplied[s]]
+        self.delivered = [
+            rand.choice(stocked) for _ in range(self.sizes['deliveries'])]
+
+        for delivery_id, supplier_id in enumerate(self.delivered, 1):
+            yield (delivery_id, supplier_id)
+
+    def receivedfrom(self):
+        rand = self.rand
+        for delivery_id, supplier_id in enumerate(self.delivered, 1):
+            products = self.supplied[supplier_id]
+            for product_id in rand.sample(
+                    products, min(rand.randint(5, 15), len(products))):
+                yield (product_id, delivery_id)
+
+    def purchases(self):
+        # Daily volume follows the weekday and the time of the year, and
+        # each department its own season; within a department products
+        # sell by popularity and customers are skewed to loyal regulars
+        rand = self.rand
+        total = self.sizes['purchases']
+        customers = self.sizes['customers']
+        start = self.today - timedelta(days=self.days - 1)
+
+        by_department = [[] for _ in DEPARTMENTS]
+        for product in self.catalog['products']:
+            by_department[product['department_id'] - 1].append(product)
+        cumulative = [
+            list(accumulate(p['popularity'] for p in products))
+            for products in by_department]
+        share = [c[-1] if c else 0 for c in cumulative]
+
+        days = [start + timedelta(days=n) for n in range(self.days)]
+        volume = [
+            WEEKDAY_FACTORS[day.weekday()] *
+            _seasonal(day.timetuple().tm_yday, 355, 0.15) for day in days]
+        scale = total / sum(volume)
+
+        purchase_id = 0
+        for day, weight in zip(days, volume):
+            count = int(round(weight * scale))
+            if day == days[-1]:
+                count = max(total - purchase_id, 0)
+
+            day_of_year = day.timetuple().tm_yday
+            department_weights = list(accumulate(
+                share[d] * _seasonal(day_of_year, dep[3], dep[4])
+                for d, dep in enumerate(DEPARTMENTS)))
+            purchase_date = day.isoformat()
+
+            for _ in range(count):
+                purchase_id += 1
+                department = bisect(
+                    department_weights,
+                    rand.random() * department_weights[-1])
+                weights = cumulative[department]
+                product = by_department[department][
+                    bisect(weights, rand.random() * weights[-1])]
+                quantity = QUANTITIES[
+                    bisect(QUANTITY_ODDS, rand.random() * 100)]
+
+                yield (purchase_id, product['id'], quantity,
+                       int(customers * rand.random() ** 2) + 1,
+                       purchase_date, round(product['price'] * quantity, 2),
+                       rand.random() < 0.01)
+
+
+COLUMNS = {
+    'departments': 'id, name',
+    'aisles': 'aisle_number, name',
+    'suppliers': 'id, name, address, phone, lead_time_days',
+    'products': 'id, name, price_per_cost_unit, cost_unit, department_id, '
+                'quantity_in_stock, brand, production_date, '
+                'best_before_date, plu, upc, organic, cut, animal, '
+                'markdown_percent',
+    'aislecontains': 'aisle_number, product_id',
+    'providedby': 'product_id, supplier_id',
+    'employees': 'id, name, department_id, title, emp_number, address, '
+                 'phone, wage, is_active',
+    'customers': 'id, name, phone, email',
+    'providesdelivery': 'delivery_id, supplier_id',
+    'receivedfrom': 'product_id, delivery_id',
+    'purchases': 'id, product_id, quantity, customer_id, purchase_date, '
+                 'total, is_cancelled'
+}
+
+
+def generate_dataset(db, scale=1.0, seed=0, days=365, log=print) -> dict:
+    generator = DatasetGenerator(scale, seed, days)
+    counts = {}
+
+    connection = db.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        # Safe to lose on a crash: the whole load is one transaction
+        cursor.execute('SET LOCAL synchronous_commit TO OFF')
+        cursor.execute(
+            f'TRUNCATE {", ".join((*DERIVED, *TABLES))} '
+            f'RESTART IDENTITY CASCADE')
+
+        for table in reversed(TABLES):
+            cursor.copy_expert(
+                f'COPY {table} ({COLUMNS[table]}) FROM STDIN '
+                f'WITH (FORMAT csv)',
+                _CopyStream(getattr(generator, table)()),
+                size=65536)
+            counts[table] = cursor.rowcount
+            log(f'{table}: {cursor.rowcount} rows')
+
+        for table, statement in DERIVED.items():
+            cursor.execute(statement)
+            counts[table] = cursor.rowcount
+            log(f'{table}: {cursor.rowcount} rows')
+
+        for sequence, (table, column) in SEQUENCES.items():
+            cursor.execute(
+                f"SELECT setval('{sequence}', "
+                f"COALESCE((SELECT max({column}) FROM {table}), 0) + 1, "
+                f"false)")
+
+        # Fresh statistics so the planner sees the new sizes right away
+        cursor.execute(f'ANALYZE {", ".join((*TABLES, *DERIVED))}')
+        connection.commit()
+    except BaseException as e:
+        tb = sys.exc_info()
+        db.app.logger.info(e.with_traceback(tb[2]))
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+
+    return counts
@@ -8,3 +8,21 @@ class EmptyEntityError(Exception):
     def __init__(self, description, code):
         self.description = description
         self.code = code
+
+
+class UnknownEntityError(Exception):
+    def __init__(self, description, code):
+        self.description = description
+        self.code = code
+
+
+class BatchOperationError(Exception):
+    def __init__(self, description, code):
+        self.description = description
+        self.code = code
+
+
+class VersionConflictError(Exception):
+    def __init__(self, description, code):
+        self.description = description
+        self.code = code
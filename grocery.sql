@@ -1,6 +1,7 @@
 -- drop schema which contains all tables and views and recreate the schema
     DROP TABLE IF EXISTS aislecontains;
     DROP TABLE IF EXISTS aisles;
+    DROP TABLE IF EXISTS customer_stats;
     DROP TABLE IF EXISTS purchases;
     DROP TABLE IF EXISTS providedby;
     DROP TABLE IF EXISTS receivedfrom;
@@ -24,12 +25,14 @@ CREATE TABLE Customers(
     name VARCHAR(255),
     phone VARCHAR(255),
     email VARCHAR(255),
+    version INT NOT NULL DEFAULT 1,
     PRIMARY KEY(id)
 );
 
 CREATE TABLE Departments(
     id SERIAL,
     name VARCHAR(255),
+    version INT NOT NULL DEFAULT 1,
     PRIMARY KEY(id)
 );
 
@@ -38,6 +41,8 @@ CREATE TABLE Suppliers(
     name VARCHAR(255) NOT NULL,
     address VARCHAR(255),
     phone VARCHAR(255) NOT NULL,
+    lead_time_days INT NOT NULL DEFAULT 3,
+    version INT NOT NULL DEFAULT 1,
     PRIMARY KEY(id)
 );
 
@@ -51,6 +56,7 @@ CREATE TABLE Employees(
     phone VARCHAR(255),
     wage INT,
     is_active BOOLEAN NOT NULL DEFAULT TRUE,
+    version INT NOT NULL DEFAULT 1,
     PRIMARY KEY(id),
     FOREIGN KEY(department_id) REFERENCES Departments(id)
 );
@@ -63,20 +69,27 @@ CREATE TABLE Products(
     department_id BIGINT NOT NULL,
     quantity_in_stock INT,
     brand VARCHAR(255),
-    production_date VARCHAR(10),
-    best_before_date VARCHAR(10),
+    production_date DATE,
+    best_before_date DATE,
     plu INT,
     upc VARCHAR(20),
     organic INT,
     cut VARCHAR(255),
     animal VARCHAR(255),
+    markdown_percent INT NOT NULL DEFAULT 0,
+    version INT NOT NULL DEFAULT 1,
     PRIMARY KEY(id),
     FOREIGN KEY(department_id) REFERENCES Departments(id)
 );
 
+-- expiring-stock report and markdown job scan by best before date
+CREATE INDEX products_best_before_date_idx
+    ON Products(best_before_date, department_id);
+
 CREATE TABLE Aisles(
     aisle_number INT,
     name VARCHAR(255) NOT NULL,
+    version INT NOT NULL DEFAULT 1,
     PRIMARY KEY(aisle_number)
 );
 
@@ -116,14 +129,33 @@ CREATE TABLE Purchases(
     product_id INT,
     quantity INT,
     customer_id INT,
-    purchase_date VARCHAR(10),
+    purchase_date DATE,
     total FLOAT,
     is_cancelled BOOLEAN NOT NULL DEFAULT FALSE,
+    version INT NOT NULL DEFAULT 1,
     PRIMARY KEY(id, product_id),
     FOREIGN KEY(product_id) REFERENCES Products(id),
     FOREIGN KEY(customer_id) REFERENCES Customers(id)
 );
 
+-- sales velocity for the replenishment engine scans recent purchases
+CREATE INDEX purchases_purchase_date_idx
+    ON Purchases(purchase_date, product_id);
+
+-- purchase history of a customer, paged newest first
+CREATE INDEX purchases_customer_id_idx
+    ON Purchases(customer_id, id, product_id);
+
+-- lifetime stats of every customer, kept up to date by the app
+CREATE TABLE Customer_Stats(
+    customer_id INT,
+    order_count INT NOT NULL DEFAULT 0,
+    lifetime_spend FLOAT NOT NULL DEFAULT 0,
+    last_purchase_date DATE,
+    PRIMARY KEY(customer_id),
+    FOREIGN KEY(customer_id) REFERENCES Customers(id)
+);
+
 -- reset ID sequences
 ALTER SEQUENCE customers_id_seq restart with 1;
 ALTER SEQUENCE suppliers_id_seq restart with 1;
@@ -800,3 +832,11 @@ INSERT INTO ReceivedFrom VALUES(422,29);
 INSERT INTO ReceivedFrom VALUES(423,13);
 INSERT INTO ReceivedFrom VALUES(424,30);
 INSERT INTO ReceivedFrom VALUES(425,19);
+
+
+-- lifetime stats of the customers above
+INSERT INTO Customer_Stats
+    SELECT customer_id, COUNT(DISTINCT id), SUM(total), MAX(purchase_date)
+    FROM Purchases
+    WHERE customer_id IS NOT NULL AND NOT is_cancelled
+    GROUP BY customer_id;
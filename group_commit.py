@@ -0,0 +1,161 @@
+import atexit
+import os
+import queue
+import threading
+import time
+
+# Local imports...
+from models import (
+    Purchase,
+    db)
+
+
+###########################################################
+#
+# GROUP COMMIT
+#
+# Committing waits for the database to flush its log to
+# disk, which dominates the cost of inserting one purchase.
+# The writer lets the requests of a worker share that wait:
+# a background thread takes the purchases queued by them,
+# gathers more for up to window seconds (at most max_size
+# in all), and commits the group at once. Every request
+# blocks until the commit of its group has returned, so it
+# is only answered once its purchase is durable.
+#
+# A group that fails is committed again one purchase at a
+# time, so one bad purchase fails its own request only. A
+# request whose writer thread has stopped raises instead
+# of waiting for a commit that will never come.
+#
+###########################################################
+
+
+class _Pending(object):
+    def __init__(self, item):
+        self.item = item
+        self.error = None
+        self.done = threading.Event()
+
+
+class GroupCommitWriter(object):
+    def __init__(self, commit, window=0.002, max_size=100, poll=1.0):
+        # commit(items) writes the items in one transaction or raises;
+        # a waiting request checks its writer thread every poll seconds
+        self.commit = commit
+        self.window = window
+        self.max_size = max_size
+        self.poll = poll
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+
+    def write(self, item):
+        # Returns once the item is committed; raises what its commit did
+        pending = _Pending(item)
+        thread = self._enqueue(pending)
+
+        while not pending.done.wait(self.poll):
+            if not thread.is_alive() and not pending.done.is_set():
+                raise RuntimeError('The group commit writer has stopped')
+
+        if pending.error is not None:
+            raise pending.error
+
+    def close(self):
+        # Commits what is queued, then stops the thread
+        with self.lock:
+            if self.thread is None or self.pid != os.getpid():
+                return
+
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def _enqueue(self, pending):
+        # Threads do not survive a fork: a gunicorn worker starts its own,
+        # as does a writer whose thread has died
+        with self.lock:
+            if self.thread is None or self.pid != os.getpid() or \
+                    not self.thread.is_alive():
+                self.queue = queue.Queue()
+                self.pid = os.getpid()
+                self.thread = threading.Thread(
+                    target=self._run, name='group-commit', daemon=True)
+                self.thread.start()
+
+            self.queue.put(pending)
+
+            return self.thread
+
+    def _run(self):
+        stopping = False
+
+        while not stopping:
+            first = self.queue.get()
+
+            if first is None:
+                return
+
+            group = [first]
+            deadline = time.monotonic() + self.window
+
+            while len(group) < self.max_size:
+                remaining = deadline - time.monotonic()
+
+                try:
+                    pending = self.queue.get(timeout=max(remaining, 0))
+                except queue.Empty:
+                    break
+
+                if pending is None:
+                    stopping = True
+                    break
+
+                group.append(pending)
+
+            self._commit(group)
+
+    def _commit(self, group):
+        try:
+            self.commit([pending.item for pending in group])
+        except BaseException as e:
+            if len(group) == 1:
+                group[0].error = e
+            else:
+                for pending in group:
+                    try:
+                        self.commit([pending.item])
+                    except BaseException as e:
+                        pending.error = e
+
+        for pending in group:
+            pending.done.set()
+
+    def __repr__(self):
+        return f'GroupCommitWriter("{self.window}","{self.max_size}")'
+
+
+def setup_group_commit(app):
+    if not app.config['PURCHASE_GROUP_COMMIT']:
+        return None
+
+    def commit(purchases):
+        # The writer thread has no request: it gets its own app context,
+        # and so its own database session
+        with app.app_context():
+            try:
+                Purchase().add_purchases_to_database(purchases)
+            finally:
+                db.session.remove()
+
+    writer = GroupCommitWriter(
+        commit,
+        app.config['PURCHASE_GROUP_COMMIT_WINDOW_MS'] / 1000,
+        app.config['PURCHASE_GROUP_COMMIT_MAX_SIZE'])
+
+    app.extensions['purchase_writer'] = writer
+    atexit.register(writer.close)
+
+    return writer
@@ -0,0 +1,105 @@
+import multiprocessing
+import os
+import random
+
+# Local imports...
+from config import Config
+from metrics import clear_metrics_dir
+from models import db
+
+
+###########################################################
+#
+# GUNICORN
+#
+# Loaded by gunicorn from the working directory (see the
+# Procfile). The app is built once in the master before
+# the workers are forked, so they share the memory pages
+# of the imported modules and compiled templates until
+# they write to them. Only the database connections can
+# not be shared: the master drops its pool before forking
+# and every worker starts with an empty one.
+#
+###########################################################
+
+
+def _workers():
+    if Config.WEB_CONCURRENCY:
+        return Config.WEB_CONCURRENCY
+
+    return min(
+        multiprocessing.cpu_count() * 2 + 1, Config.GUNICORN_MAX_WORKERS)
+
+
+workers = _workers()
+# An open change stream keeps its thread: those get threads of their own
+threads = Config.GUNICORN_THREADS + \
+    (Config.CHANGEFEED_MAX_STREAMS if Config.CHANGEFEED else 0)
+preload_app = Config.GUNICORN_PRELOAD
+
+max_requests = Config.GUNICORN_MAX_REQUESTS
+max_requests_jitter = \
+    int(Config.GUNICORN_MAX_REQUESTS * Config.GUNICORN_RECYCLE_JITTER)
+
+# Heroku's router gives up on a request after 30 seconds
+timeout = 30
+graceful_timeout = 20
+
+
+def _rss_mb():
+    # Resident memory of this process, from /proc on Linux
+    try:
+        with open('/proc/self/statm') as file:
+            pages = int(file.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+
+    return pages * os.sysconf('SC_PAGE_SIZE') / 1048576
+
+
+def _dispose_engine(server):
+    if server.cfg.preload_app:
+        db.get_engine(server.app.wsgi()).dispose()
+
+
+def on_starting(server):
+    clear_metrics_dir(Config.METRICS_DIR)
+
+
+def when_ready(server):
+    # Loading the app in the master may have opened connections; a
+    # connection copied into several workers would be used by all
+    _dispose_engine(server)
+
+    if server.cfg.preload_app:
+        # Compile every template once here instead of in every worker
+        jinja_env = server.app.wsgi().jinja_env
+
+        for name in jinja_env.list_templates(extensions=['html']):
+            jinja_env.get_template(name)
+
+
+def post_fork(server, worker):
+    _dispose_engine(server)
+
+    # The pages shared with the master already count in the RSS of a
+    # new worker, so the limit is on the growth from there. Every worker
+    # gets its own limit so they are not all replaced at the same time
+    worker.max_rss_mb = (_rss_mb() or 0) + \
+        Config.GUNICORN_MAX_RSS_GROWTH_MB * (
+            1 + random.uniform(0, Config.GUNICORN_RECYCLE_JITTER))
+
+
+def post_request(worker, req, environ, resp):
+    if not Config.GUNICORN_MAX_RSS_GROWTH_MB or not worker.alive:
+        return
+
+    rss = _rss_mb()
+
+    if rss is not None and rss > worker.max_rss_mb:
+        worker.log.info(
+            f'Worker {worker.pid} uses {rss:.0f}MB, over its limit of '
+            f'{worker.max_rss_mb:.0f}MB; replacing it')
+        # Finishes the requests in progress, then exits; the master
+        # starts a new worker in its place
+        worker.alive = False
@@ -0,0 +1,238 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+from logging import Formatter
+from logging.handlers import (
+    QueueHandler,
+    QueueListener,
+    RotatingFileHandler,
+    TimedRotatingFileHandler)
+
+
+TEXT_FORMAT = \
+    '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'
+
+listener = None
+queue_handler = None
+log_config = None
+
+
+###########################################################
+#
+# LOGGING
+#
+# Request threads only put records on an in-memory queue;
+# a single background listener thread formats them and
+# writes them to stderr (which Heroku collects) or to the
+# rotating LOG_FILE, so a burst of errors never blocks a
+# request on I/O. A process forked after setup_logging (a
+# gunicorn worker of a preloaded app) starts its own
+# listener and queue, and writes to a file of its own:
+# rotating handlers are not safe across processes, so
+# workers sharing one file would rotate it under each
+# other and lose lines.
+#
+###########################################################
+
+
+class JsonFormatter(Formatter):
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'path': record.pathname,
+            'line': record.lineno
+        }
+
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    '''
+    Lets the first `burst` copies of the same message (same call site
+    and text) through per `interval` seconds and drops the rest. The
+    first copy let through in the next window reports how many were
+    dropped.
+    '''
+
+    def __init__(self, burst=5, interval=60.0, max_keys=1000):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self.max_keys = max_keys
+        self.windows = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if self.burst <= 0:
+            return True
+
+        key = (record.pathname, record.lineno, str(record.msg))
+        now = time.monotonic()
+
+        with self.lock:
+            start, count, suppressed = self.windows.get(key, (now, 0, 0))
+
+            if now - start >= self.interval:
+                start, count = now, 0
+
+            if count >= self.burst:
+                self.windows[key] = (start, count, suppressed + 1)
+                return False
+
+            if count == 0 and suppressed > 0:
+                record.msg = f'{record.getMessage()} ' \
+                    f'[{suppressed} similar messages suppressed]'
+                record.args = None
+                suppressed = 0
+
+            self.windows[key] = (start, count + 1, suppressed)
+
+            if len(self.windows) > self.max_keys:
+                self._prune(now)
+
+        return True
+
+    def _prune(self, now):
+        for key, (start, count, suppressed) in list(self.windows.items()):
+            if now - start >= self.interval and suppressed == 0:
+                del self.windows[key]
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    '''
+    QueueHandler that drops records instead of raising when the queue
+    is full, so a stalled disk can not back up into request threads.
+    '''
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def _handler(config, pid=None):
+    # stderr without a LOG_FILE; a forked worker (pid) gets its own file,
+    # e.g. error.1234.log
+    filename = config['LOG_FILE']
+
+    if filename and pid is not None:
+        root, extension = os.path.splitext(filename)
+        filename = f'{root}.{pid}{extension}'
+
+    if not filename:
+        handler = logging.StreamHandler(sys.stderr)
+    elif config['LOG_ROTATION'] == 'time':
+        handler = TimedRotatingFileHandler(
+            filename,
+            when=config['LOG_ROTATE_WHEN'],
+            backupCount=config['LOG_BACKUP_COUNT'],
+            delay=True)
+    else:
+        handler = RotatingFileHandler(
+            filename,
+            maxBytes=config['LOG_MAX_BYTES'],
+            backupCount=config['LOG_BACKUP_COUNT'],
+            delay=True)
+
+    if config['LOG_FORMAT'] == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(Formatter(TEXT_FORMAT))
+
+    return handler
+
+
+def setup_logging(app):
+    global listener, queue_handler, log_config
+
+    # An app created again (the tests, a reused factory) replaces the
+    # handler and the listener of the previous one instead of adding more
+    stop_logging()
+
+    for previous in list(app.logger.handlers):
+        if isinstance(previous, NonBlockingQueueHandler):
+            app.logger.removeHandler(previous)
+
+    config = log_config = app.config
+    level = logging.getLevelName(config['LOG_LEVEL'])
+
+    log_queue = queue.Queue(maxsize=config['LOG_QUEUE_SIZE'])
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    queue_handler.setLevel(level)
+    queue_handler.addFilter(RateLimitFilter(
+        config['LOG_RATE_LIMIT_BURST'],
+        config['LOG_RATE_LIMIT_INTERVAL']))
+
+    handler = _handler(config)
+    handler.setLevel(level)
+
+    app.logger.setLevel(level)
+    app.logger.addHandler(queue_handler)
+
+    listener = QueueListener(
+        log_queue, handler, respect_handler_level=True)
+    listener.start()
+    atexit.unregister(stop_logging)
+    atexit.register(stop_logging)
+
+    return listener
+
+
+def _restart_logging_after_fork():
+    # Only the thread that called fork() survives in the child, so the
+    # listener thread is gone; the queue may also have been locked by it
+    global listener
+
+    if listener is None:
+        return
+
+    log_queue = queue.Queue(maxsize=listener.queue.maxsize)
+    queue_handler.queue = log_queue
+    handlers = listener.handlers
+
+    if log_config['LOG_FILE']:
+        # The inherited handler stays the parent's, on the shared file
+        handlers = []
+
+        for inherited in listener.handlers:
+            handler = _handler(log_config, os.getpid())
+            handler.setLevel(inherited.level)
+            handlers.append(handler)
+
+    listener = QueueListener(
+        log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+
+
+def stop_logging():
+    # Flushes the records still in the queue, joins the listener and
+    # closes its handlers
+    global listener
+
+    if listener is not None:
+        listener.stop()
+
+        for handler in listener.handlers:
+            handler.close()
+
+        listener = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_restart_logging_after_fork)
@@ -1,13 +1,125 @@
-from flask_script import Manager
+import json
+import time
+from flask import current_app
+from flask_script import (
+    Manager,
+    prompt_bool)
 from flask_migrate import Migrate, MigrateCommand
 
-from app import app, db
+from app import create_app
+from assets import build_assets
+from datagen import generate_dataset
+from models import CustomerStats, Product, db
+from replenishment import suggest_purchase_orders
 
-migrate = Migrate(app, db)
-manager = Manager(app)
+migrate = Migrate(db=db)
+
+
+def _create_app():
+    app = create_app()
+    migrate.init_app(app)
+    return app
+
+
+manager = Manager(_create_app)
 
 manager.add_command('db', MigrateCommand)
 
 
+def _parse_markdown_rules(rules):
+    # "1:50,3:25" -> [(1, 50), (3, 25)]
+    parsed = []
+
+    for rule in rules.split(','):
+        days, percent = rule.strip().split(':', 1)
+        days, percent = int(days), int(percent)
+
+        if days < 0 or not 0 < percent < 100:
+            raise ValueError(f'Invalid markdown rule "{rule}"')
+
+        parsed.append((days, percent))
+
+    return parsed
+
+
+@manager.option(
+    '-r', '--rules', dest='rules', default=None,
+    help='Comma separated days:percent pairs, e.g. "1:50,3:25"')
+def markdown(rules=None):
+    """Mark down the price of products close to their best before date.
+
+    Meant to be run once a day, e.g. from the Heroku Scheduler:
+    python manage.py markdown
+    """
+    rules = _parse_markdown_rules(
+        rules or current_app.config['MARKDOWN_RULES'])
+    count = Product().apply_markdowns_to_products(rules)
+    current_app.logger.info(f'Markdown job repriced {count} products')
+    print(f'{count} products marked down')
+
+
+@manager.option(
+    '-w', '--window', dest='window_days', type=int, default=None,
+    help='Days of sales history used to compute the velocity')
+@manager.option(
+    '-c', '--cover', dest='cover_days', type=int, default=None,
+    help='Days of stock to hold on top of the supplier lead time')
+def replenish(window_days=None, cover_days=None):
+    """Print the suggested purchase orders, grouped by supplier, as JSON"""
+    orders = suggest_purchase_orders(
+        db,
+        window_days or current_app.config['REPLENISH_WINDOW_DAYS'],
+        cover_days or current_app.config['REPLENISH_COVER_DAYS'])
+    print(json.dumps(orders, indent=2))
+
+
+@manager.command
+def stats():
+    """Recompute the lifetime stats of every customer from the purchases.
+
+    The app keeps them up to date; only needed after purchases were
+    changed outside of it, e.g. straight in the database
+    """
+    count = CustomerStats().rebuild_customer_stats()
+    print(f'Stats of {count} customers rebuilt')
+
+
+@manager.option(
+    '-s', '--scale', dest='scale', type=float, default=1.0,
+    help='1 is 10,000 products, 100,000 customers and 1M purchases')
+@manager.option(
+    '-d', '--days', dest='days', type=int, default=365,
+    help='Days of purchase history, ending today')
+@manager.option(
+    '--seed', dest='seed', type=int, default=0,
+    help='Random seed, the same seed gives the same dataset')
+@manager.option(
+    '-y', '--yes', dest='yes', action='store_true',
+    help='Do not ask for confirmation')
+def generate(scale=1.0, days=365, seed=0, yes=False):
+    """Replace all data with a generated dataset of the given scale"""
+    if not yes and not prompt_bool(
+            f'This deletes all data in {db.engine.url.database}. Continue'):
+        return
+
+    start = time.perf_counter()
+    counts = generate_dataset(db, scale, seed, days)
+    print(f'{sum(counts.values())} rows generated in '
+          f'{time.perf_counter() - start:.1f}s')
+
+
+@manager.option(
+    '-d', '--directory', dest='directory', default=None,
+    help='Static folder to build, the app\'s static/ by default')
+def assets(directory=None):
+    """Build the fingerprinted and precompressed static assets.
+
+    Run on every deploy, after the static files change; on Heroku
+    bin/post_compile runs it at the end of the build
+    """
+    manifest = build_assets(directory or current_app.static_folder)
+    print(f'{len(manifest)} assets built')
+
+
 if __name__ == '__main__':
     manager.run()
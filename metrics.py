@@ -0,0 +1,284 @@
+import atexit
+import glob
+import hmac
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from flask import (
+    Response,
+    abort,
+    g,
+    has_request_context,
+    request)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (
+    1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+METRICS_RULE = '/metrics'
+
+
+###########################################################
+#
+# REQUEST METRICS
+#
+# Each worker keeps its own counters in memory and dumps
+# them to METRICS_DIR every METRICS_FLUSH_INTERVAL seconds.
+# /metrics merges the files of every gunicorn worker and
+# renders them in the Prometheus text format.
+#
+###########################################################
+
+
+class RequestMetrics(object):
+    def __init__(self, directory=None, flush_interval=5.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.last_flush = time.monotonic()
+        self.reset()
+
+    def reset(self):
+        self.requests = {}
+        self.histograms = {}
+
+    def observe(
+            self, endpoint, method, status, seconds, size,
+            queries, db_seconds):
+        with self.lock:
+            key = (endpoint, method, str(status))
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+            key = (endpoint, method)
+            self._observe('http_request_duration_seconds',
+                          LATENCY_BUCKETS, key, seconds)
+            if size is not None:
+                self._observe('http_response_size_bytes',
+                              SIZE_BUCKETS, key, size)
+            self._observe('db_queries_per_request',
+                          QUERY_BUCKETS, key, queries)
+            self._observe('db_seconds_per_request',
+                          LATENCY_BUCKETS, key, db_seconds)
+
+            now = time.monotonic()
+            due = now - self.last_flush >= self.flush_interval
+            if due:
+                self.last_flush = now
+
+        if due:
+            self.flush()
+
+    def _observe(self, name, buckets, key, value):
+        # [count per bucket..., +Inf count, sum]
+        series = self.histograms.setdefault(name, {})
+        values = series.get(key)
+
+        if values is None:
+            values = series[key] = [0] * (len(buckets) + 1) + [0.0]
+
+        values[bisect_left(buckets, value)] += 1
+        values[-1] += value
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'requests': [
+                    [list(key), count]
+                    for key, count in self.requests.items()],
+                'histograms': {
+                    name: [[list(key), list(values)]
+                           for key, values in series.items()]
+                    for name, series in self.histograms.items()}
+            }
+
+    def flush(self):
+        if self.directory is None:
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f'worker-{os.getpid()}.json')
+
+        # Write then rename so /metrics never reads a half-written file
+        with open(f'{path}.tmp', 'w') as file:
+            json.dump(self.snapshot(), file)
+        os.replace(f'{path}.tmp', path)
+
+    def collect(self):
+        # Merge the snapshots of every worker, this one taken live
+        snapshots = [self.snapshot()]
+
+        if self.directory is not None:
+            own = os.path.join(self.directory, f'worker-{os.getpid()}.json')
+
+            for path in glob.glob(
+                    os.path.join(self.directory, 'worker-*.json')):
+                if path == own:
+                    continue
+                try:
+                    with open(path) as file:
+                        snapshots.append(json.load(file))
+                except (OSError, ValueError):
+                    continue
+
+        requests = {}
+        histograms = {}
+
+        for snapshot in snapshots:
+            for key, count in snapshot['requests']:
+                key = tuple(key)
+                requests[key] = requests.get(key, 0) + count
+
+            for name, series in snapshot['histograms'].items():
+                merged = histograms.setdefault(name, {})
+                for key, values in series:
+                    key = tuple(key)
+                    if key in merged:
+                        merged[key] = [
+                            a + b for a, b in zip(merged[key], values)]
+                    else:
+                        merged[key] = list(values)
+
+        return requests, histograms
+
+    def render(self):
+        requests, histograms = self.collect()
+        lines = [
+            '# HELP http_requests_total Requests handled, by endpoint',
+            '# TYPE http_requests_total counter']
+
+        for (endpoint, method, status), count in sorted(requests.items()):
+            lines.append(
+                f'http_requests_total{{endpoint="{endpoint}",'
+                f'method="{method}",status="{status}"}} {count}')
+
+        for name, buckets in (
+                ('http_request_duration_seconds', LATENCY_BUCKETS),
+                ('http_response_size_bytes', SIZE_BUCKETS),
+                ('db_queries_per_request', QUERY_BUCKETS),
+                ('db_seconds_per_request', LATENCY_BUCKETS)):
+            lines.append(f'# TYPE {name} histogram')
+
+            for (endpoint, method), values in sorted(
+                    histograms.get(name, {}).items()):
+                labels = f'endpoint="{endpoint}",method="{method}"'
+                cumulative = 0
+
+                for bound, count in zip(buckets, values):
+                    cumulative += count
+                    lines.append(
+                        f'{name}_bucket{{{labels},le="{bound}"}} '
+                        f'{cumulative}')
+
+                cumulative += values[len(buckets)]
+                lines.append(
+                    f'{name}_bucket{{{labels},le="+Inf"}} {cumulative}')
+                lines.append(f'{name}_sum{{{labels}}} {values[-1]}')
+                lines.append(f'{name}_count{{{labels}}} {cumulative}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def clear_metrics_dir(directory):
+    # Run by the gunicorn master before it starts the workers, so the
+    # counters of a previous deployment are not added to the new ones
+    for path in glob.glob(os.path.join(directory, 'worker-*.json*')):
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+
+
+def _before_cursor_execute(
+        conn, cursor, statement, parameters, context, executemany):
+    # Kept on the statement's execution context, not the connection: a
+    # statement that fails never reaches after_cursor_execute, and its
+    # start time goes away with it
+    if context is not None:
+        context._metrics_start = time.perf_counter()
+
+
+def _after_cursor_execute(
+        conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, '_metrics_start', None)
+
+    if start is not None and has_request_context() and \
+            'metrics_start' in g:
+        g.metrics_queries += 1
+        g.metrics_db_seconds += time.perf_counter() - start
+
+
+def setup_metrics(app):
+    metrics = RequestMetrics(
+        app.config['METRICS_DIR'], app.config['METRICS_FLUSH_INTERVAL'])
+    allowed = set(app.config['METRICS_ALLOWED_IPS'].split(','))
+
+    if not event.contains(
+            Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(
+            Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(
+            Engine, 'after_cursor_execute', _after_cursor_execute)
+
+    @app.before_request
+    def start_request_metrics():
+        g.metrics_start = time.perf_counter()
+        g.metrics_queries = 0
+        g.metrics_db_seconds = 0.0
+
+    @app.after_request
+    def record_request_metrics(response):
+        if 'metrics_start' not in g or request.path == METRICS_RULE:
+            return response
+
+        endpoint = request.url_rule.rule \
+            if request.url_rule is not None else 'unmatched'
+
+        # The size of a streamed response is unknown until it is sent;
+        # asking for it would read the whole stream into memory
+        size = None if response.is_streamed \
+            else response.calculate_content_length()
+
+        metrics.observe(
+            endpoint,
+            request.method,
+            response.status_code,
+            time.perf_counter() - g.metrics_start,
+            size,
+            g.metrics_queries,
+            g.metrics_db_seconds)
+
+        return response
+
+    def authorized():
+        # Behind a router (Heroku) no request comes from a loopback
+        # address: the scraper sends METRICS_TOKEN as a bearer token
+        if request.remote_addr in allowed:
+            return True
+
+        token = app.config['METRICS_TOKEN']
+        header = request.headers.get('Authorization', '')
+        scheme, _, credentials = header.partition(' ')
+
+        return bool(token) and scheme.lower() == 'bearer' and \
+            hmac.compare_digest(credentials.strip(), token)
+
+    @app.route(METRICS_RULE, methods=['GET'])
+    def metrics_endpoint():
+        if not authorized():
+            abort(403)
+
+        return Response(
+            metrics.render(),
+            mimetype='text/plain; version=0.0.4')
+
+    app.extensions['request_metrics'] = metrics
+    atexit.register(metrics.flush)
+
+    return metrics
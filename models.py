@@ -1,5 +1,10 @@
+import math
+import sqlite3
 import sys
-from flask_migrate import Migrate
+from datetime import (
+    date,
+    timedelta)
+from decimal import Decimal
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import (
     BigInteger,
@@ -8,29 +13,77 @@ from sqlalchemy import (
     Date,
     Float,
     ForeignKey,
+    Index,
     Integer,
+    Numeric,
+    Sequence,
     String,
     Table,
+    cast,
+    event,
+    inspect,
     text)
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import relationship
+from sqlalchemy.orm.exc import StaleDataError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.sql.expression import func
+from sqlalchemy.sql.expression import (
+    and_,
+    case,
+    exists,
+    false,
+    func,
+    literal,
+    or_,
+    select,
+    true)
 
 # Local imports...
-from exceptions import EmptyEntityError
+from exceptions import (
+    EmptyEntityError,
+    UnknownEntityError,
+    VersionConflictError)
 
 
 Base = declarative_base()
 metadata = Base.metadata
 
 db = SQLAlchemy()
-migrate = Migrate()
 
 
 def setup_db(app):
     db.app = app
     db.init_app(app)
-    migrate.init_app(app, db)
+
+    if not event.contains(Engine, 'connect', _sqlite_connect):
+        event.listen(Engine, 'connect', _sqlite_connect)
+        event.listen(Engine, 'begin', _sqlite_begin)
+
+
+def flush_session(session):
+    # Writes the rows a caller outside the models added, changed or
+    # deleted in session, and publishes them as the model methods do
+    _flush_and_publish(session)
+
+
+def _sqlite_ceil(value):
+    return None if value is None else math.ceil(value)
+
+
+def _sqlite_connect(dbapi_connection, connection_record):
+    # Make SQLite behave like PostgreSQL where the app relies on it:
+    # enforced foreign keys, ceil(), and transactions begun by
+    # SQLAlchemy (not the driver) so that savepoints work
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.isolation_level = None
+        dbapi_connection.execute('PRAGMA foreign_keys = ON')
+        dbapi_connection.create_function('ceil', 1, _sqlite_ceil)
+
+
+def _sqlite_begin(connection):
+    if connection.dialect.name == 'sqlite':
+        connection.execute('BEGIN')
 
 
 class Aisle(Base):
@@ -38,6 +91,11 @@ class Aisle(Base):
 
     aisle_number = Column(Integer, primary_key=True)
     name = Column(String(255), nullable=False)
+    # Bumped by every write to the row: an edit made against an older
+    # version is refused instead of overwriting the newer one
+    version = Column(Integer, nullable=False, server_default=text("1"))
+
+    __mapper_args__ = {'version_id_col': version}
 
     products = relationship('Product', secondary='aislecontains')
 
@@ -72,9 +130,9 @@ class Aisle(Base):
 
         return self
 
-    def update_aisle_in_database(self):
+    def update_aisle_in_database(self, version=None):
         try:
-            _update_entity(db)
+            _update_entity(db, self, version)
         except BaseException:
             raise
 
@@ -97,11 +155,15 @@ class Aisle(Base):
 class Customer(Base):
     __tablename__ = 'customers'
 
-    id = Column(Integer, primary_key=True, server_default=text(
-        "nextval('customers_id_seq'::regclass)"))
+    id = Column(
+        Integer, Sequence('customers_id_seq', optional=True),
+        primary_key=True)
     name = Column(String(255))
     phone = Column(String(255))
     email = Column(String(255))
+    version = Column(Integer, nullable=False, server_default=text("1"))
+
+    __mapper_args__ = {'version_id_col': version}
 
     def __init__(self, id=0, name=None, phone=None, email=None):
         self.id = id
@@ -136,13 +198,16 @@ class Customer(Base):
 
         return self
 
-    def update_customer_in_database(self):
+    def patch_customer_in_database(self, values, version=None):
+        data = None
+
         try:
-            _update_entity(db)
+            data = _patch_entity(
+                db, Customer, 'id', self.id, values, version=version)
         except BaseException:
             raise
 
-        return self
+        return data
 
     def get_next_customer_id(self):
         id = 0
@@ -154,17 +219,75 @@ class Customer(Base):
 
         return id
 
+    def list_one_or_none_customer_with_stats(self):
+        data = None
+
+        try:
+            data = _list_customer_with_stats(db, self.id)
+        except BaseException:
+            raise
+
+        return data
+
+    def list_purchase_history(self, after=None, limit=25):
+        data = None
+
+        try:
+            data = _list_purchase_history(db, self.id, after, limit)
+        except BaseException:
+            raise
+
+        return data
+
     def __repr__(self):
         return f'Customer("{self.id}","{self.name}",\
             "{self.phone}","{self.email}")'
 
 
+class CustomerStats(Base):
+    __tablename__ = 'customer_stats'
+
+    # Kept up to date by every purchase written through the models, so
+    # the lifetime stats of a customer are read without their history
+    customer_id = Column(ForeignKey('customers.id'), primary_key=True)
+    order_count = Column(Integer, nullable=False, server_default=text("0"))
+    lifetime_spend = Column(
+        Float(53), nullable=False, server_default=text("0"))
+    last_purchase_date = Column(Date)
+
+    def __init__(
+            self, customer_id=0, order_count=0, lifetime_spend=0,
+            last_purchase_date=None):
+        self.customer_id = customer_id
+        self.order_count = order_count
+        self.lifetime_spend = lifetime_spend
+        self.last_purchase_date = last_purchase_date
+
+    def rebuild_customer_stats(self):
+        count = 0
+
+        try:
+            count = _rebuild_customer_stats(db)
+        except BaseException:
+            raise
+
+        return count
+
+    def __repr__(self):
+        return f'CustomerStats("{self.customer_id}","{self.order_count}",\
+            "{self.lifetime_spend}","{self.last_purchase_date}")'
+
+
 class Department(Base):
     __tablename__ = 'departments'
 
-    id = Column(Integer, primary_key=True, server_default=text(
-        "nextval('departments_id_seq'::regclass)"))
+    id = Column(
+        Integer, Sequence('departments_id_seq', optional=True),
+        primary_key=True)
     name = Column(String(255))
+    version = Column(Integer, nullable=False, server_default=text("1"))
+
+    __mapper_args__ = {'version_id_col': version}
 
     def __init__(self, id=0, name=None):
         self.id = id
@@ -197,13 +320,16 @@ class Department(Base):
 
         return self
 
-    def update_department_in_database(self):
+    def patch_department_in_database(self, values, version=None):
+        data = None
+
         try:
-            _update_entity(db)
+            data = _patch_entity(
+                db, Department, 'id', self.id, values, version=version)
         except BaseException:
             raise
 
-        return self
+        return data
 
     def get_next_department_id(self):
         id = 0
@@ -222,11 +348,17 @@ class Department(Base):
 class Supplier(Base):
     __tablename__ = 'suppliers'
 
-    id = Column(Integer, primary_key=True, server_default=text(
-        "nextval('suppliers_id_seq'::regclass)"))
+    id = Column(
+        Integer, Sequence('suppliers_id_seq', optional=True),
+        primary_key=True)
     name = Column(String(255), nullable=False)
     address = Column(String(255))
     phone = Column(String(255), nullable=False)
+    lead_time_days = Column(
+        Integer, nullable=False, server_default=text("3"))
+    version = Column(Integer, nullable=False, server_default=text("1"))
+
+    __mapper_args__ = {'version_id_col': version}
 
     def __init__(self, id=0, name=None, address=None, phone=None):
         self.id = id
@@ -261,13 +393,16 @@ class Supplier(Base):
 
         return self
 
-    def update_supplier_in_database(self):
+    def patch_supplier_in_database(self, values, version=None):
+        data = None
+
         try:
-            _update_entity(db)
+            data = _patch_entity(
+                db, Supplier, 'id', self.id, values, version=version)
         except BaseException:
             raise
 
-        return self
+        return data
 
     def get_next_supplier_id(self):
         id = 0
@@ -287,8 +422,9 @@ class Supplier(Base):
 class Employee(Base):
     __tablename__ = 'employees'
 
-    id = Column(Integer, primary_key=True, server_default=text(
-        "nextval('employees_id_seq'::regclass)"))
+    id = Column(
+        Integer, Sequence('employees_id_seq', optional=True),
+        primary_key=True)
     name = Column(String(255), nullable=False)
     department_id = Column(ForeignKey('departments.id'))
     title = Column(String(255))
@@ -296,7 +432,10 @@ class Employee(Base):
     address = Column(String(255))
     phone = Column(String(255))
     wage = Column(Integer)
-    is_active = Column(Boolean, nullable=False, server_default=text("true"))
+    is_active = Column(Boolean, nullable=False, server_default=true())
+    version = Column(Integer, nullable=False, server_default=text("1"))
+
+    __mapper_args__ = {'version_id_col': version}
 
     department = relationship('Department')
 
@@ -304,14 +443,14 @@ class Employee(Base):
             self, id=0, name=None, department_id=0, title=None,
             emp_number=0, address=None, phone=None, wage=0,
             is_active=False):
-        self.id = id,
-        self.name = name,
-        self.department_id = department_id,
-        self.title = title,
-        self.emp_number = emp_number,
-        self.address = address,
-        self.phone = phone,
-        self.wage = wage,
+        self.id = id
+        self.name = name
+        self.department_id = department_id
+        self.title = title
+        self.emp_number = emp_number
+        self.address = address
+        self.phone = phone
+        self.wage = wage
         self.is_active = is_active
 
     def list_all_employees(self, entity=None):
@@ -323,11 +462,13 @@ class Employee(Base):
 
         return data
 
-    def list_all_employees_filtered(self, entity2=None):
+    def list_all_employees_filtered(
+            self, entity2=None, include_inactive=True):
         data = None
         try:
             data = _list_all_data_filtered(
-                db, entity=Employee(), entity2=Department())
+                db, entity=Employee(), entity2=Department(),
+                include_inactive=include_inactive)
         except BaseException:
             raise
 
@@ -351,13 +492,16 @@ class Employee(Base):
 
         return self
 
-    def update_employee_in_database(self):
+    def patch_employee_in_database(self, values, version=None):
+        data = None
+
         try:
-            _update_entity(db)
+            data = _patch_entity(
+                db, Employee, 'id', self.id, values, version=version)
         except BaseException:
             raise
 
-        return self
+        return data
 
     def get_next_employee_id(self):
         id = 0
@@ -369,6 +513,28 @@ class Employee(Base):
 
         return id
 
+    def preview_bulk_change(
+            self, action, targets, mode=None, value=None, limit=20):
+        data = None
+
+        try:
+            data = _preview_employee_change(
+                db, action, targets, mode, value, limit)
+        except BaseException:
+            raise
+
+        return data
+
+    def apply_bulk_change(self, action, targets, mode=None, value=None):
+        count = 0
+
+        try:
+            count = _apply_employee_change(db, action, targets, mode, value)
+        except BaseException:
+            raise
+
+        return count
+
     def __repr__(self):
         return f'Employee("{self.id}","{self.name}",\
             "{self.department_id}","{self.title}",\
@@ -379,8 +545,9 @@ class Employee(Base):
 class Product(Base):
     __tablename__ = 'products'
 
-    id = Column(Integer, primary_key=True, server_default=text(
-        "nextval('products_id_seq'::regclass)"))
+    id = Column(
+        Integer, Sequence('products_id_seq', optional=True),
+        primary_key=True)
     name = Column(String(255), nullable=False)
     price_per_cost_unit = Column(Float(53), nullable=False)
     cost_unit = Column(String(255), nullable=False)
@@ -394,28 +561,39 @@ class Product(Base):
     organic = Column(Integer)
     cut = Column(String(255))
     animal = Column(String(255))
+    markdown_percent = Column(
+        Integer, nullable=False, server_default=text("0"))
+    version = Column(Integer, nullable=False, server_default=text("1"))
+
+    __mapper_args__ = {'version_id_col': version}
 
     department = relationship('Department')
     suppliers = relationship('Supplier', secondary='providedby')
 
+    __table_args__ = (
+        Index(
+            'products_best_before_date_idx',
+            'best_before_date', 'department_id'),
+    )
+
     def __init__(
             self, id=0, name=None, price_per_cost_unit=0, cost_unit=None,
             department_id=0, quantity_in_stock=0, brand=None,
             production_date=None, best_before_date=None, plu=0,
             upc=0, organic=0, cut=None, animal=None):
         self.id = id
-        self.name = name,
-        self.price_per_cost_unit = price_per_cost_unit,
-        self.cost_unit = cost_unit,
-        self.department_id = department_id,
-        self.quantity_in_stock = quantity_in_stock,
-        self.brand = brand,
-        self.production_date = production_date,
-        self.best_before_date = best_before_date,
-        self.plu = plu,
-        self.upc = upc,
-        self.organic = organic,
-        self.cut = cut,
+        self.name = name
+        self.price_per_cost_unit = price_per_cost_unit
+        self.cost_unit = cost_unit
+        self.department_id = department_id
+        self.quantity_in_stock = quantity_in_stock
+        self.brand = brand
+        self.production_date = production_date
+        self.best_before_date = best_before_date
+        self.plu = plu
+        self.upc = upc
+        self.organic = organic
+        self.cut = cut
         self.animal = animal
 
     def list_all_products(self):
@@ -458,12 +636,28 @@ class Product(Base):
 
         return self
 
-    def update_product_in_database(self):
+    def patch_product_in_database(
+            self, values, aisle_number=None, version=None):
+        data = None
+
         try:
-            _update_entity(db)
+            data = _patch_entity(
+                db, Product, 'id', self.id, values, aisle_number, version)
         except BaseException:
             raise
 
+        return data
+
+    def restart_markdown(self, priced=False):
+        # The ORM counterpart of _unmarked() for a product being written:
+        # priced when the write sets the price itself
+        if not priced and self.markdown_percent:
+            self.price_per_cost_unit = round(
+                float(self.price_per_cost_unit) * 100 /
+                (100 - self.markdown_percent), 2)
+
+        self.markdown_percent = 0
+
         return self
 
     def get_next_product_id(self):
@@ -476,6 +670,49 @@ class Product(Base):
 
         return id
 
+    def list_expiring_products(
+            self, days=0, department_id=None, aisle_number=None):
+        data = None
+
+        try:
+            data = _list_expiring_data(
+                db, days, department_id, aisle_number)
+        except BaseException:
+            raise
+
+        return data
+
+    def apply_markdowns_to_products(self, rules):
+        count = 0
+
+        try:
+            count = _apply_markdowns(db, rules)
+        except BaseException:
+            raise
+
+        return count
+
+    def preview_adjustment(self, field, mode, value, targets, limit=20):
+        data = None
+
+        try:
+            data = _preview_adjustment(
+                db, field, mode, value, targets, limit)
+        except BaseException:
+            raise
+
+        return data
+
+    def apply_adjustment(self, field, mode, value, targets):
+        count = 0
+
+        try:
+            count = _apply_adjustment(db, field, mode, value, targets)
+        except BaseException:
+            raise
+
+        return count
+
     def __repr__(self):
         return f'Product("{self.id}","{self.name}",\
             "{self.price_per_cost_unit}","{self.cost_unit}",\
@@ -489,13 +726,38 @@ class Product(Base):
 class Providesdelivery(Base):
     __tablename__ = 'providesdelivery'
 
-    delivery_id = Column(Integer, primary_key=True, server_default=text(
-        "nextval('providesdelivery_delivery_id_seq'::regclass)"))
+    delivery_id = Column(
+        Integer, Sequence('providesdelivery_delivery_id_seq', optional=True),
+        primary_key=True)
     supplier_id = Column(ForeignKey('suppliers.id'), nullable=False)
 
     supplier = relationship('Supplier')
     products = relationship('Product', secondary='receivedfrom')
 
+    def __init__(self, delivery_id=0, supplier_id=0):
+        self.delivery_id = delivery_id
+        self.supplier_id = supplier_id
+
+    def get_next_delivery_id(self):
+        id = 0
+
+        try:
+            id = _get_next_id(db, Providesdelivery())
+        except BaseException:
+            raise
+
+        return id
+
+    def receive_delivery_into_database(self, lines):
+        try:
+            _receive_delivery(db, self, lines)
+        except UnknownEntityError:
+            raise
+        except BaseException:
+            raise
+
+        return self
+
     def __repr__(self):
         return f'Providesdelivery("{self.delivery_id}","{self.supplier_id}")'
 
@@ -563,8 +825,9 @@ t_providedby = Table(
 class Purchase(Base):
     __tablename__ = 'purchases'
 
-    id = Column(Integer, primary_key=True, nullable=False, server_default=text(
-        "nextval('purchases_id_seq'::regclass)"))
+    # Part of a composite key, so no SERIAL is implied: the sequence is
+    # fired explicitly on PostgreSQL and ignored by SQLite
+    id = Column(Integer, Sequence('purchases_id_seq'), primary_key=True)
     product_id = Column(ForeignKey(
         'products.id'), primary_key=True, nullable=False)
     quantity = Column(Integer)
@@ -572,11 +835,23 @@ class Purchase(Base):
     purchase_date = Column(Date)
     total = Column(Float(53))
     is_cancelled = Column(
-        Boolean, nullable=False, server_default=text("false"))
+        Boolean, nullable=False, server_default=false())
+    version = Column(Integer, nullable=False, server_default=text("1"))
+
+    __mapper_args__ = {'version_id_col': version}
 
     customer = relationship('Customer')
     product = relationship('Product')
 
+    __table_args__ = (
+        Index(
+            'purchases_purchase_date_idx',
+            'purchase_date', 'product_id'),
+        Index(
+            'purchases_customer_id_idx',
+            'customer_id', 'id', 'product_id'),
+    )
+
     def __init__(
             self, id=0, product_id=0, quantity=0, customer_id=0,
             purchase_date=None, total=0, is_cancelled=False):
@@ -608,20 +883,50 @@ class Purchase(Base):
         return data
 
     def add_purchase_to_database(self):
+        # With group commit on, the purchase is written along with those
+        # of concurrent requests; either way it is committed on return
+        writer = db.app.extensions.get('purchase_writer')
+
         try:
-            _add_entity(db, self)
+            if writer is None:
+                _add_purchase(db, self)
+            else:
+                writer.write(self)
         except BaseException:
             raise
 
         return self
 
-    def update_purchase_in_database(self):
+    def add_purchases_to_database(self, purchases):
         try:
-            _update_entity(db)
+            _add_purchases(db, purchases)
         except BaseException:
             raise
 
-        return self
+        return purchases
+
+    def patch_purchase_in_database(
+            self, values, product_id=None, version=None):
+        data = None
+
+        try:
+            data = _patch_purchase(db, self.id, product_id, values, version)
+        except BaseException:
+            raise
+
+        return data
+
+    def cancel_purchases(
+            self, purchase_ids=None, purchase_date=None, product_ids=None):
+        data = None
+
+        try:
+            data = _cancel_purchases(db, _purchase_filter(
+                purchase_ids, purchase_date, product_ids))
+        except BaseException:
+            raise
+
+        return data
 
     def get_next_purchase_id(self):
         id = 0
@@ -652,11 +957,12 @@ t_receivedfrom = Table(
 class EmployeeDto(Employee):
     def __init__(
         self, department_name, id, name, department_id, title,
-            emp_number, address, phone, wage, is_active):
+            emp_number, address, phone, wage, is_active, version=1):
         super().__init__(
             id, name, department_id, title,
             emp_number, address, phone, wage, is_active)
         self.department_name = department_name
+        self.version = version
 
         def __repr__(self):
             return f'EmployeeDto("{super.__repr__()}" and\
@@ -668,7 +974,7 @@ class ProductDto(Product):
         self, department_name, id, name, price_per_cost_unit,
             cost_unit, department_id, quantity_in_stock, brand,
             production_date, best_before_date, plu, upc, organic, cut,
-            animal, aisle_name, aisle_number):
+            animal, aisle_name, aisle_number, version=1):
         super().__init__(
             id, name, price_per_cost_unit,
             cost_unit, department_id, quantity_in_stock, brand,
@@ -677,6 +983,7 @@ class ProductDto(Product):
         self.department_name = department_name
         self.aisle_name = aisle_name
         self.aisle_number = aisle_number
+        self.version = version
 
         def __repr__(self):
             return f'ProductDto("{super.__repr__()}" and\
@@ -717,7 +1024,8 @@ def _list_all_data(db, entity) -> list:
 
 
 def _list_all_data_filtered(
-        db, entity, entity2=None, entity3=None, entity4=None) -> list:
+        db, entity, entity2=None, entity3=None, entity4=None,
+        include_inactive=True) -> list:
     data = None
     model = type(entity)
     model_name = model.__name__
@@ -731,10 +1039,14 @@ def _list_all_data_filtered(
                 aisle_number=int(entity.aisle_number)).all()
         elif model_name == 'Employee':
             model2 = type(entity2)
-            data = session.query(
+            query = session.query(
                 model, model2).filter(
-                model.department_id == model2.id).order_by(
-                model2.id, model.id).all()
+                model.department_id == model2.id)
+
+            if not include_inactive:
+                query = query.filter(model.is_active.is_(true()))
+
+            data = query.order_by(model2.id, model.id).all()
         elif model_name == 'Product':
             model2 = type(entity2)
             model3 = type(entity3)
@@ -784,12 +1096,127 @@ def _list_one_or_none_data(db, entity, entity2=None):
     return data
 
 
+def _pending_changes(session):
+    # (row, op, changed columns) of the rows the next flush writes; the
+    # columns of an insert are all those it sets
+    pending = [(row, 'insert', None) for row in session.new]
+
+    for row in session.dirty:
+        state = inspect(row)
+        columns = [
+            attr.key for attr in state.mapper.column_attrs
+            if state.attrs[attr.key].history.has_changes()]
+
+        if columns:
+            pending.append((row, 'update', columns))
+
+    pending.extend((row, 'delete', []) for row in session.deleted)
+
+    return pending
+
+
+def _changefeed():
+    return db.app.extensions.get('changefeed')
+
+
+def _publish_changes(session, changes):
+    # changes are dicts of entity (the table), op, id, changes and
+    # version, published before the commit that makes them real
+    feed = _changefeed()
+
+    if feed is not None and changes:
+        feed.publish(session, changes)
+
+
+def _row_changes(table, rows, columns, op='update') -> list:
+    # Change events of rows holding the key, the columns and the version
+    keys = [column.name for column in table.primary_key.columns]
+
+    return [{
+        'entity': table.name,
+        'op': op,
+        'id': row[keys[0]] if len(keys) == 1 else [row[key] for key in keys],
+        'changes': {column: row[column] for column in columns},
+        'version': row['version']
+    } for row in rows]
+
+
+def _select_rows(session, table, keys) -> list:
+    # The rows of the given primary keys, read back to be published
+    columns = list(table.primary_key.columns)
+
+    if not keys:
+        return []
+
+    if len(columns) == 1:
+        matched = columns[0].in_([key[0] for key in keys])
+    else:
+        matched = or_(*(
+            and_(*(column == value for column, value in zip(columns, key)))
+            for key in keys))
+
+    return session.execute(select([table]).where(matched)).fetchall()
+
+
+def _bulk_update(session, table, criteria, values):
+    # One set-based UPDATE; returns the number of rows updated and the
+    # rows themselves when the change feed is on, to publish them. They
+    # come from RETURNING on PostgreSQL; elsewhere their keys are read
+    # first, in the same transaction, which SQLite runs alone
+    update = table.update().where(criteria).values(values)
+
+    if _changefeed() is None:
+        return session.execute(update).rowcount, []
+
+    if session.get_bind().dialect.name == 'postgresql':
+        rows = session.execute(update.returning(*table.c)).fetchall()
+        return len(rows), rows
+
+    keys = session.execute(
+        select(list(table.primary_key.columns)).where(criteria)).fetchall()
+    count = session.execute(update).rowcount
+
+    return count, _select_rows(session, table, keys)
+
+
+def _flush_and_publish(session):
+    # Flushes the session, then publishes what the flush wrote, with
+    # the versions it gave the rows
+    pending = _pending_changes(session) \
+        if 'changefeed' in db.app.extensions else []
+
+    session.flush()
+
+    changes = []
+
+    for row, op, columns in pending:
+        state = inspect(row)
+        values = state.dict
+        key = state.identity or ()
+
+        if columns is None:
+            columns = [attr.key for attr in state.mapper.column_attrs]
+
+        changes.append({
+            'entity': state.mapper.local_table.name,
+            'op': op,
+            'id': key[0] if len(key) == 1 else list(key),
+            'changes': {
+                column: values[column] for column in columns
+                if column in values and column != 'version'},
+            'version': values.get('version')
+        })
+
+    _publish_changes(session, changes)
+
+
 def _add_entity(db, entity):
     session = db.session
     session.expire_on_commit = False
 
     try:
         session.add(entity)
+        _flush_and_publish(session)
         session.commit()
     except BaseException as e:
         tb = sys.exc_info()
@@ -798,12 +1225,24 @@ def _add_entity(db, entity):
         raise
 
 
-def _update_entity(db):
+def _update_entity(db, entity, version=None):
+    # With a version, the entity must still be at it when read; a write
+    # after that is caught by the UPDATE, which checks the version read
     session = db.session
     session.expire_on_commit = False
 
     try:
+        if version is not None and version != entity.version:
+            raise _version_conflict(version, entity.version)
+
+        _flush_and_publish(session)
         session.commit()
+    except VersionConflictError:
+        session.rollback()
+        raise
+    except StaleDataError:
+        session.rollback()
+        raise _version_conflict(version, None)
     except BaseException as e:
         tb = sys.exc_info()
         db.app.logger.info(e.with_traceback(tb[2]))
@@ -811,6 +1250,117 @@ def _update_entity(db):
         raise
 
 
+def _update_rows(session, table, criteria, values, check=None) -> list:
+    # One UPDATE of only the given columns, returning the updated rows,
+    # none when no row matches. check, e.g. the expected version, must
+    # hold as well. Other backends than PostgreSQL have no RETURNING, so
+    # the rows are read back after the UPDATE
+    matched = criteria if check is None else and_(criteria, check)
+
+    if values and session.get_bind().dialect.name == 'postgresql':
+        return session.execute(table.update().where(matched).values(
+            values).returning(*table.c)).fetchall()
+
+    if values:
+        if session.execute(table.update().where(matched).values(
+                values)).rowcount == 0:
+            return []
+
+        # The version was bumped: the check no longer holds
+        matched = criteria
+
+    return session.execute(select([table]).where(matched)).fetchall()
+
+
+def _version_conflict(version, current):
+    description = 'the data was changed by someone else'
+
+    if version is not None:
+        description = f'Version {version} is out of date; {description}'
+
+    if current is not None:
+        description += f' and is now at version {current}'
+
+    return VersionConflictError({
+        "code": "version_conflict",
+        "description": description[0].upper() + description[1:],
+        "version": current
+    }, 409)
+
+
+def _check_version(session, table, criteria, version):
+    # Nothing matched the expected version: refused if the row is there
+    # at another one, so a stale edit fails instead of overwriting it
+    current = session.execute(
+        select([table.c.version]).where(criteria)).scalar()
+
+    if current is not None:
+        raise _version_conflict(version, current)
+
+
+def _patch_entity(
+        db, model, key, id, values, aisle_number=None, version=None):
+    # Partial update of one row by its key, without reading it first;
+    # returns the updated row, or None when there is no such row. With
+    # a version, the row is only updated if it is still at that version.
+    session = db.session
+    session.expire_on_commit = False
+
+    table = model.__table__
+    criteria = table.c[key] == id
+    check = None if version is None else table.c.version == version
+
+    if model is Product:
+        values = _unmarked(values)
+
+    if values or aisle_number is not None:
+        values = dict(values, version=table.c.version + 1)
+
+    try:
+        rows = _update_rows(session, table, criteria, values, check)
+
+        if not rows and check is not None:
+            _check_version(session, table, criteria, version)
+
+        # A product sits in one aisle, moved along with the update
+        if rows and aisle_number is not None:
+            moved = session.execute(t_aislecontains.update().where(
+                t_aislecontains.c.product_id == id).values(
+                aisle_number=aisle_number)).rowcount
+
+            if moved == 0:
+                session.execute(t_aislecontains.insert().values(
+                    aisle_number=aisle_number, product_id=id))
+
+        if rows and values:
+            changes = {
+                column: rows[0][column] for column in values
+                if column != 'version'}
+
+            if aisle_number is not None:
+                changes['aisle_number'] = aisle_number
+
+            _publish_changes(session, [{
+                'entity': table.name,
+                'op': 'update',
+                'id': id,
+                'changes': changes,
+                'version': rows[0]['version']
+            }])
+
+        session.commit()
+    except VersionConflictError:
+        session.rollback()
+        raise
+    except BaseException as e:
+        tb = sys.exc_info()
+        db.app.logger.info(e.with_traceback(tb[2]))
+        session.rollback()
+        raise
+
+    return rows[0] if rows else None
+
+
 def _delete_entity(db, entity=None, entity_list=None):
     session = db.session
     session.expire_on_commit = False
@@ -830,6 +1380,7 @@ def _delete_entity(db, entity=None, entity_list=None):
         elif entity is not None:
             session.delete(entity)
 
+        _flush_and_publish(session)
         session.commit()
     except EmptyEntityError:
         raise
@@ -851,12 +1402,860 @@ def _get_next_id(db, entity) -> int:
         if model is Aisle or model is AisleContains:
             max_id = session.query(func.max(model.aisle_name)).one_or_none()
             id = max_id[0] + 1
+        elif model is Providesdelivery:
+            max_id = session.query(
+                func.max(model.delivery_id)).one_or_none()
+            id = (max_id[0] or 0) + 1
         else:
             max_id = session.query(func.max(model.id)).one_or_none()
-            id = max_id[0] + 1
+            id = (max_id[0] or 0) + 1
     except BaseException as e:
         tb = sys.exc_info()
         db.app.logger.info(e.with_traceback(tb[2]))
         raise
 
     return id
+
+
+def _list_expiring_data(db, days, department_id=None, aisle_number=None):
+    # Products whose best before date falls within the next N days,
+    # joined to their department and aisle. The query is returned
+    # un-executed with yield_per() so the caller can stream it in
+    # batches instead of loading the whole result set at once.
+    data = None
+    today = date.today()
+
+    session = db.session
+    session.expire_on_commit = False
+
+    try:
+        query = session.query(
+            Product.id,
+            Product.name,
+            Product.department_id,
+            Department.name.label('department_name'),
+            t_aislecontains.c.aisle_number,
+            Aisle.name.label('aisle_name'),
+            Product.quantity_in_stock,
+            Product.price_per_cost_unit,
+            Product.markdown_percent,
+            Product.best_before_date).join(
+            Department, Product.department_id == Department.id).outerjoin(
+            t_aislecontains,
+            Product.id == t_aislecontains.c.product_id).outerjoin(
+            Aisle,
+            t_aislecontains.c.aisle_number == Aisle.aisle_number).filter(
+            Product.best_before_date.between(
+                today, today + timedelta(days=days)))
+
+        if department_id is not None:
+            query = query.filter(Product.department_id == department_id)
+
+        if aisle_number is not None:
+            query = query.filter(
+                t_aislecontains.c.aisle_number == aisle_number)
+
+        data = query.order_by(
+            Product.best_before_date,
+            Product.department_id,
+            Product.id).yield_per(500)
+    except BaseException as e:
+        tb = sys.exc_info()
+        db.app.logger.info(e.with_traceback(tb[2]))
+        raise
+
+    return data
+
+
+def _full_price():
+    # The price of a product before its markdown, as a SQL expression
+    return case([(
+        Product.markdown_percent > 0,
+        func.round(cast(
+            Product.price_per_cost_unit * 100 /
+            (100 - Product.markdown_percent), Numeric), 2))],
+        else_=Product.price_per_cost_unit)
+
+
+def _unmarked(values) -> dict:
+    # A written price is the full price, and a new best before date means
+    # new stock, sold at the full price again: either way the markdown
+    # starts over, and the markdown job applies it again when it is due
+    if 'price_per_cost_unit' not in values and \
+            'best_before_date' not in values:
+        return values
+
+    unmarked = {'price_per_cost_unit': _full_price()}
+    unmarked.update(values)
+    unmarked['markdown_percent'] = 0
+
+    return unmarked
+
+
+def _apply_markdowns(db, rules) -> int:
+    # rules is a list of (days, percent) tuples. Each rule is applied
+    # with one set-based UPDATE over the products expiring within its
+    # window. markdown_percent remembers the discount already applied so
+    # re-running the job is idempotent and a deeper rule replaces a
+    # shallower one instead of compounding on top of it.
+    count = 0
+    today = date.today()
+
+    session = db.session
+    session.expire_on_commit = False
+
+    table = Product.__table__
+
+    try:
+        for days, percent in sorted(rules, key=lambda rule: -rule[1]):
+            updated, rows = _bulk_update(session, table, and_(
+                Product.best_before_date.between(
+                    today, today + timedelta(days=days)),
+                Product.markdown_percent < percent), {
+                    'price_per_cost_unit': func.round(cast(
+                        Product.price_per_cost_unit * (100 - percent) /
+                        (100 - Product.markdown_percent), Numeric), 2),
+                    'markdown_percent': percent,
+                    'version': Product.version + 1
+            })
+
+            count += updated
+            _publish_changes(session, _row_changes(
+                table, rows, ['price_per_cost_unit', 'markdown_percent']))
+
+        session.commit()
+    except BaseException as e:
+        tb = sys.exc_info()
+        db.app.logger.info(e.with_traceback(tb[2]))
+        session.rollback()
+        raise
+
+    return count
+
+
+def _adjusted_value(field, mode, value):
+    # New value of the adjusted column, as a SQL expression. Prices are
+    # rounded to the cent, and neither prices nor stock go below zero.
+    if field == 'price':
+        column = Product.price_per_cost_unit
+
+        if mode == 'percent':
+            adjusted = func.round(cast(
+                column * (100 + value) / 100.0, Numeric), 2)
+        elif mode == 'amount':
+            adjusted = func.round(cast(column + value, Numeric), 2)
+        else:
+            adjusted = literal(value)
+    else:
+        column = func.coalesce(Product.quantity_in_stock, 0)
+
+        if mode == 'amount':
+            adjusted = column + value
+        else:
+            adjusted = literal(value)
+
+    return case([(adjusted < 0, 0)], else_=adjusted)
+
+
+def _adjustment_filter(targets):
+    # targets may hold department_id, brand, aisle_number and
+    # product_ids; a product must match all of them
+    criteria = []
+
+    if targets.get('department_id') is not None:
+        criteria.append(Product.department_id == targets['department_id'])
+
+    if targets.get('brand') is not None:
+        criteria.append(Product.brand == targets['brand'])
+
+    if targets.get('aisle_number') is not None:
+        criteria.append(Product.id.in_(
+            select([t_aislecontains.c.product_id]).where(
+                t_aislecontains.c.aisle_number ==
+                targets['aisle_number'])))
+
+    if targets.get('product_ids') is not None:
+        criteria.append(Product.id.in_(targets['product_ids']))
+
+    return and_(true(), *criteria)
+
+
+def _plain(value):
+    # NUMERIC results come back as Decimal, which jsonify can not encode
+    return float(value) if isinstance(value, Decimal) else value
+
+
+def _preview_update(
+        db, model, before, after, criteria, limit, totals=True) -> dict:
+    # One query: the first rows a set-based update would change with
+    # their old and new values, and, through window functions over the
+    # whole match, the number of rows and the totals before and after
+    columns = [
+        model.id,
+        model.name,
+        before.label('before'),
+        after.label('after'),
+        func.count().over().label('matched')]
+
+    if totals:
+        columns += [
+            func.sum(before).over().label('total_before'),
+            func.sum(after).over().label('total_after')]
+
+    session = db.session
+    session.expire_on_commit = False
+
+    try:
+        rows = session.query(*columns).filter(criteria).order_by(
+            model.id).limit(limit).all()
+    except BaseException as e:
+        tb = sys.exc_info()
+        db.app.logger.info(e.with_traceback(tb[2]))
+        raise
+
+    preview = {
+        'matched': rows[0].matched if rows else 0,
+        'rows': [{
+            'id': row.id,
+            'name': row.name,
+            'before': _plain(row.before),
+            'after': _plain(row.after)
+        } for row in rows]
+    }
+
+    if totals:
+        preview['total_before'] = _plain(rows[0].total_before) if rows else 0
+        preview['total_after'] = _plain(rows[0].total_after) if rows else 0
+
+    return preview
+
+
+def _apply_update(db, model, column, after, criteria, extra=None) -> int:
+    # A single UPDATE over every matching row, whatever their number;
+    # extra holds the values of further columns set along with it
+    session = db.session
+    session.expire_on_commit = False
+
+    table = model.__table__
+    values = dict(extra or {}, **{column.key: after})
+
+    try:
+        count, rows = _bulk_update(
+            session, table, criteria, dict(values, version=model.version + 1))
+
+        _publish_changes(session, _row_changes(table, rows, list(values)))
+        session.commit()
+    except BaseException as e:
+        tb = sys.exc_info()
+        db.app.logger.info(e.with_traceback(tb[2]))
+        session.rollback()
+        raise
+
+    return count
+
+
+def _preview_adjustment(db, field, mode, value, targets, limit) -> dict:
+    before = Product.price_per_cost_unit if field == 'price' \
+        else func.coalesce(Product.quantity_in_stock, 0)
+
+    return _preview_update(
+        db, Product, before, _adjusted_value(field, mode, value),
+        _adjustment_filter(targets), limit)
+
+
+def _apply_adjustment(db, field, mode, value, targets) -> int:
+    column = Product.price_per_cost_unit if field == 'price' \
+        else Product.quantity_in_stock
+
+    # An adjusted price is the new full price, see _unmarked()
+    extra = {'markdown_percent': 0} if field == 'price' else None
+
+    return _apply_update(
+        db, Product, column, _adjusted_value(field, mode, value),
+        _adjustment_filter(targets), extra)
+
+
+def _employee_change(action, mode=None, value=None):
+    # Column changed by a bulk employee action, its new value as a SQL
+    # expression, and the rows the action would actually change
+    if action == 'transfer':
+        return (
+            Employee.department_id,
+            literal(value),
+            or_(Employee.department_id.is_(None),
+                Employee.department_id != value))
+
+    if action in ('deactivate', 'reactivate'):
+        active = action == 'reactivate'
+
+        return (
+            Employee.is_active,
+            true() if active else false(),
+            Employee.is_active.is_(false() if active else true()))
+
+    wage = func.coalesce(Employee.wage, 0)
+
+    if mode == 'percent':
+        adjusted = cast(func.round(wage * (100 + value) / 100.0), Integer)
+    elif mode == 'amount':
+        adjusted = wage + value
+    else:
+        adjusted = literal(value)
+
+    return (
+        Employee.wage,
+        case([(adjusted < 0, 0)], else_=adjusted),
+        true())
+
+
+def _employee_filter(targets):
+    # targets may hold department_id and employee_ids; an employee must
+    # match both
+    criteria = []
+
+    if targets.get('department_id') is not None:
+        criteria.append(Employee.department_id == targets['department_id'])
+
+    if targets.get('employee_ids') is not None:
+        criteria.append(Employee.id.in_(targets['employee_ids']))
+
+    return and_(true(), *criteria)
+
+
+def _preview_employee_change(
+        db, action, targets, mode, value, limit) -> dict:
+    column, after, changed = _employee_change(action, mode, value)
+    before = func.coalesce(column, 0) if action == 'wage' else column
+
+    return _preview_update(
+        db, Employee, before, after,
+        and_(_employee_filter(targets), changed), limit,
+        totals=action == 'wage')
+
+
+def _apply_employee_change(db, action, targets, mode, value) -> int:
+    column, after, changed = _employee_change(action, mode, value)
+
+    return _apply_update(
+        db, Employee, column, after,
+        and_(_employee_filter(targets), changed))
+
+
+def _customer_stats_query(customer_ids=None):
+    # Lifetime stats computed from the purchase history; an order is one
+    # purchase id, whatever its number of product lines, and cancelled
+    # purchases do not count
+    query = select([
+        Purchase.customer_id,
+        func.count(func.distinct(Purchase.id)),
+        func.coalesce(func.sum(Purchase.total), 0),
+        func.max(Purchase.purchase_date)]).where(and_(
+            Purchase.customer_id.isnot(None),
+            Purchase.is_cancelled.is_(false())))
+
+    if customer_ids is not None:
+        query = query.where(Purchase.customer_id.in_(customer_ids))
+
+    return query.group_by(Purchase.customer_id)
+
+
+def _refresh_customer_stats(session, customer_ids=None) -> int:
+    # Recomputes the stats rows of the given customers, or of everyone,
+    # from their history
+    stats = CustomerStats.__table__
+    delete = stats.delete()
+
+    if customer_ids is not None:
+        delete = delete.where(stats.c.customer_id.in_(customer_ids))
+
+    session.execute(delete)
+
+    return session.execute(stats.insert().from_select(
+        ['customer_id', 'order_count', 'lifetime_spend',
+         'last_purchase_date'],
+        _customer_stats_query(customer_ids))).rowcount
+
+
+def _record_purchase(session, customer_id, orders, spend, purchase_date):
+    # Adds one purchase to the stats of its customer in place: a single
+    # UPDATE, or an INSERT for the first purchase of the customer
+    values = {
+        CustomerStats.order_count: CustomerStats.order_count + orders,
+        CustomerStats.lifetime_spend: CustomerStats.lifetime_spend + spend
+    }
+
+    if purchase_date is not None:
+        values[CustomerStats.last_purchase_date] = case([(
+            or_(CustomerStats.last_purchase_date.is_(None),
+                CustomerStats.last_purchase_date < purchase_date),
+            purchase_date)], else_=CustomerStats.last_purchase_date)
+
+    query = session.query(CustomerStats).filter(
+        CustomerStats.customer_id == customer_id)
+
+    if query.update(values, synchronize_session=False) > 0:
+        return
+
+    try:
+        with session.begin_nested():
+            session.add(CustomerStats(
+                customer_id, orders, spend, purchase_date))
+    except IntegrityError:
+        # Another request added the first purchase of the customer
+        query.update(values, synchronize_session=False)
+
+
+def _assign_purchase_ids(db, purchases) -> list:
+    # Purchases without an id are new orders: they take the next ids in
+    # the transaction writing them, which for a group commit is a single
+    # thread of the worker, so grouped purchases never share one
+    fresh = [purchase for purchase in purchases if purchase.id is None]
+
+    if fresh:
+        next_id = _get_next_id(db, Purchase())
+
+        for n, purchase in enumerate(fresh):
+            purchase.id = next_id + n
+
+    return fresh
+
+
+def _add_purchase(db, purchase):
+    # The purchase and the stats of its customer are written in one
+    # transaction, so the stats never need the history to be re-read
+    session = db.session
+    session.expire_on_commit = False
+
+    fresh = []
+
+    try:
+        fresh = _assign_purchase_ids(db, [purchase])
+        counted = purchase.customer_id is not None and \
+            not purchase.is_cancelled
+
+        # An order is one purchase id: a purchase that took a new id is a
+        # new order, while a further product line of a known order is not
+        new_order = counted and (len(fresh) > 0 or not session.query(
+            exists().where(and_(
+                Purchase.id == purchase.id,
+                Purchase.customer_id == purchase.customer_id,
+                Purchase.is_cancelled.is_(false())))).scalar())
+
+        session.add(purchase)
+        _flush_and_publish(session)
+
+        if counted:
+            _record_purchase(
+                session, purchase.customer_id, 1 if new_order else 0,
+                float(purchase.total or 0), purchase.purchase_date)
+
+        session.commit()
+    except BaseException as e:
+        tb = sys.exc_info()
+        db.app.logger.info(e.with_traceback(tb[2]))
+        session.rollback()
+
+        # The id taken is rolled back with the purchase
+        if fresh:
+            purchase.id = None
+        raise
+
+
+def _add_purchases(db, purchases):
+    # A group of purchases in one transaction, so it costs one commit:
+    # one multi-row INSERT, and one stats UPDATE per customer with the
+    # orders, spend and last date of all their purchases in the group
+    session = db.session
+    session.expire_on_commit = False
+
+    table = Purchase.__table__
+    counted = [
+        purchase for purchase in purchases
+        if purchase.customer_id is not None and not purchase.is_cancelled]
+    fresh = []
+
+    try:
+        fresh = _assign_purchase_ids(db, purchases)
+
+        # A further product line of a known order is not a new order;
+        # the known ones are read before the INSERT adds the group's.
+        # Purchases that took new ids are new orders, with nothing to read
+        orders = set()
+        known = {p.id for p in counted if p not in fresh}
+
+        if known:
+            orders.update(
+                (row.id, row.customer_id) for row in session.execute(
+                    select([table.c.id, table.c.customer_id]).where(and_(
+                        table.c.id.in_(known),
+                        table.c.is_cancelled.is_(false())))))
+
+        rows = [{
+            'id': purchase.id,
+            'product_id': purchase.product_id,
+            'quantity': purchase.quantity,
+            'customer_id': purchase.customer_id,
+            'purchase_date': purchase.purchase_date,
+            'total': purchase.total,
+            'is_cancelled': bool(purchase.is_cancelled)
+        } for purchase in purchases]
+
+        session.execute(table.insert().values(rows))
+        _publish_changes(session, _row_changes(
+            table, [dict(row, version=1) for row in rows], list(rows[0]),
+            'insert'))
+
+        stats = {}
+
+        for purchase in counted:
+            count, spend, last = stats.get(
+                purchase.customer_id, (0, 0.0, None))
+
+            if (purchase.id, purchase.customer_id) not in orders:
+                orders.add((purchase.id, purchase.customer_id))
+                count += 1
+
+            if purchase.purchase_date is not None and \
+                    (last is None or purchase.purchase_date > last):
+                last = purchase.purchase_date
+
+            stats[purchase.customer_id] = \
+                (count, spend + float(purchase.total or 0), last)
+
+        for customer_id, (count, spend, last) in stats.items():
+            _record_purchase(session, customer_id, count, spend, last)
+
+        session.commit()
+    except BaseException as e:
+        tb = sys.exc_info()
+        db.app.logger.info(e.with_traceback(tb[2]))
+        session.rollback()
+
+        # Retried one by one, the purchases of a failed group take new ids
+        for purchase in fresh:
+            purchase.id = None
+        raise
+
+
+def _patch_purchase(db, purchase_id, product_id, values, version=None):
+    # Partial update of the lines of an order, or of one of its lines,
+    # without reading them first. The stats of the customers the lines
+    # belong to are recomputed when the customer, total or date change;
+    # only a change of customer needs the old one read beforehand. Each
+    # line has its own version, so one is only checked for one line.
+    session = db.session
+    session.expire_on_commit = False
+
+    table = Purchase.__table__
+    criteria = table.c.id == purchase_id
+    check = None if version is None else table.c.version == version
+
+    if product_id is not None:
+        criteria = and_(criteria, table.c.product_id == product_id)
+
+    if values:
+        values = dict(values, version=table.c.version + 1)
+
+    try:
+        customer_ids = set()
+
+        if 'customer_id' in values:
+            customer_ids.update(
+                row.customer_id for row in session.execute(
+                    select([table.c.customer_id]).where(
+                        criteria).distinct()))
+
+        rows = _update_rows(session, table, criteria, values, check)
+
+        if not rows and check is not None:
+            _check_version(session, table, criteria, version)
+
+        if rows and values:
+            _publish_changes(session, _row_changes(
+                table, rows, [column for column in values
+                              if column != 'version']))
+
+        if rows and set(values) & {'customer_id', 'total', 'purchase_date'}:
+            customer_ids.update(row.customer_id for row in rows)
+            customer_ids.discard(None)
+
+            if customer_ids:
+                _refresh_customer_stats(session, list(customer_ids))
+
+        session.commit()
+    except VersionConflictError:
+        session.rollback()
+        raise
+    except BaseException as e:
+        tb = sys.exc_info()
+        db.app.logger.info(e.with_traceback(tb[2]))
+        session.rollback()
+        raise
+
+    return rows
+
+
+def _rebuild_customer_stats(db) -> int:
+    session = db.session
+    session.expire_on_commit = False
+
+    try:
+        count = _refresh_customer_stats(session)
+        session.commit()
+    except BaseException as e:
+        tb = sys.exc_info()
+        db.app.logger.info(e.with_traceback(tb[2]))
+        session.rollback()
+        raise
+
+    return count
+
+
+def _cancel_purchases(db, criteria) -> dict:
+    # Cancels the purchase lines matching criteria that are not cancelled
+    # yet, in one transaction: one UPDATE marks them cancelled, one
+    # UPDATE puts their quantities back in stock, summed per product,
+    # and the stats of their customers are recomputed. A line cancelled
+    # by a concurrent request is skipped, so its stock is restored once.
+    session = db.session
+    session.expire_on_commit = False
+
+    purchases = Purchase.__table__
+    cancel = purchases.update().where(and_(
+        criteria, purchases.c.is_cancelled.is_(false()))).values(
+        is_cancelled=True, version=purchases.c.version + 1)
+    columns = [
+        purchases.c.id, purchases.c.product_id, purchases.c.quantity,
+        purchases.c.customer_id, purchases.c.total, purchases.c.version]
+
+    try:
+        if session.get_bind().dialect.name == 'postgresql':
+            lines = session.execute(cancel.returning(*columns)).fetchall()
+            bumped = 0
+        else:
+            # No RETURNING: the lines are read first, in the same
+            # transaction, which SQLite runs alone
+            lines = session.execute(select(columns).where(and_(
+                criteria, purchases.c.is_cancelled.is_(false())))).fetchall()
+            session.execute(cancel)
+            bumped = 1
+
+        _publish_changes(session, _row_changes(purchases, [
+            dict(line, is_cancelled=True, version=line.version + bumped)
+            for line in lines], ['is_cancelled']))
+
+        restock = {}
+        customer_ids = set()
+
+        for line in lines:
+            restock[line.product_id] = \
+                restock.get(line.product_id, 0) + (line.quantity or 0)
+
+            if line.customer_id is not None:
+                customer_ids.add(line.customer_id)
+
+        if restock:
+            _increment_stock(session, restock)
+
+        if customer_ids:
+            _refresh_customer_stats(session, list(customer_ids))
+
+        session.commit()
+    except BaseException as e:
+        tb = sys.exc_info()
+        db.app.logger.info(e.with_traceback(tb[2]))
+        session.rollback()
+        raise
+
+    return {
+        'purchases': len(lines),
+        'products': len(restock),
+        'quantity': sum(restock.values()),
+        'refund': round(sum(line.total or 0 for line in lines), 2)
+    }
+
+
+def _purchase_filter(purchase_ids=None, purchase_date=None, product_ids=None):
+    # A purchase line must match all of the given criteria
+    purchases = Purchase.__table__
+    criteria = []
+
+    if purchase_ids is not None:
+        criteria.append(purchases.c.id.in_(purchase_ids))
+
+    if purchase_date is not None:
+        criteria.append(purchases.c.purchase_date == purchase_date)
+
+    if product_ids is not None:
+        criteria.append(purchases.c.product_id.in_(product_ids))
+
+    return and_(true(), *criteria)
+
+
+def _list_customer_with_stats(db, customer_id):
+    # (customer, stats) in one query; stats is None until the customer's
+    # first purchase
+    data = None
+
+    session = db.session
+    session.expire_on_commit = False
+
+    try:
+        data = session.query(Customer, CustomerStats).outerjoin(
+            CustomerStats,
+            CustomerStats.customer_id == Customer.id).filter(
+            Customer.id == customer_id).one_or_none()
+    except BaseException as e:
+        tb = sys.exc_info()
+        db.app.logger.info(e.with_traceback(tb[2]))
+        raise
+
+    return data
+
+
+def _list_purchase_history(db, customer_id, after=None, limit=25) -> list:
+    # One page of the purchases of a customer, newest first. Pages are
+    # keyed on the (id, product_id) of the last row of the previous page
+    # rather than an OFFSET, so any page is read straight from
+    # purchases_customer_id_idx however long the history is.
+    data = None
+
+    session = db.session
+    session.expire_on_commit = False
+
+    try:
+        query = session.query(
+            Purchase.id,
+            Purchase.product_id,
+            Product.name.label('product_name'),
+            Purchase.quantity,
+            Purchase.total,
+            Purchase.purchase_date,
+            Purchase.is_cancelled).join(
+            Product, Purchase.product_id == Product.id).filter(
+            Purchase.customer_id == customer_id)
+
+        if after is not None:
+            id, product_id = after
+            query = query.filter(or_(
+                Purchase.id < id,
+                and_(Purchase.id == id, Purchase.product_id < product_id)))
+
+        data = query.order_by(
+            Purchase.id.desc(),
+            Purchase.product_id.desc()).limit(limit).all()
+    except BaseException as e:
+        tb = sys.exc_info()
+        db.app.logger.info(e.with_traceback(tb[2]))
+        raise
+
+    return data
+
+
+def _increment_stock(session, lines, new_stock=False) -> int:
+    # lines maps product_id -> quantity to add to the stock. One UPDATE
+    # joined against the lines, whatever their number; returns the
+    # number of products updated.
+    product_ids = list(lines.keys())
+    quantities = [lines[product_id] for product_id in product_ids]
+    table = Product.__table__
+    publish = _changefeed() is not None
+    columns = ['quantity_in_stock']
+    restock = ''
+
+    # Delivered stock is new stock, sold at the full price again; as
+    # _unmarked() does, the markdown starts over. Refunded stock is not
+    if new_stock:
+        columns += ['price_per_cost_unit', 'markdown_percent']
+        restock = (
+            'price_per_cost_unit = CASE WHEN markdown_percent > 0 '
+            'THEN ROUND(CAST(price_per_cost_unit * 100 / '
+            '(100 - markdown_percent) AS NUMERIC), 2) '
+            'ELSE price_per_cost_unit END, '
+            'markdown_percent = 0, ')
+
+    if session.get_bind().dialect.name == 'postgresql':
+        # With the change feed on, the new stock comes back to publish it
+        result = session.execute(text(
+            'UPDATE products '
+            'SET quantity_in_stock = '
+            'COALESCE(products.quantity_in_stock, 0) + manifest.quantity, '
+            + restock +
+            'version = products.version + 1 '
+            'FROM unnest(:product_ids, :quantities) '
+            'AS manifest(product_id, quantity) '
+            'WHERE products.id = manifest.product_id' + (
+                ' RETURNING products.id, products.version, ' + ', '.join(
+                    f'products.{column}' for column in columns)
+                if publish else '')), {
+                    'product_ids': product_ids,
+                    'quantities': quantities
+        })
+
+        if not publish:
+            return result.rowcount
+
+        rows = result.fetchall()
+    else:
+        # Other backends have no unnest: one executemany round trip
+        updated = session.execute(text(
+            'UPDATE products '
+            'SET quantity_in_stock = '
+            'COALESCE(quantity_in_stock, 0) + :quantity, '
+            + restock +
+            'version = version + 1 '
+            'WHERE id = :product_id'), [{
+                'product_id': product_id,
+                'quantity': quantity
+            } for product_id, quantity in zip(product_ids, quantities)]
+        ).rowcount
+
+        if not publish:
+            return updated
+
+        rows = _select_rows(
+            session, table, [(product_id,) for product_id in product_ids])
+
+    _publish_changes(session, _row_changes(table, rows, columns))
+
+    return len(rows)
+
+
+def _receive_delivery(db, delivery, lines):
+    # lines maps product_id -> quantity received. The delivery row, its
+    # receivedfrom links and the stock increments are written in one
+    # transaction: one multi-row INSERT for the links and one UPDATE
+    # joined against the manifest for the stock, whatever its size.
+    session = db.session
+    session.expire_on_commit = False
+
+    product_ids = list(lines.keys())
+
+    try:
+        session.add(delivery)
+        session.flush()
+
+        updated = _increment_stock(session, lines, new_stock=True)
+
+        if updated != len(product_ids):
+            raise UnknownEntityError({
+                "code": "unknown_product",
+                "description":
+                    f'{len(product_ids) - updated} products in the '
+                    f'delivery manifest do not exist'
+            }, 422)
+
+        session.execute(t_receivedfrom.insert().values([{
+            'product_id': product_id,
+            'delivery_id': delivery.delivery_id
+        } for product_id in product_ids]))
+
+        session.commit()
+    except UnknownEntityError:
+        session.rollback()
+        raise
+    except BaseException as e:
+        tb = sys.exc_info()
+        db.app.logger.info(e.with_traceback(tb[2]))
+        session.rollback()
+        raise
@@ -0,0 +1,142 @@
+import re
+import threading
+from collections import Counter
+from flask import (
+    g,
+    request)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+NPLUSONE_THRESHOLD = 5
+
+_FINGERPRINT_PATTERNS = [
+    # string literals, bind parameters and numbers become ?
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'%\(\w+\)s|%s|(?<!:):\w+'), '?'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    # IN lists of any length share one shape
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)'), '(?)'),
+    (re.compile(r'\s+'), ' ')
+]
+
+# Transaction control is not counted against the budget
+IGNORED_STATEMENTS = re.compile(
+    r'\s*(BEGIN|SAVEPOINT|RELEASE SAVEPOINT|ROLLBACK TO SAVEPOINT)\b', re.I)
+
+_local = threading.local()
+
+
+###########################################################
+#
+# QUERY BUDGET
+#
+# Records the SQL statements run by the current thread,
+# fingerprinted so that the same query issued with
+# different parameters has the same shape. The same shape
+# repeated NPLUSONE_THRESHOLD times within one request is
+# the signature of a lazy-loaded relationship being
+# walked row by row (the N+1 query problem).
+#
+###########################################################
+
+
+def fingerprint(statement):
+    statement = statement.strip()
+
+    for pattern, replacement in _FINGERPRINT_PATTERNS:
+        statement = pattern.sub(replacement, statement)
+
+    return statement
+
+
+def _recorders():
+    if not hasattr(_local, 'recorders'):
+        _local.recorders = []
+
+    return _local.recorders
+
+
+class QueryRecorder(object):
+    '''
+    Context manager collecting every statement executed by this thread
+    while it is active, e.g. in a test:
+
+        with QueryRecorder() as queries:
+            client.get('/products')
+        assert queries.count <= 5
+    '''
+
+    def __init__(self):
+        self.statements = []
+
+    def __enter__(self):
+        _recorders().append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self in _recorders():
+            _recorders().remove(self)
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def suspects(self, threshold=NPLUSONE_THRESHOLD):
+        shapes = Counter(fingerprint(s) for s in self.statements)
+
+        return [(shape, count) for shape, count in shapes.most_common()
+                if count >= threshold]
+
+
+def _after_cursor_execute(
+        conn, cursor, statement, parameters, context, executemany):
+    if IGNORED_STATEMENTS.match(statement):
+        return
+
+    for recorder in _recorders():
+        recorder.statements.append(statement)
+
+
+def setup_query_budget(app):
+    if not event.contains(
+            Engine, 'after_cursor_execute', _after_cursor_execute):
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+    if not app.config['QUERY_INSPECTOR']:
+        return
+
+    threshold = app.config['NPLUSONE_THRESHOLD']
+    budget = app.config['QUERY_BUDGET']
+
+    @app.before_request
+    def start_query_recorder():
+        g.query_recorder = QueryRecorder().__enter__()
+
+    @app.after_request
+    def check_query_budget(response):
+        recorder = g.get('query_recorder')
+
+        if recorder is None:
+            return response
+
+        response.headers['X-Query-Count'] = str(recorder.count)
+
+        for shape, count in recorder.suspects(threshold):
+            app.logger.warning(
+                f'Possible N+1 query on {request.path}: '
+                f'{count} x {shape}')
+
+        if budget and recorder.count > budget:
+            app.logger.warning(
+                f'{request.path} ran {recorder.count} queries, '
+                f'over the budget of {budget}')
+
+        return response
+
+    @app.teardown_request
+    def stop_query_recorder(exception=None):
+        recorder = g.pop('query_recorder', None)
+
+        if recorder is not None:
+            recorder.__exit__(None, None, None)
@@ -0,0 +1,103 @@
+import sys
+from datetime import (
+    date,
+    timedelta)
+from itertools import groupby
+from sqlalchemy.sql.expression import func
+
+# Local imports...
+from models import (
+    Product,
+    Purchase,
+    Supplier,
+    t_providedby)
+
+
+###########################################################
+#
+# REPLENISHMENT ENGINE
+#
+# Suggested purchase orders are computed for the whole
+# catalog with a single aggregate query: the sales velocity
+# of every product over the last window_days, the stock it
+# should hold to cover its supplier's lead time plus
+# cover_days, and the quantity to reorder, all evaluated by
+# the database in one pass instead of one query per product.
+#
+###########################################################
+
+
+def suggest_purchase_orders(
+        db, window_days=28, cover_days=7, as_of=None) -> list:
+    data = None
+    as_of = as_of or date.today()
+    since = as_of - timedelta(days=window_days)
+
+    session = db.session
+    session.expire_on_commit = False
+
+    try:
+        # Units sold per day over the window, per product
+        velocity = session.query(
+            Purchase.product_id.label('product_id'),
+            (func.sum(Purchase.quantity) / float(window_days)).label(
+                'per_day')).filter(
+            Purchase.purchase_date > since).filter(
+            Purchase.purchase_date <= as_of).filter(
+            Purchase.is_cancelled.is_(False)).group_by(
+            Purchase.product_id).subquery()
+
+        # A product provided by several suppliers is ordered from the
+        # one with the lowest id, so each product lands on one order
+        provider = session.query(
+            t_providedby.c.product_id.label('product_id'),
+            func.min(t_providedby.c.supplier_id).label(
+                'supplier_id')).group_by(
+            t_providedby.c.product_id).subquery()
+
+        target = velocity.c.per_day * (Supplier.lead_time_days + cover_days)
+        quantity = func.ceil(
+            target - func.coalesce(Product.quantity_in_stock, 0))
+
+        data = session.query(
+            Supplier.id.label('supplier_id'),
+            Supplier.name.label('supplier_name'),
+            Supplier.lead_time_days,
+            Product.id.label('product_id'),
+            Product.name.label('product_name'),
+            Product.quantity_in_stock,
+            velocity.c.per_day,
+            quantity.label('quantity')).select_from(Product).join(
+            velocity, velocity.c.product_id == Product.id).join(
+            provider, provider.c.product_id == Product.id).join(
+            Supplier, Supplier.id == provider.c.supplier_id).filter(
+            quantity > 0).order_by(
+            Supplier.id, Product.id).all()
+    except BaseException as e:
+        tb = sys.exc_info()
+        db.app.logger.info(e.with_traceback(tb[2]))
+        raise
+
+    return _group_by_supplier(data)
+
+
+def _group_by_supplier(rows) -> list:
+    orders = []
+
+    for (supplier_id, supplier_name, lead_time_days), lines in groupby(
+            rows, key=lambda row: (
+                row.supplier_id, row.supplier_name, row.lead_time_days)):
+        orders.append({
+            'supplier_id': supplier_id,
+            'supplier_name': supplier_name,
+            'lead_time_days': lead_time_days,
+            'lines': [{
+                'product_id': line.product_id,
+                'product_name': line.product_name,
+                'quantity_in_stock': line.quantity_in_stock,
+                'daily_velocity': round(float(line.per_day), 2),
+                'quantity': int(line.quantity)
+            } for line in lines]
+        })
+
+    return orders
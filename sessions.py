@@ -0,0 +1,254 @@
+import os
+import random
+import secrets
+import sqlite3
+import threading
+import time
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import (
+    SessionInterface,
+    SessionMixin)
+from werkzeug.datastructures import CallbackDict
+
+
+# Each store deletes the expired sessions on about one write in this many
+PRUNE_EVERY = 100
+
+# An unchanged session is saved again, pushing its expiry back, at most
+# this often, so a page view does not always cost a write
+REFRESH_INTERVAL = 60
+
+
+###########################################################
+#
+# SERVER-SIDE SESSIONS
+#
+# The session cookie only holds a random session id; the
+# session itself (the Auth0 profile and tokens) is kept in
+# a store and expires after SESSION_IDLE_TIMEOUT seconds
+# without a request. SESSION_STORE picks the store:
+# 'redis' (shared by several machines, needs the redis
+# package), 'cookie' (Flask's signed cookie session, the
+# default without SESSION_REDIS_URL), or, opted into,
+# 'sqlite' (a file shared by the workers of one machine
+# only: a restart or a second dyno logs users out) or
+# 'memory' (one process, for tests).
+#
+###########################################################
+
+
+class MemorySessionStore(object):
+    def __init__(self):
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def get(self, sid):
+        with self.lock:
+            entry = self.sessions.get(sid)
+
+        if entry is None or entry[1] < time.time():
+            return None
+
+        return entry[0]
+
+    def set(self, sid, data, timeout):
+        with self.lock:
+            self.sessions[sid] = (data, time.time() + timeout)
+
+            if random.randrange(PRUNE_EVERY) == 0:
+                now = time.time()
+                for key, (_, expires) in list(self.sessions.items()):
+                    if expires < now:
+                        del self.sessions[key]
+
+    def delete(self, sid):
+        with self.lock:
+            self.sessions.pop(sid, None)
+
+
+class SQLiteSessionStore(object):
+    '''
+    Sessions in a SQLite file, so every gunicorn worker of the machine
+    sees the same sessions. Each thread, and each forked process, opens
+    its own connection.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+        with self._connection() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS sessions ('
+                'sid TEXT PRIMARY KEY, data TEXT NOT NULL, '
+                'expires REAL NOT NULL)')
+
+    def _connection(self):
+        connection = getattr(self.local, 'connection', None)
+
+        if connection is None or self.local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5)
+            # Readers do not wait for a writer in WAL mode
+            connection.execute('PRAGMA journal_mode = WAL')
+            connection.execute('PRAGMA synchronous = NORMAL')
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+
+        return connection
+
+    def get(self, sid):
+        row = self._connection().execute(
+            'SELECT data FROM sessions WHERE sid = ? AND expires >= ?',
+            (sid, time.time())).fetchone()
+
+        return None if row is None else row[0]
+
+    def set(self, sid, data, timeout):
+        with self._connection() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO sessions (sid, data, expires) '
+                'VALUES (?, ?, ?)', (sid, data, time.time() + timeout))
+
+            if random.randrange(PRUNE_EVERY) == 0:
+                connection.execute(
+                    'DELETE FROM sessions WHERE expires < ?', (time.time(),))
+
+    def delete(self, sid):
+        with self._connection() as connection:
+            connection.execute('DELETE FROM sessions WHERE sid = ?', (sid,))
+
+
+class RedisSessionStore(object):
+    def __init__(self, url):
+        # Optional dependency, only needed when SESSION_STORE=redis
+        import redis
+
+        self.redis = redis.Redis.from_url(url)
+
+    def get(self, sid):
+        data = self.redis.get(f'session:{sid}')
+
+        return None if data is None else data.decode('utf-8')
+
+    def set(self, sid, data, timeout):
+        # Redis expires the key itself, nothing to prune
+        self.redis.setex(f'session:{sid}', int(timeout), data)
+
+    def delete(self, sid):
+        self.redis.delete(f'session:{sid}')
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, saved_at=0.0):
+        def on_update(self):
+            self.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.saved_at = saved_at
+        self.modified = False
+        self.accessed = False
+        self.old_sid = None
+
+    def __getitem__(self, key):
+        self.accessed = True
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        self.accessed = True
+        return super().get(key, default)
+
+    def setdefault(self, key, default=None):
+        self.accessed = True
+        return super().setdefault(key, default)
+
+    def regenerate(self):
+        # Gives the session a new id, e.g. on login, so an id planted
+        # in the browser beforehand is worthless
+        if self.sid is not None and self.old_sid is None:
+            self.old_sid = self.sid
+        self.sid = None
+        self.modified = True
+
+
+class ServerSideSessionInterface(SessionInterface):
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store, idle_timeout):
+        self.store = store
+        self.idle_timeout = idle_timeout
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.session_cookie_name)
+
+        if sid:
+            data = self.store.get(sid)
+
+            if data is not None:
+                data = self.serializer.loads(data)
+                saved_at = data.pop('_saved_at', 0.0)
+                return ServerSideSession(data, sid, saved_at)
+
+        return ServerSideSession()
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        # The page may depend on who is logged in
+        if session.accessed:
+            response.vary.add('Cookie')
+
+        if session.old_sid is not None:
+            self.store.delete(session.old_sid)
+
+        if not session:
+            if session.sid is not None and session.modified:
+                self.store.delete(session.sid)
+                response.delete_cookie(
+                    app.session_cookie_name, domain=domain, path=path)
+            return
+
+        now = time.time()
+
+        if not session.modified and \
+                now - session.saved_at < REFRESH_INTERVAL:
+            return
+
+        if session.sid is None:
+            session.sid = secrets.token_urlsafe(32)
+
+        data = dict(session, _saved_at=now)
+        self.store.set(
+            session.sid, self.serializer.dumps(data), self.idle_timeout)
+
+        response.set_cookie(
+            app.session_cookie_name,
+            session.sid,
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app))
+
+
+def setup_sessions(app):
+    kind = app.config['SESSION_STORE']
+
+    if kind == 'cookie':
+        return None
+    elif kind == 'memory':
+        store = MemorySessionStore()
+    elif kind == 'sqlite':
+        store = SQLiteSessionStore(app.config['SESSION_FILE'])
+    elif kind == 'redis':
+        store = RedisSessionStore(
+            app.config['SESSION_REDIS_URL'] or 'redis://localhost:6379/0')
+    else:
+        raise ValueError(f'Unknown SESSION_STORE "{kind}"')
+
+    app.session_interface = ServerSideSessionInterface(
+        store, app.config['SESSION_IDLE_TIMEOUT'])
+
+    return store
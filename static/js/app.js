@@ -36,3 +36,64 @@ function deleteAisle(e, id) {
         });
     }
 }
+
+/****************************/
+/******  Live changes  ******/
+/****************************/
+
+function followChanges(entity) {
+    // Rows of the table are named <entity>-<id> and their cells carry
+    // the column they show in data-column
+    if(!window.EventSource) {
+        return;
+    }
+
+    var source = new EventSource('/changes?entity=' + entity);
+
+    source.addEventListener('change', function (e) {
+        var change = JSON.parse(e.data);
+        var row = document.getElementById(entity + '-' + change.id);
+
+        // Too many rows changed at once to be sent one by one
+        if(change.op === 'reload') {
+            window.location.reload(false);
+            return;
+        }
+
+        if(change.op === 'insert') {
+            document.getElementById('changes-notice').hidden = false;
+            return;
+        }
+
+        if(!row) {
+            return;
+        }
+
+        if(change.op === 'delete') {
+            row.remove();
+            return;
+        }
+
+        if(change.changes === null) {
+            window.location.reload(false);
+            return;
+        }
+
+        Object.keys(change.changes).forEach(function (column) {
+            var cell = row.querySelector('[data-column="' + column + '"]');
+
+            if(cell) {
+                var value = change.changes[column];
+                cell.textContent = value === null ? '' : value;
+            }
+        });
+
+        // The edit form still holds the old version: saving it is
+        // refused until the page is reloaded
+        row.classList.add('table-warning');
+    });
+
+    source.addEventListener('reload', function (e) {
+        window.location.reload(false);
+    });
+}
@@ -1,9 +1,158 @@
+import csv
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
 import unittest
-from flask_sqlalchemy import SQLAlchemy
+import zlib
+from datetime import date
+from flask import Flask
+from sqlalchemy import (
+    create_engine,
+    event)
+from sqlalchemy.engine.url import make_url
 
 # Local imports...
-from app import app as test_app, test_token
-from config import Config
+from app import (
+    create_app,
+    test_token)
+from assets import (
+    build_assets,
+    setup_assets)
+from changefeed import setup_changefeed
+from config import (
+    Config,
+    SQLiteConfig)
+from group_commit import (
+    GroupCommitWriter,
+    setup_group_commit)
+from logging_config import (
+    NonBlockingQueueHandler,
+    setup_logging)
+from models import (
+    CustomerStats,
+    Product,
+    Purchase,
+    db,
+    flush_session,
+    metadata,
+    t_aislecontains)
+from query_budget import QueryRecorder
+from sessions import setup_sessions
+
+
+# Maximum number of SQL statements each listing route may run
+ROUTE_QUERY_BUDGETS = {
+    '/aisles': ('get:aisle', 1),
+    '/customers': ('get:customer', 1),
+    '/customers/1/history': ('get:customer', 2),
+    '/customers/1/purchases': ('get:customer', 2),
+    '/departments': ('get:department', 1),
+    '/employees': ('get:employee', 2),
+    '/products': ('get:product', 3),
+    '/products/expiring': ('get:product', 1),
+    '/suppliers': ('get:supplier', 1),
+    '/replenishment': ('get:supplier', 1)
+}
+
+# Set by pytest-xdist (gw0, gw1, ...) when the tests run in parallel
+WORKER = os.environ.get('PYTEST_XDIST_WORKER')
+
+# TEST_DATABASE=sqlite runs the suite on an in-memory SQLite database
+# built from the models and the rows of grocery.sql
+SQLITE = os.environ.get('TEST_DATABASE') == 'sqlite'
+SEED_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'grocery.sql')
+SEED_INSERT = re.compile(r'INSERT INTO (\w+) VALUES\s*\((.*)\);')
+SEED_DATE = re.compile(r"'(\d{2})-(\d{2})-(\d{4})'")
+
+test_app = create_app(SQLiteConfig if SQLITE else Config)
+
+# The change feed is opt-in; its tests need it whatever the environment
+test_app.config['CHANGEFEED'] = True
+setup_changefeed(test_app)
+
+# Server-side sessions are opt-in as well
+test_app.config['SESSION_STORE'] = 'memory'
+setup_sessions(test_app)
+
+
+def _worker_database(uri):
+    # Every parallel worker gets its own copy of the test database,
+    # cloned from it as a template
+    url = make_url(uri)
+    template = url.database
+    url.database = f'{template}_{WORKER}'
+
+    admin = create_engine(
+        str(url).replace(f'/{url.database}', '/postgres'),
+        isolation_level='AUTOCOMMIT')
+    admin.execute(f'DROP DATABASE IF EXISTS "{url.database}"')
+    admin.execute(
+        f'CREATE DATABASE "{url.database}" TEMPLATE "{template}"')
+    admin.dispose()
+
+    return str(url)
+
+
+def _sqlite_database(engine):
+    metadata.create_all(engine)
+
+    # grocery.sql leaves trailing columns to their defaults and writes its
+    # dates as MM-DD-YYYY; SQLite needs the columns named and ISO dates
+    with open(SEED_FILE) as file, engine.begin() as connection:
+        for line in file:
+            match = SEED_INSERT.match(line.strip())
+            if match is None:
+                continue
+
+            table, values = match.groups()
+            count = len(next(csv.reader(
+                [values], quotechar="'", skipinitialspace=True)))
+            columns = metadata.tables[table.lower()].columns.keys()[:count]
+            values = SEED_DATE.sub(r"'\3-\1-\2'", values)
+            connection.execute(
+                f'INSERT INTO {table.lower()} ({", ".join(columns)}) '
+                f'VALUES ({values})')
+
+
+def setUpModule():
+    test_app.config['SQLALCHEMY_DATABASE_URI'] = \
+        test_app.config['SQLALCHEMY_TEST_DATABASE_URI']
+
+    if SQLITE:
+        _sqlite_database(db.get_engine(test_app))
+        CustomerStats().rebuild_customer_stats()
+        db.session.remove()
+    elif WORKER is not None:
+        test_app.config['SQLALCHEMY_DATABASE_URI'] = _worker_database(
+            test_app.config['SQLALCHEMY_TEST_DATABASE_URI'])
+
+
+def tearDownModule():
+    if WORKER is not None and not SQLITE:
+        db.get_engine(test_app).dispose()
+        admin = create_engine(
+            test_app.config['SQLALCHEMY_TEST_DATABASE_URI'],
+            isolation_level='AUTOCOMMIT')
+        database = make_url(
+            test_app.config['SQLALCHEMY_DATABASE_URI']).database
+        admin.execute(f'DROP DATABASE IF EXISTS "{database}"')
+        admin.dispose()
+
+
+def _begin_savepoint(session, transaction, connection):
+    # The app's commits and rollbacks then only end a savepoint
+    if not transaction.nested:
+        session.begin_nested()
+
+
+def _restart_savepoint(session, transaction):
+    if transaction.nested and not transaction._parent.nested:
+        session.expire_all()
+        session.begin_nested()
 
 
 class TestApiMethods(unittest.TestCase):
@@ -14,21 +163,24 @@ class TestApiMethods(unittest.TestCase):
         self.app = test_app
         self.client = self.app.test_client
 
-        self.app.config.from_object(Config)
-        self.app.config["SQLALCHEMY_DATABASE_URI"] =\
-            test_app.config['SQLALCHEMY_TEST_DATABASE_URI']
-        self.app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] =\
-            test_app.config['SQLALCHEMY_TRACK_MODIFICATIONS']
+        # Every test runs inside one transaction rolled back by tearDown,
+        # so tests neither see each other's changes nor depend on order
+        self.connection = db.get_engine(self.app).connect()
+        self.connection.begin()
 
-        # binds the app to the current context
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            self.db.create_all()
+        self.app_session = db.session
+        db.session = db.create_scoped_session(
+            options={'bind': self.connection, 'binds': {}})
+        event.listen(db.session, 'after_begin', _begin_savepoint)
+        event.listen(db.session, 'after_transaction_end', _restart_savepoint)
 
     def tearDown(self):
         """Executed after each test"""
+        db.session.remove()
+        db.session = self.app_session
+        # Returning the connection to the pool rolls back the test's
+        # transaction along with any savepoint the app left open
+        self.connection.close()
 
     ###########################################################
     #
@@ -173,6 +325,24 @@ class TestApiMethods(unittest.TestCase):
         self.assertEqual(result.status_code, 302)
         self.assertEqual('/aisles' in data, True)
 
+    # Success - A form sent with a real PUT, as the Postman collection does
+    def test_put_an_aisle_form(self):
+        result = self.client().put(
+            '/aisles/1',
+            headers={
+                'authorization': test_token,
+                'test_permission': 'put:aisle'
+            },
+            data={
+                '_method': 'PUT',
+                'name': 'Tree Babies'
+            }
+        )
+
+        data = result.get_json()
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(data['aisle']['name'], 'Tree Babies')
+
     # Fail - Incorrect protocal
     def test_update_an_aisle_get(self):
         result = self.client().get(
@@ -218,6 +388,18 @@ class TestApiMethods(unittest.TestCase):
 
     # Success
     def test_delete_an_aisle_success(self):
+        self.client().post(
+            '/aisles/create',
+            headers={
+                'authorization': test_token,
+                'test_permission': 'post:aisle'
+            },
+            data={
+                'aisle_number': 10,
+                'name': 'Furniture'
+            }
+        )
+
         result = self.client().delete(
             '/aisles/10',
             headers={
@@ -384,7 +566,7 @@ class TestApiMethods(unittest.TestCase):
     # Success
     def test_update_a_customer_success(self):
         result = self.client().post(
-            '/customers/31',
+            '/customers/30',
             headers={
                 'authorization': test_token,
                 'test_permission': 'put:customer'
@@ -440,6 +622,136 @@ class TestApiMethods(unittest.TestCase):
         self.assertEqual(
             'Authentication and/or authorization error' in data, True)
 
+    ###########################################################
+    #
+    # Get / Purchase history of a Customer
+    #
+    ###########################################################
+
+    def _customer_purchases(self, customer_id, query=''):
+        return self.client().get(
+            f'/customers/{customer_id}/purchases{query}',
+            headers={
+                'authorization': test_token,
+                'test_permission': 'get:customer'
+            }
+        )
+
+    # Success
+    def test_get_customer_purchases_success(self):
+        result = self._customer_purchases(1, '?limit=5')
+
+        data = result.get_json()
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(data['customer']['name'], 'Harry Potter')
+        self.assertEqual(data['stats'], {
+            'order_count': 2,
+            'lifetime_spend': 138.46,
+            'last_purchase_date': '2017-11-07'
+        })
+        self.assertEqual(
+            [(row['id'], row['product_id']) for row in data['purchases']],
+            [(2, 425), (2, 421), (2, 307), (2, 301), (2, 3)])
+        self.assertEqual(data['next_cursor'], '2:3')
+
+        result = self._customer_purchases(1, '?limit=10&cursor=2:3')
+
+        data = result.get_json()
+        self.assertEqual(len(data['purchases']), 7)
+        self.assertEqual(data['purchases'][0]['product_id'], 211)
+        self.assertEqual(data['next_cursor'], None)
+
+    # Success - Stats follow new purchases
+    def test_add_purchase_updates_customer_stats(self):
+        with self.app.app_context():
+            for product_id, total in ((1, 3.18), (13, 2.5)):
+                Purchase(
+                    id=61, product_id=product_id, quantity=2,
+                    customer_id=4, purchase_date=date(2018, 1, 5),
+                    total=total).add_purchase_to_database()
+
+        data = self._customer_purchases(4).get_json()
+        self.assertEqual(data['stats'], {
+            'order_count': 3,
+            'lifetime_spend': 9.25,
+            'last_purchase_date': '2018-01-05'
+        })
+        self.assertEqual(len(data['purchases']), 4)
+
+    # Success - A group of purchases in one INSERT
+    def test_add_purchases_in_one_insert(self):
+        purchases = [
+            Purchase(
+                id=61, product_id=1, quantity=2, customer_id=4,
+                purchase_date=date(2018, 1, 5), total=3.18),
+            Purchase(
+                id=61, product_id=13, quantity=2, customer_id=4,
+                purchase_date=date(2018, 1, 5), total=2.5),
+            Purchase(
+                id=62, product_id=1, quantity=1, customer_id=4,
+                purchase_date=date(2018, 1, 6), total=1.59)]
+
+        with self.app.app_context(), QueryRecorder() as queries:
+            Purchase().add_purchases_to_database(purchases)
+
+        self.assertEqual(len([
+            statement for statement in queries.statements
+            if statement.startswith('INSERT INTO purchases')]), 1)
+
+        data = self._customer_purchases(4).get_json()
+        self.assertEqual(data['stats']['order_count'], 4)
+        self.assertAlmostEqual(data['stats']['lifetime_spend'], 10.84)
+        self.assertEqual(data['stats']['last_purchase_date'], '2018-01-06')
+
+    # Success - Every purchase of the route is an order of its own
+    def test_add_order_updates_customer_history(self):
+        for product, total in (
+                ('Apples (Ambrosia)', 3.18), ('Lettuce (Iceberg)', 2.5)):
+            result = self._add_order(product, 'Hermione Granger', total)
+            self.assertEqual(result.status_code, 302)
+
+        result = self.client().get(
+            '/customers/4/history',
+            headers={
+                'authorization': test_token,
+                'test_permission': 'get:customer'
+            }
+        )
+
+        data = result.data.decode('utf8')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(
+            '<td>4</td>\n            <td>9.25</td>\n'
+            '            <td>2018-01-05</td>' in data, True)
+        self.assertEqual('<td>62</td>' in data, True)
+
+    # Success - Page
+    def test_get_customer_history_success(self):
+        result = self.client().get(
+            '/customers/1/history',
+            headers={
+                'authorization': test_token,
+                'test_permission': 'get:customer'
+            }
+        )
+
+        data = result.data.decode('utf8')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual('<h2>Customer <b>Harry Potter</b>' in data, True)
+        self.assertEqual('138.46' in data, True)
+
+    # Fail - Malformed cursor
+    def test_get_customer_purchases_bad_cursor(self):
+        result = self._customer_purchases(1, '?cursor=latest')
+
+        self.assertEqual(result.status_code, 400)
+
+    # Fail - Unknown customer
+    def test_get_customer_purchases_unknown_customer(self):
+        result = self._customer_purchases(999)
+
+        self.assertEqual(result.status_code, 404)
+
     ###########################################################
     #
     # DEPARTMENT
@@ -559,7 +871,7 @@ class TestApiMethods(unittest.TestCase):
     # Success
     def test_update_a_department_success(self):
         result = self.client().post(
-            '/departments/6',
+            '/departments/5',
             headers={
                 'authorization': test_token,
                 'test_permission': 'put:department'
@@ -631,6 +943,9 @@ class TestApiMethods(unittest.TestCase):
         self.assertEqual(result.status_code, 200)
         self.assertEqual('Welcome Guest' in data, True)
         self.assertEqual('<h2>Manage <b>Employees</b>' in data, True)
+        # Fields are rendered whole, and the edit forms post to their row
+        self.assertEqual('<td>Ben Ling</td>' in data, True)
+        self.assertEqual('action="/employees/1"' in data, True)
 
     # Fail - Incorrect protocal
     def test_get_all_employees_post(self):
@@ -661,6 +976,83 @@ class TestApiMethods(unittest.TestCase):
         self.assertEqual(
             'Authentication and/or authorization error' in data, True)
 
+    ###########################################################
+    #
+    # Post / Bulk transfer, deactivation and wage change
+    #
+    ###########################################################
+
+    def _bulk_employees(self, body, permission='put:employee'):
+        return self.client().post(
+            '/employees/bulk',
+            headers={
+                'authorization': test_token,
+                'test_permission': permission
+            },
+            json=body
+        )
+
+    def _list_employees(self, query=''):
+        return self.client().get(
+            f'/employees{query}',
+            headers={
+                'authorization': test_token,
+                'test_permission': 'get:employee'
+            }
+        ).data.decode('utf8')
+
+    # Success
+    def test_bulk_deactivate_employees(self):
+        result = self._bulk_employees(
+            {'action': 'deactivate', 'employee_ids': [12]})
+
+        data = result.get_json()
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(data['employees'], 1)
+        self.assertEqual('Yuchen Lin' in self._list_employees(), False)
+        self.assertEqual(
+            'Yuchen Lin' in self._list_employees('?include_inactive=true'),
+            True)
+
+        result = self._bulk_employees(
+            {'action': 'reactivate', 'employee_ids': [12]})
+
+        self.assertEqual(result.get_json()['employees'], 1)
+        self.assertEqual('Yuchen Lin' in self._list_employees(), True)
+
+    # Success - Dry run
+    def test_bulk_wage_change_dry_run(self):
+        result = self._bulk_employees({
+            'action': 'wage',
+            'percent': 10,
+            'department_id': 4,
+            'dry_run': True
+        })
+
+        data = result.get_json()
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(data['dry_run'], True)
+        self.assertEqual(data['employees'], len(data['preview']))
+        for row in data['preview']:
+            self.assertEqual(row['after'], round(row['before'] * 1.1))
+        self.assertGreater(data['total_after'], data['total_before'])
+
+    # Fail - Unknown department
+    def test_bulk_transfer_unknown_department(self):
+        result = self._bulk_employees({
+            'action': 'transfer',
+            'to_department_id': 999,
+            'employee_ids': [12]
+        })
+
+        self.assertEqual(result.status_code, 422)
+
+    # Fail - No employees targeted
+    def test_bulk_deactivate_no_target(self):
+        result = self._bulk_employees({'action': 'deactivate'})
+
+        self.assertEqual(result.status_code, 400)
+
     ###########################################################
     #
     # Post / Add an Employee
@@ -677,7 +1069,7 @@ class TestApiMethods(unittest.TestCase):
             },
             data={
                 'name': 'Alan Kwok',
-                'department_name': '6 - Frozens',
+                'department_name': '5 - Eggs and Dairy',
                 'title': 'Butcher',
                 'emp_number': 23451234,
                 'address': '123 Main Street, Columbus, OH 43023',
@@ -746,7 +1138,7 @@ class TestApiMethods(unittest.TestCase):
     # Success
     def test_update_an_employee_success(self):
         result = self.client().post(
-            '/employees/16',
+            '/employees/15',
             headers={
                 'authorization': test_token,
                 'test_permission': 'put:employee'
@@ -837,6 +1229,9 @@ class TestApiMethods(unittest.TestCase):
         self.assertEqual(result.status_code, 200)
         self.assertEqual('Welcome Guest' in data, True)
         self.assertEqual('<h2>Manage <b>Products</b>' in data, True)
+        # Fields are rendered whole, and the edit forms post to their row
+        self.assertEqual('>Apples (Ambrosia)</td>' in data, True)
+        self.assertEqual('action="/products/1"' in data, True)
 
     # Fail - Incorrect protocal
     def test_get_all_products_post(self):
@@ -973,7 +1368,7 @@ class TestApiMethods(unittest.TestCase):
     # Success
     def test_update_a_product_success(self):
         result = self.client().post(
-            '/products/426',
+            '/products/425',
             headers={
                 'authorization': test_token,
                 'test_permission': 'put:product'
@@ -1064,6 +1459,279 @@ class TestApiMethods(unittest.TestCase):
         self.assertEqual(
             'Authentication and/or authorization error' in data, True)
 
+    ###########################################################
+    #
+    # Patch / Partial update of a Product
+    #
+    ###########################################################
+
+    def _patch_product(self, product_id, body):
+        return self.client().patch(
+            f'/products/{product_id}',
+            headers={
+                'authorization': test_token,
+                'test_permission': 'put:product'
+            },
+            json=body
+        )
+
+    # Success
+    def test_patch_a_product_success(self):
+        result = self._patch_product(
+            1, {'price_per_cost_unit': 1.99, 'aisle_number': 2})
+
+        data = result.get_json()
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(data['product']['price_per_cost_unit'], 1.99)
+        self.assertEqual(data['product']['name'], 'Apples (Ambrosia)')
+        self.assertEqual(data['product']['best_before_date'], '2017-12-15')
+
+    def _mark_down(self, product_id, price, percent):
+        # Leaves the product as the markdown job does
+        with self.app.app_context():
+            db.session.query(Product).filter(Product.id == product_id).update(
+                {'price_per_cost_unit': price, 'markdown_percent': percent},
+                synchronize_session=False)
+            db.session.commit()
+
+    def _markdown(self, product_id):
+        with self.app.app_context():
+            return tuple(db.session.query(
+                Product.price_per_cost_unit, Product.markdown_percent).filter(
+                Product.id == product_id).one())
+
+    # Success - New stock is sold at the full price again
+    def test_patch_a_product_restarts_markdown(self):
+        self._mark_down(1, 0.8, 50)
+
+        result = self._patch_product(1, {'best_before_date': '2018-01-31'})
+
+        data = result.get_json()
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(data['product']['price_per_cost_unit'], 1.6)
+        self.assertEqual(data['product']['markdown_percent'], 0)
+
+        self._mark_down(1, 0.8, 50)
+        self._patch_product(1, {'price_per_cost_unit': 1.99})
+
+        self.assertEqual(self._markdown(1), (1.99, 0))
+
+    # Fail - Unknown product
+    def test_patch_a_product_not_found(self):
+        result = self._patch_product(9999, {'price_per_cost_unit': 1.99})
+
+        self.assertEqual(result.status_code, 404)
+
+    # Fail - Unknown field
+    def test_patch_a_product_unknown_field(self):
+        result = self._patch_product(1, {'markdown_percent': 50})
+
+        self.assertEqual(result.status_code, 400)
+
+    # Success - Edited at the version it was read at
+    def test_patch_a_product_at_its_version(self):
+        result = self._patch_product(1, {'brand': 'Orchard', 'version': 1})
+
+        data = result.get_json()
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(data['product']['version'], 2)
+        self.assertEqual(result.headers['ETag'], '"2"')
+
+    # Fail - Edited at an out of date version
+    def test_patch_a_product_stale_version(self):
+        self._patch_product(1, {'brand': 'Orchard', 'version': 1})
+
+        result = self.client().patch(
+            '/products/1',
+            headers={
+                'authorization': test_token,
+                'test_permission': 'put:product',
+                'If-Match': '"1"'
+            },
+            json={'brand': 'Stale'}
+        )
+
+        data = result.get_json()
+        self.assertEqual(result.status_code, 409)
+        self.assertEqual(data['message']['version'], 2)
+
+        with self.app.app_context():
+            brand = db.session.query(Product.brand).filter(
+                Product.id == 1).scalar()
+            db.session.remove()
+        self.assertEqual(brand, 'Orchard')
+
+    # Fail - The version is not a field to write
+    def test_patch_a_product_version_field(self):
+        result = self._patch_product(1, {'version': 'latest'})
+
+        self.assertEqual(result.status_code, 400)
+
+    # Success - A form sent with a real PUT, as the Postman collection does
+    def test_put_a_product_form(self):
+        result = self.client().put(
+            '/products/1',
+            headers={
+                'authorization': test_token,
+                'test_permission': 'put:product'
+            },
+            data={
+                '_method': 'PUT',
+                'name': 'Apples (Gala)',
+                'department_name': '1 - Produce',
+                'quantity_in_stock': '15'
+            }
+        )
+
+        data = result.get_json()
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(data['product']['name'], 'Apples (Gala)')
+        self.assertEqual(data['product']['organic'], 0)
+
+    ###########################################################
+    #
+    # Get / Expiring-stock Report
+    #
+    ###########################################################
+
+    # Success
+    def test_get_expiring_products_success(self):
+        result = self.client().get(
+            '/products/expiring?days=30&department_id=1',
+            headers={
+                'authorization': test_token,
+                'test_permission': 'get:product'
+            }
+        )
+
+        data = result.data.decode('utf8')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.mimetype, 'text/csv')
+        self.assertEqual(data.startswith('id,name,department_id'), True)
+
+    # Fail - Incorrect protocal
+    def test_get_expiring_products_post(self):
+        result = self.client().post(
+            '/products/expiring',
+            headers={
+                'authorization': test_token,
+                'test_permission': 'get:product'
+            }
+        )
+
+        data = result.data.decode('utf8')
+        self.assertEqual(result.status_code, 405)
+        self.assertEqual('Incorrect transfer protocol' in data, True)
+
+    # Fail - Wrong Permission
+    def test_get_expiring_products_wrong_permission(self):
+        result = self.client().get(
+            '/products/expiring',
+            headers={
+                'authorization': test_token,
+                'test_permission': 'post:product'
+            }
+        )
+
+        data = result.data.decode('utf8')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(
+            'Authentication and/or authorization error' in data, True)
+
+    ###########################################################
+    #
+    # Post / Bulk price and stock adjustment
+    #
+    ###########################################################
+
+    # Success - Dry run
+    def test_adjust_products_dry_run(self):
+        result = self.client().post(
+            '/products/adjust',
+            headers={
+                'authorization': test_token,
+                'test_permission': 'put:product'
+            },
+            json={
+                'field': 'price',
+                'percent': 10,
+                'department_id': 1,
+                'dry_run': True
+            }
+        )
+
+        data = result.get_json()
+        self.assertEqual(result.status_code, 200)
+        self.assertGreater(data['products'], 0)
+        for row in data['preview']:
+            self.assertAlmostEqual(
+                row['after'], round(row['before'] * 1.1, 2), places=2)
+
+        with self.app.app_context():
+            prices = [
+                product.price_per_cost_unit for product in db.session.query(
+                    Product).filter(Product.id.in_(
+                        [row['id'] for row in data['preview']])).order_by(
+                    Product.id)]
+            db.session.remove()
+        self.assertEqual(
+            prices, [row['before'] for row in data['preview']])
+
+    # Success
+    def test_adjust_products_stock(self):
+        result = self.client().post(
+            '/products/adjust',
+            headers={
+                'authorization': test_token,
+                'test_permission': 'put:product'
+            },
+            json={
+                'field': 'stock',
+                'amount': 5,
+                'product_ids': [1, 2]
+            }
+        )
+
+        data = result.get_json()
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(data['products'], 2)
+
+    # Fail - No products targeted
+    def test_adjust_products_no_target(self):
+        result = self.client().post(
+            '/products/adjust',
+            headers={
+                'authorization': test_token,
+                'test_permission': 'put:product'
+            },
+            json={
+                'field': 'price',
+                'percent': -100
+            }
+        )
+
+        self.assertEqual(result.status_code, 400)
+
+    # Fail - Wrong Permission
+    def test_adjust_products_wrong_permission(self):
+        result = self.client().post(
+            '/products/adjust',
+            headers={
+                'authorization': test_token,
+                'test_permission': 'get:product'
+            },
+            json={
+                'field': 'price',
+                'percent': 10,
+                'all': True
+            }
+        )
+
+        data = result.data.decode('utf8')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(
+            'Authentication and/or authorization error' in data, True)
+
     ###########################################################
     #
     # SUPPLIER
@@ -1189,7 +1857,7 @@ class TestApiMethods(unittest.TestCase):
     # Success
     def test_update_a_supplier_success(self):
         result = self.client().post(
-            '/suppliers/21',
+            '/suppliers/20',
             headers={
                 'authorization': test_token,
                 'test_permission': 'put:supplier'
@@ -1247,6 +1915,1045 @@ class TestApiMethods(unittest.TestCase):
         self.assertEqual(
             'Authentication and/or authorization error' in data, True)
 
+    ###########################################################
+    #
+    # REPLENISHMENT
+    #
+    # Get / Suggested Purchase Orders
+    #
+    ###########################################################
+
+    # Success
+    def test_get_replenishment_success(self):
+        result = self.client().get(
+            '/replenishment?as_of=12-01-2017&window_days=60',
+            headers={
+                'authorization': test_token,
+                'test_permission': 'get:supplier'
+            }
+        )
+
+        data = result.get_json()
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['window_days'], 60)
+        self.assertEqual(isinstance(data['purchase_orders'], list), True)
+
+    # Fail - Incorrect protocal
+    def test_get_replenishment_post(self):
+        result = self.client().post(
+            '/replenishment',
+            headers={
+                'authorization': test_token,
+                'test_permission': 'get:supplier'
+            }
+        )
+
+        data = result.data.decode('utf8')
+        self.assertEqual(result.status_code, 405)
+        self.assertEqual('Incorrect transfer protocol' in data, True)
+
+    # Fail - Wrong Permission
+    def test_get_replenishment_wrong_permission(self):
+        result = self.client().get(
+            '/replenishment',
+            headers={
+                'authorization': test_token,
+                'test_permission': 'post:supplier'
+            }
+        )
+
+        data = result.data.decode('utf8')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(
+            'Authentication and/or authorization error' in data, True)
+
+    ###########################################################
+    #
+    # DELIVERY
+    #
+    # Post / Receive a Delivery
+    #
+    ###########################################################
+
+    # Success
+    def test_receive_a_delivery_success(self):
+        result = self.client().post(
+            '/deliveries/create',
+            headers={
+                'authorization': test_token,
+                'test_permission': 'put:product'
+            },
+            json={
+                'supplier_id': 1,
+                'lines': [
+                    {'product_id': 1, 'quantity': 20},
+                    {'product_id': 2, 'quantity': 10},
+                    {'product_id': 1, 'quantity': 5}
+                ]
+            }
+        )
+
+        data = result.get_json()
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['products'], 2)
+        self.assertEqual(data['quantity'], 35)
+
+    # Success - Delivered stock is sold at the full price again
+    def test_receive_a_delivery_restarts_markdown(self):
+        self._mark_down(2, 0.75, 25)
+
+        result = self.client().post(
+            '/deliveries/create',
+            headers={
+                'authorization': test_token,
+                'test_permission': 'put:product'
+            },
+            json={
+                'supplier_id': 1,
+                'lines': [{'product_id': 2, 'quantity': 10}]
+            }
+        )
+
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(self._markdown(2), (1.0, 0))
+
+    # Fail - Incorrect protocal
+    def test_receive_a_delivery_get(self):
+        result = self.client().get(
+            '/deliveries/create',
+            headers={
+                'authorization': test_token,
+                'test_permission': 'put:product'
+            }
+        )
+
+        data = result.data.decode('utf8')
+        self.assertEqual(result.status_code, 405)
+        self.assertEqual('Incorrect transfer protocol' in data, True)
+
+    # Fail - Wrong Permission
+    def test_receive_a_delivery_wrong_permission(self):
+        result = self.client().post(
+            '/deliveries/create',
+            headers={
+                'authorization': test_token,
+                'test_permission': 'get:supplier'
+            },
+            json={
+                'supplier_id': 1,
+                'lines': [{'product_id': 1, 'quantity': 20}]
+            }
+        )
+
+        data = result.data.decode('utf8')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(
+            'Authentication and/or authorization error' in data, True)
+
+    ###########################################################
+    #
+    # PURCHASE
+    #
+    # Post / Cancel and refund Purchases
+    #
+    ###########################################################
+
+    def _post_purchases(self, route, body, permission='put:purchase'):
+        return self.client().post(
+            route,
+            headers={
+                'authorization': test_token,
+                'test_permission': permission
+            },
+            json=body
+        )
+
+    def _stock(self, product_id):
+        return db.session.query(Product.quantity_in_stock).filter(
+            Product.id == product_id).scalar()
+
+    # Success
+    def test_cancel_purchases_of_a_day(self):
+        stock = self._stock(17)
+        result = self._post_purchases(
+            '/purchases/cancel', {'purchase_date': '2017-11-01'})
+
+        data = result.get_json()
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(data['purchases'], 8)
+        self.assertEqual(data['products'], 8)
+        self.assertEqual(data['quantity'], 32)
+        self.assertEqual(data['refund'], 87.4)
+        self.assertEqual(self._stock(17), stock + 8)
+
+        stats = self._customer_purchases(1).get_json()['stats']
+        self.assertEqual(stats['order_count'], 1)
+        self.assertEqual(stats['lifetime_spend'], 56.22)
+
+        # Cancelled purchases are not cancelled again
+        result = self._post_purchases(
+            '/purchases/cancel', {'purchase_date': '2017-11-01'})
+
+        self.assertEqual(result.get_json()['purchases'], 0)
+        self.assertEqual(self._stock(17), stock + 8)
+
+    # Success
+    def test_refund_a_purchase_success(self):
+        stock = self._stock(13)
+        result = self._post_purchases('/purchases/7/refund', {})
+
+        data = result.get_json()
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(data['purchase_id'], 7)
+        self.assertEqual(data['quantity'], 2)
+        self.assertEqual(self._stock(13), stock + 2)
+        self.assertEqual(self._customer_purchases(4).get_json()['stats'], {
+            'order_count': 1,
+            'lifetime_spend': 1.59,
+            'last_purchase_date': '2017-11-11'
+        })
+
+        # Nothing left to refund
+        result = self._post_purchases('/purchases/7/refund', {})
+
+        self.assertEqual(result.status_code, 422)
+
+    # Success - Partial update of one product of an order
+    def test_patch_a_purchase_line(self):
+        result = self.client().patch(
+            '/purchases/7',
+            headers={
+                'authorization': test_token,
+                'test_permission': 'put:purchase'
+            },
+            json={'product_id': 13, 'total': 2.5}
+        )
+
+        data = result.get_json()
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(len(data['purchases']), 1)
+        self.assertEqual(data['purchases'][0]['quantity'], 2)
+        self.assertEqual(
+            self._customer_purchases(4).get_json()['stats']
+            ['lifetime_spend'], 4.09)
+
+    # Fail - No purchases targeted
+    def test_cancel_purchases_no_target(self):
+        result = self._post_purchases('/purchases/cancel', {})
+
+        self.assertEqual(result.status_code, 400)
+
+    # Fail - Wrong Permission
+    def test_cancel_purchases_wrong_permission(self):
+        result = self._post_purchases(
+            '/purchases/cancel', {'purchase_ids': [1]}, 'get:purchase')
+
+        data = result.data.decode('utf8')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(
+            'Authentication and/or authorization error' in data, True)
+
+    ###########################################################
+    #
+    # GROUP COMMIT
+    #
+    # Writes of concurrent requests committed together
+    #
+    ###########################################################
+
+    def _write_concurrently(self, writer, items):
+        errors = {}
+
+        def write(item):
+            try:
+                writer.write(item)
+            except Exception as e:
+                errors[item] = e
+
+        threads = [
+            threading.Thread(target=write, args=(item,)) for item in items]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        writer.close()
+
+        return errors
+
+    # Success
+    def test_group_commit_groups_writes(self):
+        groups = []
+        writer = GroupCommitWriter(groups.append, window=0.05)
+
+        errors = self._write_concurrently(writer, range(20))
+
+        self.assertEqual(errors, {})
+        self.assertEqual(
+            sorted(item for group in groups for item in group),
+            list(range(20)))
+        self.assertLess(len(groups), 20)
+
+    # Fail - One failed write fails alone
+    def test_group_commit_failure_isolated(self):
+        committed = []
+
+        def commit(items):
+            if 'bad' in items:
+                raise ValueError('bad item')
+            committed.extend(items)
+
+        writer = GroupCommitWriter(commit, window=0.05)
+
+        errors = self._write_concurrently(writer, ['a', 'bad', 'b'])
+
+        self.assertEqual(list(errors), ['bad'])
+        self.assertEqual(sorted(committed), ['a', 'b'])
+
+    # Fail - A dead writer thread fails its requests instead of hanging
+    def test_group_commit_writer_stopped(self):
+        committed = []
+        writer = GroupCommitWriter(committed.extend, poll=0.05)
+
+        def stop(group):
+            raise SystemExit()
+
+        writer._commit = stop
+        with self.assertRaises(RuntimeError):
+            writer.write('a')
+
+        # The next write starts a new thread
+        del writer._commit
+        writer.write('b')
+        writer.close()
+
+        self.assertEqual(committed, ['b'])
+
+    def _add_order(self, product, customer, total):
+        return self.client().post(
+            '/purchases/create',
+            headers={
+                'authorization': test_token,
+                'test_permission': 'post:purchase'
+            },
+            data={
+                'product': product,
+                'quantity': 2,
+                'customer': customer,
+                'purchase_date': '01/05/2018',
+                'total': total
+            }
+        )
+
+    # Success - Purchases of the route go through the writer
+    def test_group_commit_add_order(self):
+        self.app.config['PURCHASE_GROUP_COMMIT'] = True
+        writer = setup_group_commit(self.app)
+
+        try:
+            for product, total in (
+                    ('Apples (Ambrosia)', 3.18), ('Lettuce (Iceberg)', 2.5)):
+                result = self._add_order(product, 'Hermione Granger', total)
+                self.assertEqual(result.status_code, 302)
+        finally:
+            writer.close()
+            del self.app.extensions['purchase_writer']
+            self.app.config['PURCHASE_GROUP_COMMIT'] = False
+
+        data = self._customer_purchases(4).get_json()
+        self.assertEqual(
+            [(row['id'], row['product_id']) for row in data['purchases']][:2],
+            [(62, 13), (61, 1)])
+        self.assertEqual(data['stats']['order_count'], 4)
+
+    ###########################################################
+    #
+    # CHANGE FEED
+    #
+    # Changes of the rows streamed to the pages; on PostgreSQL
+    # they are only sent once the test's transaction commits,
+    # which it never does
+    #
+    ###########################################################
+
+    def _follow_changes(self, entities, keepalive=1):
+        feed = self.app.extensions['changefeed']
+        stream = feed.stream(feed.subscribe(), entities, 5, keepalive)
+        self.assertEqual(next(stream), 'retry: 3000\n\n')
+
+        return stream
+
+    def _next_change(self, stream):
+        event = next(stream)
+        self.assertEqual(event.startswith('event: change\n'), True)
+
+        return json.loads(event.split('data: ', 1)[1])
+
+    # Success
+    @unittest.skipUnless(SQLITE, 'NOTIFY waits for the outer commit')
+    def test_changes_of_a_patched_product(self):
+        stream = self._follow_changes({'product'})
+
+        self._patch_product(1, {'quantity_in_stock': 12})
+
+        change = self._next_change(stream)
+        stream.close()
+
+        self.assertEqual(change, {
+            'entity': 'product',
+            'op': 'update',
+            'id': 1,
+            'changes': {'quantity_in_stock': 12},
+            'version': 2
+        })
+
+    # Success - The stock received with a delivery
+    @unittest.skipUnless(SQLITE, 'NOTIFY waits for the outer commit')
+    def test_changes_of_a_delivery(self):
+        stream = self._follow_changes({'product'})
+
+        self.client().post(
+            '/deliveries/create',
+            headers={
+                'authorization': test_token,
+                'test_permission': 'put:product'
+            },
+            json={
+                'supplier_id': 1,
+                'lines': [{'product_id': 2, 'quantity': 10}]
+            }
+        )
+
+        change = self._next_change(stream)
+        stream.close()
+
+        self.assertEqual(change, {
+            'entity': 'product',
+            'op': 'update',
+            'id': 2,
+            'changes': {
+                'quantity_in_stock': self._stock(2),
+                'price_per_cost_unit': 1.49,
+                'markdown_percent': 0
+            },
+            'version': 2
+        })
+
+    # Success - A savepoint rolled back drops only its own changes
+    @unittest.skipUnless(SQLITE, 'NOTIFY waits for the outer commit')
+    def test_changes_past_a_rolled_back_savepoint(self):
+        stream = self._follow_changes({'product'})
+
+        with self.app.app_context():
+            session = db.session
+            session.query(Product).get(1).brand = 'Kept'
+            flush_session(session)
+
+            savepoint = session.begin_nested()
+            session.query(Product).get(2).brand = 'Rolled Back'
+            flush_session(session)
+            savepoint.rollback()
+
+            session.commit()
+
+        change = self._next_change(stream)
+        keepalive = next(stream)
+        stream.close()
+
+        self.assertEqual(
+            (change['id'], change['changes']), (1, {'brand': 'Kept'}))
+        self.assertEqual(keepalive, ': keepalive\n\n')
+
+    # Success - The cancelled line and the stock put back
+    @unittest.skipUnless(SQLITE, 'NOTIFY waits for the outer commit')
+    def test_changes_of_a_refund(self):
+        stream = self._follow_changes({'product', 'purchase'})
+
+        self._post_purchases('/purchases/7/refund', {})
+
+        purchase = self._next_change(stream)
+        product = self._next_change(stream)
+        stream.close()
+
+        self.assertEqual(purchase, {
+            'entity': 'purchase',
+            'op': 'update',
+            'id': [7, 13],
+            'changes': {'is_cancelled': True},
+            'version': 2
+        })
+        self.assertEqual(product['id'], 13)
+        self.assertEqual(
+            product['changes'], {'quantity_in_stock': self._stock(13)})
+
+    # Success - A rolled back change is not streamed
+    @unittest.skipUnless(SQLITE, 'NOTIFY waits for the outer commit')
+    def test_changes_rolled_back(self):
+        feed = self.app.extensions['changefeed']
+        stream = self._follow_changes({'product'}, 0.05)
+
+        with self.app.app_context():
+            feed.publish(db.session, [{
+                'entity': 'products',
+                'op': 'update',
+                'id': 1,
+                'changes': {'quantity_in_stock': 12},
+                'version': 2
+            }])
+            db.session.rollback()
+            db.session.remove()
+
+        event = next(stream)
+        stream.close()
+
+        self.assertEqual(event, ': keepalive\n\n')
+
+    # Fail - Unknown entity
+    def test_changes_unknown_entity(self):
+        result = self.client().get(
+            '/changes?entity=product,shelf',
+            headers={
+                'authorization': test_token,
+                'test_permission': 'get:product'
+            })
+
+        self.assertEqual(result.status_code, 400)
+
+    # Fail - Changes of an entity the user may not read
+    def test_changes_wrong_permission(self):
+        result = self.client().get(
+            '/changes?entity=customer',
+            headers={
+                'authorization': test_token,
+                'test_permission': 'get:product'
+            })
+
+        data = result.data.decode('utf8')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(
+            'Authentication and/or authorization error' in data, True)
+
+    # Fail - Every thread for streams is taken
+    def test_changes_no_stream_left(self):
+        feed = self.app.extensions['changefeed']
+        taken = [feed.subscribe() for n in range(feed.max_streams)]
+
+        try:
+            result = self.client().get(
+                '/changes',
+                headers={
+                    'authorization': test_token,
+                    'test_permission': 'get:product'
+                })
+        finally:
+            for subscriber in taken:
+                feed.unsubscribe(subscriber)
+
+        self.assertEqual(result.status_code, 503)
+
+    ###########################################################
+    #
+    # METRICS
+    #
+    # Get / Prometheus Metrics
+    #
+    ###########################################################
+
+    # Success
+    def test_get_metrics_success(self):
+        self.client().get('/home')
+        result = self.client().get('/metrics')
+
+        data = result.data.decode('utf8')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(
+            'http_requests_total{endpoint="/home",method="GET"' in data,
+            True)
+        self.assertEqual('db_queries_per_request_bucket' in data, True)
+
+    # Fail - Incorrect protocal
+    def test_get_metrics_post(self):
+        result = self.client().post('/metrics')
+
+        data = result.data.decode('utf8')
+        self.assertEqual(result.status_code, 405)
+        self.assertEqual('Incorrect transfer protocol' in data, True)
+
+    # Fail - Not a local request
+    def test_get_metrics_remote(self):
+        result = self.client().get(
+            '/metrics',
+            environ_base={'REMOTE_ADDR': '203.0.113.9'}
+        )
+
+        data = result.data.decode('utf8')
+        self.assertEqual(result.status_code, 403)
+        self.assertEqual('Request denied' in data, True)
+
+    # Success - A remote scraper with the metrics token; not without it
+    def test_get_metrics_remote_token(self):
+        token = self.app.config['METRICS_TOKEN']
+        self.app.config['METRICS_TOKEN'] = 'scrape-secret'
+
+        try:
+            results = [
+                self.client().get(
+                    '/metrics',
+                    headers={'Authorization': f'Bearer {secret}'},
+                    environ_base={'REMOTE_ADDR': '203.0.113.9'}
+                ).status_code
+                for secret in ('scrape-secret', 'guess')]
+        finally:
+            self.app.config['METRICS_TOKEN'] = token
+
+        self.assertEqual(results, [200, 403])
+
+    ###########################################################
+    #
+    # QUERY BUDGET
+    #
+    # Get / All listing routes stay within their query budget
+    #
+    ###########################################################
+
+    # Success
+    def test_routes_within_query_budget(self):
+        for route, (permission, budget) in ROUTE_QUERY_BUDGETS.items():
+            with QueryRecorder() as queries:
+                result = self.client().get(
+                    route,
+                    headers={
+                        'authorization': test_token,
+                        'test_permission': permission
+                    }
+                )
+
+            self.assertEqual(result.status_code, 200, route)
+            self.assertLessEqual(
+                queries.count, budget,
+                f'{route} ran {queries.count} queries')
+
+    # Fail - N+1 query
+    def test_routes_without_n_plus_one(self):
+        for route, (permission, budget) in ROUTE_QUERY_BUDGETS.items():
+            with QueryRecorder() as queries:
+                self.client().get(
+                    route,
+                    headers={
+                        'authorization': test_token,
+                        'test_permission': permission
+                    }
+                )
+
+            self.assertEqual(queries.suspects(), [], route)
+
+    ###########################################################
+    #
+    # SESSION
+    #
+    # Get / Home page of a logged in user
+    #
+    ###########################################################
+
+    # Success
+    def test_session_kept_server_side(self):
+        with self.client() as client:
+            with client.session_transaction() as session:
+                session[Config.PROFILE_KEY] = {'nickname': 'Tester'}
+                session[Config.ACCESS_KEY] = {'access': 'x' * 2048}
+
+            result = client.get('/home')
+
+        cookie = next(
+            c for c in client.cookie_jar
+            if c.name == test_app.session_cookie_name)
+        data = result.data.decode('utf8')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual('Welcome Tester' in data, True)
+        self.assertLess(len(cookie.value), 64)
+
+    # Fail - Logged out
+    def test_session_cleared_on_logout(self):
+        with self.client() as client:
+            with client.session_transaction() as session:
+                session[Config.PROFILE_KEY] = {'nickname': 'Tester'}
+
+            client.get('/logout')
+            result = client.get('/home')
+
+        data = result.data.decode('utf8')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual('Welcome Tester' in data, False)
+
+    ###########################################################
+    #
+    # STATIC ASSETS
+    #
+    # Get / A fingerprinted, precompressed asset
+    #
+    ###########################################################
+
+    def _built_assets_app(self, directory):
+        static = os.path.join(directory, 'static')
+        shutil.copytree(test_app.static_folder, static)
+        manifest = build_assets(static)
+
+        app = Flask(__name__, static_folder=static)
+        setup_assets(app)
+
+        return app, manifest
+
+    # Success
+    def test_get_fingerprinted_asset(self):
+        with tempfile.TemporaryDirectory() as directory:
+            app, manifest = self._built_assets_app(directory)
+
+            with app.test_request_context():
+                url = app.jinja_env.globals['asset_url']('css/style.css')
+
+            result = app.test_client().get(
+                url, headers={'Accept-Encoding': 'gzip, br'})
+
+            self.assertEqual(url, f'/assets/{manifest["css/style.css"]}')
+            self.assertEqual(result.status_code, 200)
+            self.assertEqual(result.headers['Content-Encoding'], 'br')
+            self.assertEqual(
+                'immutable' in result.headers['Cache-Control'], True)
+            result.close()
+
+    # Fail - Not a built asset
+    def test_get_unknown_asset(self):
+        with tempfile.TemporaryDirectory() as directory:
+            app, manifest = self._built_assets_app(directory)
+
+            result = app.test_client().get('/assets/css/style.css')
+
+            self.assertEqual(result.status_code, 404)
+
+    ###########################################################
+    #
+    # COMPRESSION
+    #
+    # Get / A listing page and a streamed report, compressed
+    #
+    ###########################################################
+
+    # Success
+    def test_get_products_gzip(self):
+        result = self.client().get(
+            '/products',
+            headers={
+                'authorization': test_token,
+                'test_permission': 'get:product',
+                'Accept-Encoding': 'gzip'
+            }
+        )
+
+        data = zlib.decompress(result.data, 31).decode('utf8')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.headers['Content-Encoding'], 'gzip')
+        self.assertEqual('Accept-Encoding' in result.headers['Vary'], True)
+        self.assertEqual('<h2>Manage <b>Products</b>' in data, True)
+
+    # Success
+    def test_get_expiring_products_gzip(self):
+        result = self.client().get(
+            '/products/expiring?days=30',
+            headers={
+                'authorization': test_token,
+                'test_permission': 'get:product',
+                'Accept-Encoding': 'gzip'
+            }
+        )
+
+        data = zlib.decompress(result.data, 31).decode('utf8')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.headers['Content-Encoding'], 'gzip')
+        self.assertEqual('Content-Length' in result.headers, False)
+        self.assertEqual(data.startswith('id,name,department_id'), True)
+
+    # Fail - Client does not accept a compressed response
+    def test_get_products_identity(self):
+        result = self.client().get(
+            '/products',
+            headers={
+                'authorization': test_token,
+                'test_permission': 'get:product'
+            }
+        )
+
+        data = result.data.decode('utf8')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual('Content-Encoding' in result.headers, False)
+        self.assertEqual('<h2>Manage <b>Products</b>' in data, True)
+
+    ###########################################################
+    #
+    # CORS
+    #
+    # Options / A preflight request
+    #
+    ###########################################################
+
+    # Success
+    def test_preflight_products(self):
+        result = self.client().options(
+            '/products/1',
+            headers={
+                'Origin': 'http://localhost:3000',
+                'Access-Control-Request-Method': 'PUT',
+                'Access-Control-Request-Headers': 'authorization'
+            }
+        )
+
+        self.assertEqual(result.status_code, 204)
+        self.assertEqual(
+            result.headers['Access-Control-Allow-Origin'], '*')
+        self.assertEqual(
+            result.headers['Access-Control-Max-Age'],
+            str(Config.CORS_MAX_AGE))
+        # Answered before the app: no session, no auth, no query
+        self.assertEqual('X-Query-Count' in result.headers, False)
+
+    # Fail - Method not served by the route
+    def test_preflight_wrong_method(self):
+        result = self.client().options(
+            '/products/1',
+            headers={
+                'Origin': 'http://localhost:3000',
+                'Access-Control-Request-Method': 'DELETE'
+            }
+        )
+
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(
+            'Access-Control-Max-Age' in result.headers, False)
+
+    ###########################################################
+    #
+    # BATCH
+    #
+    # Post / Several operations in one request
+    #
+    ###########################################################
+
+    # Success
+    def test_batch_update_products_success(self):
+        result = self.client().post(
+            '/batch',
+            headers={
+                'authorization': test_token,
+                'test_permission': 'put:product'
+            },
+            json={
+                'operations': [
+                    {'op': 'update', 'entity': 'product', 'id': 1,
+                     'data': {'brand': 'Batch Farms'}},
+                    {'op': 'update', 'entity': 'product', 'id': 2,
+                     'data': {'brand': 'Batch Farms',
+                              'best_before_date': '2030-01-31'}}
+                ]
+            }
+        )
+
+        data = result.get_json()
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(
+            [r['status'] for r in data['results']], ['ok', 'ok'])
+
+        with self.app.app_context():
+            brands = {
+                product.brand for product in db.session.query(
+                    Product).filter(Product.id.in_([1, 2]))}
+            db.session.remove()
+        self.assertEqual(brands, {'Batch Farms'})
+
+    # Success - A created product is put in its aisle; one without fails
+    def test_batch_create_product_in_aisle(self):
+        product = {
+            'name': 'Batch Bread',
+            'price_per_cost_unit': 2.99,
+            'cost_unit': 'loaf',
+            'department_id': 1
+        }
+
+        result = self.client().post(
+            '/batch',
+            headers={
+                'authorization': test_token,
+                'test_permission': 'post:product'
+            },
+            json={
+                'atomic': False,
+                'operations': [
+                    {'op': 'create', 'entity': 'product',
+                     'data': dict(product, aisle_number=2)},
+                    {'op': 'create', 'entity': 'product', 'data': product}
+                ]
+            }
+        )
+
+        data = result.get_json()
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(
+            [r['status'] for r in data['results']], ['ok', 'error'])
+        self.assertEqual(
+            data['results'][1]['error'], 'aisle_number is required')
+
+        with self.app.app_context():
+            aisle_number = db.session.query(
+                t_aislecontains.c.aisle_number).filter(
+                t_aislecontains.c.product_id ==
+                data['results'][0]['id']).scalar()
+            db.session.remove()
+        self.assertEqual(aisle_number, 2)
+
+    # Fail - Operation made against an out of date version
+    def test_batch_stale_version(self):
+        result = self.client().post(
+            '/batch',
+            headers={
+                'authorization': test_token,
+                'test_permission': 'put:product'
+            },
+            json={
+                'atomic': False,
+                'operations': [
+                    {'op': 'update', 'entity': 'product', 'id': 1,
+                     'version': 1, 'data': {'brand': 'Batch Farms'}},
+                    {'op': 'update', 'entity': 'product', 'id': 1,
+                     'version': 1, 'data': {'brand': 'Stale Farms'}}
+                ]
+            }
+        )
+
+        data = result.get_json()
+        self.assertEqual(
+            [r['status'] for r in data['results']], ['ok', 'error'])
+        self.assertEqual(
+            data['results'][1]['error'],
+            'Product 1 is at version 2, not 1')
+
+    # Success - Partial, one operation fails alone
+    def test_batch_partial_success(self):
+        result = self.client().post(
+            '/batch',
+            headers={
+                'authorization': test_token,
+                'test_permission': 'put:product'
+            },
+            json={
+                'atomic': False,
+                'operations': [
+                    {'op': 'update', 'entity': 'product', 'id': 1,
+                     'data': {'quantity_in_stock': 40}},
+                    {'op': 'update', 'entity': 'product', 'id': 999999,
+                     'data': {'quantity_in_stock': 40}}
+                ]
+            }
+        )
+
+        data = result.get_json()
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(
+            [r['status'] for r in data['results']], ['ok', 'error'])
+
+    # Fail - Atomic, one unknown field rolls back the batch
+    def test_batch_atomic_rolled_back(self):
+        result = self.client().post(
+            '/batch',
+            headers={
+                'authorization': test_token,
+                'test_permission': 'put:product'
+            },
+            json={
+                'operations': [
+                    {'op': 'update', 'entity': 'product', 'id': 1,
+                     'data': {'brand': 'Never Stored'}},
+                    {'op': 'update', 'entity': 'product', 'id': 2,
+                     'data': {'colour': 'red'}},
+                    {'op': 'update', 'entity': 'product', 'id': 3,
+                     'data': {'brand': 'Never Stored'}}
+                ]
+            }
+        )
+
+        data = result.get_json()
+        self.assertEqual(result.status_code, 422)
+        self.assertEqual(
+            [r['status'] for r in data['results']],
+            ['rolled back', 'error', 'skipped'])
+
+        with self.app.app_context():
+            stored = db.session.query(Product).filter(
+                Product.brand == 'Never Stored').count()
+            db.session.remove()
+        self.assertEqual(stored, 0)
+
+    # Fail - Wrong Permission
+    def test_batch_wrong_permission(self):
+        result = self.client().post(
+            '/batch',
+            headers={
+                'authorization': test_token,
+                'test_permission': 'put:product'
+            },
+            json={
+                'operations': [
+                    {'op': 'delete', 'entity': 'aisle', 'id': 1}
+                ]
+            }
+        )
+
+        data = result.get_json()
+        self.assertEqual(result.status_code, 422)
+        self.assertEqual(
+            data['results'][0]['error'], 'Permission not found')
+
+    # Fail - Only aisles can be deleted
+    def test_batch_delete_product(self):
+        result = self.client().post(
+            '/batch',
+            headers={
+                'authorization': test_token,
+                'test_permission': 'delete:aisle'
+            },
+            json={
+                'operations': [
+                    {'op': 'delete', 'entity': 'product', 'id': 1}
+                ]
+            }
+        )
+
+        self.assertEqual(result.status_code, 400)
+
+    ###########################################################
+    #
+    # LOGGING
+    #
+    ###########################################################
+
+    # Success - Set up again, logging replaces its handler and listener
+    def test_setup_logging_again(self):
+        app = Flask('logging_test')
+        app.config.update(test_app.config)
+
+        try:
+            first = setup_logging(app)
+            second = setup_logging(app)
+
+            self.assertEqual(len([
+                handler for handler in app.logger.handlers
+                if isinstance(handler, NonBlockingQueueHandler)]), 1)
+            self.assertEqual(first._thread, None)
+            self.assertEqual(second._thread.is_alive(), True)
+        finally:
+            setup_logging(test_app)
+
 
 # Make the tests conveniently executable
 if __name__ == "__main__":